@@ -0,0 +1,267 @@
+"""
+Generates synthetic allowance_events, allowance_backend_table and
+payment_schedule_backend_table datasets with the same shape as the sample under
+exploratory_data_analysis/datasets, at a configurable scale and with
+configurable violation rates.
+
+Usage:
+    python benchmarks/generate_datasets.py --users 1000000 --output-dir /tmp/allowances_1m
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mnt", "airflow", "dags"))
+from tasks import payment_calendar
+
+FREQUENCIES = np.array(['daily', 'biweekly', 'weekly', 'monthly'])
+FREQUENCY_WEIGHTS = np.array([0.05, 0.35, 0.45, 0.15])
+WEEKDAYS = np.array(['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday'])
+MONTH_DAYS = np.array(['first_day', 'fifteenth_day'])
+INVALID_DAY = 'someday'
+EVENT_TIMEZONE = 'America/Los_Angeles'
+
+DEFAULT_VIOLATION_RATES = {
+    "schedule_mismatch": 0.001,
+    "disabled_with_payment": 0.002,
+    "payment_mismatch": 0.02,
+    "duplicate_payment": 0.005,
+    "invalid_day": 0.0,
+}
+
+def _uuid_strings(rng, size):
+    """
+    Generates random version 4 UUID strings with vectorized operations.
+
+    Args:
+        rng (np.random.Generator): The random generator.
+        size (int): Number of UUIDs.
+
+    Returns:
+        np.ndarray: The UUID strings.
+    """
+    nibbles = rng.integers(0, 16, size=(size, 32), dtype=np.uint8)
+    nibbles[:, 12] = 4
+    nibbles[:, 16] = 8 + (nibbles[:, 16] & 3)
+    ascii_codes = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)[nibbles]
+    dashed = np.full((size, 36), ord('-'), dtype=np.uint8)
+    for target, source in ((slice(0, 8), slice(0, 8)), (slice(9, 13), slice(8, 12)), (slice(14, 18), slice(12, 16)),
+                           (slice(19, 23), slice(16, 20)), (slice(24, 36), slice(20, 32))):
+        dashed[:, target] = ascii_codes[:, source]
+    return dashed.view('S36').ravel().astype(str)
+
+def _random_schedules(rng, size):
+    """
+    Draws random (frequency, day) schedules.
+
+    Args:
+        rng (np.random.Generator): The random generator.
+        size (int): Number of schedules.
+
+    Returns:
+        tuple: Arrays of frequencies and days.
+    """
+    frequency = rng.choice(FREQUENCIES, size=size, p=FREQUENCY_WEIGHTS)
+    day = rng.choice(WEEKDAYS, size=size).astype(object)
+    monthly = frequency == 'monthly'
+    day[monthly] = rng.choice(MONTH_DAYS, size=int(monthly.sum()))
+    day[frequency == 'daily'] = 'daily'
+    return frequency, day
+
+def _events_per_user(rng, size, distribution, mean):
+    """
+    Draws the number of events of each user (at least 1).
+
+    Args:
+        rng (np.random.Generator): The random generator.
+        size (int): Number of users.
+        distribution (str): 'poisson', 'geometric' or 'constant'.
+        mean (float): Mean number of events per user.
+
+    Returns:
+        np.ndarray: The number of events of each user.
+    """
+    if distribution == 'constant':
+        return np.full(size, max(int(round(mean)), 1))
+    if distribution == 'geometric':
+        return rng.geometric(1.0 / max(mean, 1.0), size=size)
+    return 1 + rng.poisson(max(mean - 1.0, 0.0), size=size)
+
+def _format_event_timestamps(epochs):
+    """
+    Formats epoch seconds like the events source: local time of the allowance
+    service, hour without padding ('2024-09-21 1:39:34').
+
+    Args:
+        epochs (np.ndarray): Epoch seconds.
+
+    Returns:
+        list: The formatted timestamps.
+    """
+    timestamps = pd.to_datetime(epochs, unit='s', utc=True).tz_convert(EVENT_TIMEZONE)
+    dates = timestamps.strftime('%Y-%m-%d')
+    clock = timestamps.strftime('%M:%S')
+    return [f"{date} {hour}:{rest}" for date, hour, rest in zip(dates, timestamps.hour, clock)]
+
+def _write_events(events_file, user_ids, counts, first_epochs, final_frequency, final_day, rng, first_chunk):
+    """
+    Appends the events of a chunk of users to the JSON array.
+
+    The last event of each user carries the user's final schedule; earlier events
+    carry random schedules, so the history has edits to replay.
+
+    Args:
+        events_file (file): The open events file.
+        user_ids (np.ndarray): The user ids of the chunk.
+        counts (np.ndarray): Number of events of each user.
+        first_epochs (np.ndarray): Epoch seconds of the first event of each user.
+        final_frequency (np.ndarray): Final frequency of each user.
+        final_day (np.ndarray): Final day of each user.
+        rng (np.random.Generator): The random generator.
+        first_chunk (bool): Whether this is the first chunk written.
+
+    Returns:
+        np.ndarray: Epoch seconds of the last event of each user.
+    """
+    total = int(counts.sum())
+    owner = np.repeat(np.arange(len(user_ids)), counts)
+    position = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    gaps = rng.integers(1, 3 * 24 * 3600, size=total)
+    gaps[position == 0] = 0
+    elapsed = np.cumsum(gaps)
+    epochs = first_epochs[owner] + elapsed - elapsed[np.cumsum(counts) - counts][owner]
+    frequency, day = _random_schedules(rng, total)
+    is_last = np.zeros(total, dtype=bool)
+    is_last[np.cumsum(counts) - 1] = True
+    frequency[is_last] = final_frequency
+    day[is_last] = final_day
+    amount = rng.integers(1, 100, size=total)
+    names = np.where(position == 0, 'allowance.created', 'allowance.edited')
+    timestamps = _format_event_timestamps(epochs)
+
+    records = [
+        '{"user": {"id": "%s"}, "event": {"timestamp": "%s", "name": "%s"}, '
+        '"allowance": {"scheduled": {"frequency": "%s", "day": "%s"}, "amount": %d}}'
+        % values
+        for values in zip(user_ids[owner], timestamps, names, frequency, day, amount)
+    ]
+    events_file.write(("" if first_chunk else ",\n") + ",\n".join(records))
+    return epochs[is_last]
+
+def generate_datasets(output_dir, users, events_mean=2.2, events_distribution='poisson',
+                      violation_rates=None, as_of=datetime(2024, 12, 3), chunk_size=500000, seed=42):
+    """
+    Generates the three source datasets in chunks of users.
+
+    Args:
+        output_dir (str): Directory where the datasets are written.
+        users (int): Number of users.
+        events_mean (float, optional): Mean number of events per user.
+        events_distribution (str, optional): 'poisson', 'geometric' or 'constant'.
+        violation_rates (dict, optional): Rates of the injected violations (see DEFAULT_VIOLATION_RATES).
+        as_of (datetime, optional): Date used to compute next_payment_day.
+        chunk_size (int, optional): Number of users generated per chunk.
+        seed (int, optional): Seed of the random generator.
+
+    Returns:
+        dict: Paths of the generated datasets and the number of injected violations.
+    """
+    rates = dict(DEFAULT_VIOLATION_RATES, **(violation_rates or {}))
+    rng = np.random.default_rng(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {
+        "allowance_events": os.path.join(output_dir, "allowance_events"),
+        "allowance_backend": os.path.join(output_dir, "allowance_backend_table"),
+        "payment_schedule_backend": os.path.join(output_dir, "payment_schedule_backend_table"),
+    }
+    injected = {name: 0 for name in rates}
+    start_epoch = int(pd.Timestamp(as_of).timestamp()) - 180 * 24 * 3600
+
+    with open(paths["allowance_events"], "w") as events_file:
+        events_file.write("[\n")
+        for chunk_start in range(0, users, chunk_size):
+            size = min(chunk_size, users - chunk_start)
+            user_ids = _uuid_strings(rng, size)
+            counts = _events_per_user(rng, size, events_distribution, events_mean)
+            first_epochs = start_epoch + rng.integers(0, 150 * 24 * 3600, size=size)
+            frequency, day = _random_schedules(rng, size)
+            last_epochs = _write_events(events_file, user_ids, counts, first_epochs, frequency, day, rng, chunk_start == 0)
+
+            backend_frequency, backend_day = frequency.copy(), day.copy()
+            mismatch = rng.random(size) < rates["schedule_mismatch"]
+            backend_frequency[mismatch], backend_day[mismatch] = _random_schedules(rng, int(mismatch.sum()))
+            invalid_day = rng.random(size) < rates["invalid_day"]
+            backend_day[invalid_day] = INVALID_DAY
+            status = np.where(rng.random(size) < 0.25, 'disabled', 'enabled')
+            next_payment_day = payment_calendar.expected_next_payment_day(pd.Series(frequency), pd.Series(day), as_of).to_numpy()
+            updated_at = np.where(
+                counts > 1,
+                pd.to_datetime(last_epochs, unit='s').strftime('%Y-%m-%dT%H:%M:%S.%f000Z'),
+                first_epochs.astype(str),
+            )
+            pd.DataFrame({
+                "uuid": user_ids,
+                "creation_date": first_epochs,
+                "frequency": backend_frequency,
+                "day": backend_day,
+                "updated_at": updated_at,
+                "next_payment_day": next_payment_day,
+                "status": status,
+            }).to_csv(paths["allowance_backend"], mode="w" if chunk_start == 0 else "a",
+                      header=chunk_start == 0, index=False)
+
+            with_payment = (status == 'enabled') | (rng.random(size) < rates["disabled_with_payment"])
+            payment_date = next_payment_day.copy()
+            payment_mismatch = rng.random(size) < rates["payment_mismatch"]
+            payment_date[payment_mismatch] = rng.integers(1, 32, size=int(payment_mismatch.sum()))
+            duplicate = with_payment & (rng.random(size) < rates["duplicate_payment"])
+            payments = pd.DataFrame({"user_id": user_ids, "payment_date": payment_date})
+            payments = pd.concat([payments[with_payment], payments[duplicate]]).sort_index(kind="stable")
+            payments.to_csv(paths["payment_schedule_backend"], mode="w" if chunk_start == 0 else "a",
+                            header=chunk_start == 0, index=False)
+
+            injected["schedule_mismatch"] += int((mismatch & (status == 'enabled')).sum())
+            injected["disabled_with_payment"] += int((with_payment & (status == 'disabled')).sum())
+            injected["payment_mismatch"] += int((payment_mismatch & with_payment).sum())
+            injected["duplicate_payment"] += int(duplicate.sum())
+            injected["invalid_day"] += int(invalid_day.sum())
+            logging.info(f"Generated {chunk_start + size} of {users} users")
+        events_file.write("\n]\n")
+
+    return {"paths": paths, "injected_violations": injected}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--events-mean", type=float, default=2.2)
+    parser.add_argument("--events-distribution", choices=["poisson", "geometric", "constant"], default="poisson")
+    parser.add_argument("--violation-rates", type=json.loads, default={},
+                        help=f"JSON overriding the default rates: {json.dumps(DEFAULT_VIOLATION_RATES)}")
+    parser.add_argument("--as-of", type=lambda value: datetime.strptime(value, "%Y-%m-%d"), default=datetime(2024, 12, 3))
+    parser.add_argument("--chunk-size", type=int, default=500000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    result = generate_datasets(
+        args.output_dir,
+        args.users,
+        events_mean=args.events_mean,
+        events_distribution=args.events_distribution,
+        violation_rates=args.violation_rates,
+        as_of=args.as_of,
+        chunk_size=args.chunk_size,
+        seed=args.seed,
+    )
+    print(json.dumps(result, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+"""
+Times and memory-profiles each look_* task and each _check_* function against a
+dataset generated by generate_datasets.py, and appends the results to a JSON
+lines file so that runs can be compared.
+
+Each benchmark runs in a fresh process, so the peak RSS of one benchmark does not
+leak into the next. The look_* tasks fetch the datasets over HTTP from a local
+server, like they do from the gist in the DAG.
+
+A benchmark whose process crashes (e.g. killed when it runs out of memory) or runs
+longer than the DAG run timeout is recorded as a failed run instead of stalling the
+harness. The results are kept next to the dataset by default.
+
+Usage:
+    python benchmarks/run_benchmarks.py --data-dir /tmp/allowances_1m
+"""
+import argparse
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import queue as queue_module
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+DAGS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mnt", "airflow", "dags")
+DAGRUN_TIMEOUT_SECONDS = 60 * 60
+REGRESSION_THRESHOLD = 0.2
+# How often the harness checks that a benchmark process is still alive
+RESULT_POLL_SECONDS = 5
+RESULTS_FILE_NAME = "benchmark_results.jsonl"
+# Default reference date of generate_datasets.py
+AS_OF = "2024-12-03"
+
+TASK_BENCHMARKS = ["look_for_inconsistencies", "look_allowance_backend", "look_payment_schedule"]
+CHECK_BENCHMARKS = [
+    "look_allowance_backend._check_values_allowance_backend",
+    "look_payment_schedule._check_values_payment_schedule_backend",
+    "look_for_inconsistencies._check_values_allowance_backend",
+    "look_for_inconsistencies._check_values_payment_schedule_backend",
+    "look_for_inconsistencies._check_values_replayed_state",
+    "look_allowance_backend._check_values_next_payment_day",
+]
+
+def _load_tables(data_dir):
+    """
+    Parses the datasets from disk with the same parsers as the tasks.
+
+    Args:
+        data_dir (str): Directory of the datasets.
+
+    Returns:
+        dict: The 'allowance_events' (latest event per user), 'all_allowance_events',
+            'allowance_backend' and 'payment_schedule_backend' DataFrames.
+    """
+    from tasks import utils
+
+    tables = {}
+    with open(os.path.join(data_dir, "allowance_events"), "rb") as stream:
+        tables["all_allowance_events"] = utils.SNAPSHOT_PARSERS["json"](stream)
+    with open(os.path.join(data_dir, "allowance_events"), "rb") as stream:
+        tables["allowance_events"] = utils.SNAPSHOT_PARSERS["json_latest"](stream)
+    with open(os.path.join(data_dir, "allowance_backend_table"), "rb") as stream:
+        tables["allowance_backend"] = utils.SNAPSHOT_PARSERS["allowance_backend"](stream)
+    with open(os.path.join(data_dir, "payment_schedule_backend_table"), "rb") as stream:
+        tables["payment_schedule_backend"] = utils.SNAPSHOT_PARSERS["payment_schedule_backend"](stream)
+    return tables
+
+def _prepare(name, data_dir, base_url):
+    """
+    Builds the callable measured by a benchmark. Loading the inputs of the
+    _check_* functions is not part of the measure.
+
+    Args:
+        name (str): Name of the benchmark.
+        data_dir (str): Directory of the datasets.
+        base_url (str): URL of the local server of the datasets.
+
+    Returns:
+        tuple: The callable and the number of input rows.
+    """
+    from tasks import look_allowance_backend, look_for_inconsistencies, look_payment_schedule
+
+    urls = {
+        "allowance_events": f"{base_url}/allowance_events",
+        "allowance_backend": f"{base_url}/allowance_backend_table",
+        "payment_schedule_backend": f"{base_url}/payment_schedule_backend_table",
+    }
+    run_id = f"benchmark_{os.getpid()}"
+    if name == "look_for_inconsistencies":
+        return functools.partial(look_for_inconsistencies.look_for_inconsistencies, run_id=run_id, **urls), None
+    if name == "look_allowance_backend":
+        return functools.partial(look_allowance_backend.look_for_inconsistencies, run_id=run_id, allowance_backend=urls["allowance_backend"], as_of=AS_OF), None
+    if name == "look_payment_schedule":
+        return functools.partial(look_payment_schedule.look_for_inconsistencies, run_id=run_id, payment_schedule_backend=urls["payment_schedule_backend"]), None
+
+    tables = _load_tables(data_dir)
+    events, backend, payments = tables["allowance_events"], tables["allowance_backend"], tables["payment_schedule_backend"]
+    all_events = tables["all_allowance_events"]
+    checks = {
+        "look_allowance_backend._check_values_allowance_backend":
+            (functools.partial(look_allowance_backend._check_values_allowance_backend, backend), len(backend)),
+        "look_payment_schedule._check_values_payment_schedule_backend":
+            (functools.partial(look_payment_schedule._check_values_payment_schedule_backend, payments), len(payments)),
+        "look_for_inconsistencies._check_values_allowance_backend":
+            (functools.partial(look_for_inconsistencies._check_values_allowance_backend, events, backend), len(events) + len(backend)),
+        "look_for_inconsistencies._check_values_payment_schedule_backend":
+            (functools.partial(look_for_inconsistencies._check_values_payment_schedule_backend, backend, payments), len(backend) + len(payments)),
+        "look_allowance_backend._check_values_next_payment_day":
+            (functools.partial(look_allowance_backend._check_values_next_payment_day, backend, AS_OF), len(backend)),
+        "look_for_inconsistencies._check_values_replayed_state":
+            (functools.partial(look_for_inconsistencies._check_values_replayed_state, all_events, backend), len(all_events) + len(backend)),
+    }
+    return checks[name]
+
+def _run_benchmark(name, data_dir, base_url, work_dir, trace_memory, queue):
+    """
+    Runs a single benchmark in the current (fresh) process and puts its measures in the queue.
+
+    Args:
+        name (str): Name of the benchmark.
+        data_dir (str): Directory of the datasets.
+        base_url (str): URL of the local server of the datasets.
+        work_dir (str): Directory for the snapshots, downloads and violation files of the run.
+        trace_memory (bool): Whether to measure the peak of Python allocations with tracemalloc.
+        queue (multiprocessing.Queue): Queue where the result is put.
+    """
+    for variable, directory in (("ALLOWANCES_SNAPSHOT_DIR", "snapshots"), ("ALLOWANCES_DOWNLOAD_DIR", "downloads"),
+                                ("ALLOWANCES_VIOLATIONS_DIR", "violations"), ("ALLOWANCES_STATE_DIR", "state")):
+        os.environ[variable] = os.path.join(work_dir, directory)
+    # The tasks are timed end to end, never served from a memoized result nor diffed with a previous run
+    os.environ["ALLOWANCES_MEMO"] = "0"
+    os.environ["ALLOWANCES_VIOLATION_HISTORY"] = "0"
+    sys.path.insert(0, DAGS_DIR)
+    logging.basicConfig(level=logging.WARNING)
+
+    result = {"benchmark": name}
+    try:
+        function, rows = _prepare(name, data_dir, base_url)
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if trace_memory:
+            tracemalloc.start()
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        try:
+            found = function()
+            result["violations"] = sum(violation["count"] for violation in found) if isinstance(found, list) else 0
+        except Exception as e:
+            # The look_* tasks raise when they find violations, which is expected on generated data
+            result["raised"] = str(e).splitlines()[0]
+        result["wall_seconds"] = round(time.perf_counter() - wall_start, 4)
+        result["cpu_seconds"] = round(time.process_time() - cpu_start, 4)
+        if trace_memory:
+            result["python_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+            tracemalloc.stop()
+        result["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2)
+        result["rss_growth_mb"] = round((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024, 2)
+        result["rows_in"] = rows
+        result["status"] = "ok"
+    except Exception as e:
+        logging.exception(e)
+        result["status"] = "error"
+        result["error"] = str(e)
+    queue.put(result)
+
+def _serve(data_dir):
+    """
+    Serves the datasets over HTTP on a free local port.
+
+    Args:
+        data_dir (str): Directory of the datasets.
+
+    Returns:
+        ThreadingHTTPServer: The running server.
+    """
+    handler = functools.partial(_QuietHandler, directory=data_dir)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def _load_baseline(path):
+    """
+    Reads the latest result of each benchmark from a previous results file.
+
+    Args:
+        path (str): Path of the results file.
+
+    Returns:
+        dict: The latest result by (benchmark, users).
+    """
+    baseline = {}
+    if path and os.path.exists(path):
+        with open(path) as results_file:
+            for line in results_file:
+                result = json.loads(line)
+                baseline[(result["benchmark"], result.get("users"))] = result
+    return baseline
+
+def _compare(result, baseline, threshold):
+    """
+    Flags a result slower or bigger than its baseline by more than the threshold,
+    or too slow to fit in the DAG run timeout.
+
+    Args:
+        result (dict): The benchmark result.
+        baseline (dict): The baseline results (see _load_baseline).
+        threshold (float): Relative growth tolerated.
+
+    Returns:
+        list: The regressions found, as messages.
+    """
+    regressions = []
+    if result.get("status") in ("crashed", "timeout"):
+        regressions.append(f"{result['benchmark']} {result['status']}: {result['error']}")
+    if result.get("wall_seconds", 0) > DAGRUN_TIMEOUT_SECONDS:
+        regressions.append(f"{result['benchmark']} takes {result['wall_seconds']}s, more than the dagrun_timeout")
+    previous = baseline.get((result["benchmark"], result.get("users")))
+    if previous is None or previous.get("status") != "ok" or result.get("status") != "ok":
+        return regressions
+    for measure in ("wall_seconds", "peak_rss_mb"):
+        if previous[measure] and result[measure] > previous[measure] * (1 + threshold):
+            regressions.append(f"{result['benchmark']} {measure} went from {previous[measure]} to {result[measure]}")
+    return regressions
+
+def _wait_result(name, process, result_queue, timeout=DAGRUN_TIMEOUT_SECONDS):
+    """
+    Waits for the result of a benchmark process, without hanging if the process dies
+    before sending it.
+
+    Args:
+        name (str): Name of the benchmark.
+        process (multiprocessing.Process): The benchmark process.
+        result_queue (multiprocessing.Queue): The queue the process sends its result to.
+        timeout (float, optional): Seconds after which the process is terminated.
+
+    Returns:
+        dict: The result sent by the process, or a result with the status 'crashed'
+            or 'timeout' and the 'error' that explains it.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return result_queue.get(timeout=RESULT_POLL_SECONDS)
+        except queue_module.Empty:
+            pass
+        if not process.is_alive():
+            try:
+                # The result may have been sent right before the process exited
+                return result_queue.get(timeout=1)
+            except queue_module.Empty:
+                exitcode = process.exitcode
+                reason = f"killed by signal {-exitcode}" if exitcode < 0 else f"exited with code {exitcode}"
+                if exitcode == -9:
+                    reason += " (out of memory?)"
+                logging.error(f"Benchmark {name} {reason} without a result")
+                return {"benchmark": name, "status": "crashed", "exitcode": exitcode, "error": reason}
+        if time.monotonic() > deadline:
+            process.terminate()
+            logging.error(f"Benchmark {name} did not finish in {timeout}s, terminated")
+            return {"benchmark": name, "status": "timeout", "error": f"did not finish in {timeout}s"}
+
+def run_benchmarks(data_dir, benchmarks, output, baseline=None, threshold=REGRESSION_THRESHOLD, repeat=1, trace_memory=False):
+    """
+    Runs the benchmarks, each one in a fresh process, and appends their results to the output file.
+
+    Args:
+        data_dir (str): Directory of the datasets (see generate_datasets.py).
+        benchmarks (list): Names of the benchmarks to run.
+        output (str): Path of the JSON lines file where the results are appended.
+        baseline (str, optional): Path of a previous results file to compare against.
+        threshold (float, optional): Relative growth of time or memory reported as a regression.
+        repeat (int, optional): Number of runs of each benchmark. The fastest is kept.
+        trace_memory (bool, optional): Whether to measure Python allocations with tracemalloc (slower).
+
+    Returns:
+        list: The regressions found, as messages.
+    """
+    with open(os.path.join(data_dir, "allowance_backend_table")) as backend_file:
+        users = sum(1 for _ in backend_file) - 1
+    previous = _load_baseline(baseline)
+    context = multiprocessing.get_context("spawn")
+    server = _serve(data_dir)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    regressions = []
+    try:
+        with open(output, "a") as output_file:
+            for name in benchmarks:
+                runs = []
+                for _ in range(repeat):
+                    with tempfile.TemporaryDirectory() as work_dir:
+                        result_queue = context.Queue()
+                        process = context.Process(target=_run_benchmark, args=(name, data_dir, base_url, work_dir, trace_memory, result_queue))
+                        process.start()
+                        runs.append(_wait_result(name, process, result_queue))
+                        process.join()
+                result = min(runs, key=lambda run: run.get("wall_seconds", float("inf")))
+                result.update(
+                    users=users,
+                    timestamp=datetime.utcnow().isoformat(),
+                    python=platform.python_version(),
+                    cpus=os.cpu_count(),
+                )
+                output_file.write(json.dumps(result) + "\n")
+                print(json.dumps(result))
+                regressions.extend(_compare(result, previous, threshold))
+    finally:
+        server.shutdown()
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data-dir", required=True)
+    parser.add_argument("--benchmarks", nargs="+", default=TASK_BENCHMARKS + CHECK_BENCHMARKS, choices=TASK_BENCHMARKS + CHECK_BENCHMARKS)
+    parser.add_argument("--output", help=f"Results file (JSON lines), defaults to {RESULTS_FILE_NAME} in the data directory")
+    parser.add_argument("--baseline", help="Results file to compare against (defaults to --output)")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--trace-memory", action="store_true")
+    args = parser.parse_args()
+    output = args.output or os.path.join(args.data_dir, RESULTS_FILE_NAME)
+
+    regressions = run_benchmarks(
+        args.data_dir,
+        args.benchmarks,
+        output,
+        baseline=args.baseline or output,
+        threshold=args.threshold,
+        repeat=args.repeat,
+        trace_memory=args.trace_memory,
+    )
+    for regression in regressions:
+        print(f"REGRESSION: {regression}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""
+This python file contains the column profiles computed on each source of the
+ETL-check-allowances DAG and the thresholds of their drift (tasks/profiling.py
+computes and compares them).
+
+Each table declares:
+    distinct: Columns whose number of distinct values is estimated (HyperLogLog).
+    frequencies: Low-cardinality columns whose value frequencies are counted.
+    quantiles: Numeric columns whose distribution is sketched (quantile sketch).
+
+A profile is compared with the profiles of the previous baseline_runs runs, merged.
+Each drift threshold declares:
+    row_count: Relative change of the number of rows.
+    distinct: Relative change of the estimated number of distinct values.
+    null_fraction: Absolute change of the fraction of null values of a column.
+    frequency_psi: Population stability index between the value frequencies.
+    quantile_ks: Kolmogorov-Smirnov distance between the distributions.
+"""
+
+profile_dict = {
+    "allowance_events": {
+        "distinct": ["user_id"],
+        "frequencies": ["event_name", "allowance_scheduled_frequency", "allowance_scheduled_day"],
+        "quantiles": ["allowance_amount"],
+    },
+    "allowance_backend": {
+        "distinct": ["uuid"],
+        "frequencies": ["frequency", "day", "status"],
+        "quantiles": ["next_payment_day"],
+    },
+    "payment_schedule_backend": {
+        "distinct": ["user_id"],
+        "frequencies": [],
+        "quantiles": ["payment_date"],
+    },
+}
+
+drift_config = {
+    "baseline_runs": 7,
+    "thresholds": {
+        "row_count": 0.2,
+        "distinct": 0.2,
+        "null_fraction": 0.05,
+        "frequency_psi": 0.2,
+        "quantile_ks": 0.1,
+    },
+}
@@ -0,0 +1,98 @@
+"""
+This python file contains the data quality rules checked on each backend table
+by the ETL-check-allowances DAG (tasks/rules.py evaluates them).
+
+Each rule declares:
+    name: Unique name of the rule.
+    column: Column checked by the rule, or '*' for every column of the table.
+    type: One of 'not_null', 'unique', 'range', 'isin' or 'parseable_timestamp'.
+    params: Parameters of the rule type ('min'/'max' for range, 'values' for isin).
+    severity: 'error' fails the task, 'warning' is only logged.
+    message: Description of the violation used in the error report.
+"""
+
+FREQUENCIES = ['daily', 'biweekly', 'weekly', 'monthly']
+
+DAYS = ['fifteenth_day', 'first_day', 'friday', 'monday', 'tuesday',
+        'thursday', 'saturday', 'sunday', 'daily', 'wednesday']
+
+rules_dict = {
+    "allowance_backend": [
+        {
+            "name": "allowance_backend_not_null",
+            "column": "*",
+            "type": "not_null",
+            "severity": "error",
+            "message": "null values",
+        },
+        {
+            "name": "allowance_backend_unique_uuid",
+            "column": "uuid",
+            "type": "unique",
+            "severity": "error",
+            "message": "duplicate values",
+        },
+        {
+            "name": "allowance_backend_next_payment_day_range",
+            "column": "next_payment_day",
+            "type": "range",
+            "params": {"min": 1, "max": 31},
+            "severity": "error",
+            "message": "invalid payment dates",
+        },
+        {
+            "name": "allowance_backend_frequency_allowed",
+            "column": "frequency",
+            "type": "isin",
+            "params": {"values": FREQUENCIES},
+            "severity": "error",
+            "message": "invalid frequencies",
+        },
+        {
+            "name": "allowance_backend_day_allowed",
+            "column": "day",
+            "type": "isin",
+            "params": {"values": DAYS},
+            "severity": "error",
+            "message": "invalid day",
+        },
+        {
+            "name": "allowance_backend_creation_date_parseable",
+            "column": "creation_date",
+            "type": "parseable_timestamp",
+            "severity": "error",
+            "message": "creation dates that can not be parsed",
+        },
+        {
+            "name": "allowance_backend_updated_at_parseable",
+            "column": "updated_at",
+            "type": "parseable_timestamp",
+            "severity": "error",
+            "message": "update timestamps that can not be parsed",
+        },
+    ],
+    "payment_schedule_backend": [
+        {
+            "name": "payment_schedule_backend_not_null",
+            "column": "*",
+            "type": "not_null",
+            "severity": "error",
+            "message": "null values",
+        },
+        {
+            "name": "payment_schedule_backend_unique_user_id",
+            "column": "user_id",
+            "type": "unique",
+            "severity": "error",
+            "message": "duplicate values",
+        },
+        {
+            "name": "payment_schedule_backend_payment_date_range",
+            "column": "payment_date",
+            "type": "range",
+            "params": {"min": 1, "max": 31},
+            "severity": "error",
+            "message": "invalid payment dates",
+        },
+    ],
+}
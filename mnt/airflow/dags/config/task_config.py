@@ -16,7 +16,11 @@ task_dict = {
         "kwargs": {
             "allowance_events": "https://gist.githubusercontent.com/DaniModak/d0cdc441bc2cab2abdc5b37e45ca5cb4/raw/13ded757082f09740a0ca351f926b74c336206ab/allowance_events",
             "allowance_backend": "https://gist.githubusercontent.com/DaniModak/d0cdc441bc2cab2abdc5b37e45ca5cb4/raw/13ded757082f09740a0ca351f926b74c336206ab/allowance_backend_table",
-            "payment_schedule_backend": "https://gist.githubusercontent.com/DaniModak/d0cdc441bc2cab2abdc5b37e45ca5cb4/raw/13ded757082f09740a0ca351f926b74c336206ab/payment_schedule_backend_table"
+            "payment_schedule_backend": "https://gist.githubusercontent.com/DaniModak/d0cdc441bc2cab2abdc5b37e45ca5cb4/raw/13ded757082f09740a0ca351f926b74c336206ab/payment_schedule_backend_table",
+            "incremental": False,
+            "n_shards": 1,
+            "replay": False,
+            "out_of_core": False,
         },
     },
     "look_allowance_backend": {
@@ -25,6 +29,7 @@ task_dict = {
         "function_name": "look_for_inconsistencies",
         "kwargs": {
             "allowance_backend": "https://gist.githubusercontent.com/DaniModak/d0cdc441bc2cab2abdc5b37e45ca5cb4/raw/13ded757082f09740a0ca351f926b74c336206ab/allowance_backend_table",
+            "next_payment_day_severity": "warning",
         },
     },
     "look_payment_schedule": {
@@ -35,4 +40,15 @@ task_dict = {
             "payment_schedule_backend": "https://gist.githubusercontent.com/DaniModak/d0cdc441bc2cab2abdc5b37e45ca5cb4/raw/13ded757082f09740a0ca351f926b74c336206ab/payment_schedule_backend_table"
         },
     },
+    "profile_sources": {
+        "depends_on": ["init_process_authentication"],
+        "module_path": "tasks.profile_sources",
+        "function_name": "profile_sources",
+        "kwargs": {
+            "allowance_events": "https://gist.githubusercontent.com/DaniModak/d0cdc441bc2cab2abdc5b37e45ca5cb4/raw/13ded757082f09740a0ca351f926b74c336206ab/allowance_events",
+            "allowance_backend": "https://gist.githubusercontent.com/DaniModak/d0cdc441bc2cab2abdc5b37e45ca5cb4/raw/13ded757082f09740a0ca351f926b74c336206ab/allowance_backend_table",
+            "payment_schedule_backend": "https://gist.githubusercontent.com/DaniModak/d0cdc441bc2cab2abdc5b37e45ca5cb4/raw/13ded757082f09740a0ca351f926b74c336206ab/payment_schedule_backend_table",
+            "drift_severity": "warning",
+        },
+    },
 }
\ No newline at end of file
@@ -0,0 +1,360 @@
+"""
+Re-validates a range of past days from their snapshots, without Airflow, e.g. after a
+backend bug was found.
+
+Every day is the scheduled run of that date: its sources are read from the Arrow
+snapshots the run left (see utils.get_snapshot_df), so nothing is fetched or parsed
+again. The days whose sources did not change share the same snapshot files; they are
+validated once and the result is written for each of them. A snapshot shared by
+several validations (a backend table that did not change for a week) is loaded once
+per worker process. The validations run in a process pool, with at most max_in_flight
+of them submitted at once, and the offending rows of every day are written to the
+violation sink under the run id of that day.
+
+Every day runs the checks of look_for_inconsistencies and the ones of
+look_allowance_backend, with the payment calendar as of the next day, when the
+scheduled run of that day started (see look_allowance_backend._run_date). The checks of
+look_payment_schedule and the drift of profile_sources are not backfilled.
+
+The snapshots of the scheduled runs are kept ALLOWANCES_BACKFILL_RETENTION_DAYS days
+(see utils._purge_old_snapshots): raise it to the longest range to backfill. A source
+URL may hold a {ds} placeholder, replaced by the date of each day; with
+--fetch-missing, the days without snapshots are fetched.
+
+Usage (from mnt/airflow/dags):
+    python -m tasks.backfill --start 2025-01-01 --end 2025-01-31 --max-workers 8
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import date, timedelta
+
+BACKFILL_TASK_ID = "backfill_look_for_inconsistencies"
+BACKFILL_BACKEND_TASK_ID = "backfill_look_allowance_backend"
+# Run id of the scheduled Airflow run of a date
+RUN_ID_TEMPLATE = os.environ.get("ALLOWANCES_BACKFILL_RUN_ID_TEMPLATE", "scheduled__{ds}T00:00:00+00:00")
+# Task argument, table and snapshot formats of each source, in the order of the checks
+BACKFILL_SOURCES = [
+    ("allowance_events", "allowance_events", {True: ["json"], False: ["json_latest", "json"]}),
+    ("allowance_backend", "allowance_backend", {True: ["allowance_backend"], False: ["allowance_backend"]}),
+    ("payment_schedule_backend", "payment_schedule_backend", {True: ["payment_schedule_backend"], False: ["payment_schedule_backend"]}),
+]
+
+# Snapshots used by several validations, kept by each worker process once loaded (see _init_worker)
+_shared_paths = frozenset()
+_shared_snapshots = {}
+
+def backfill_days(start, end, run_id_template=RUN_ID_TEMPLATE):
+    """
+    Lists the days of a range with the run id of each.
+
+    Args:
+        start (str): First day (YYYY-MM-DD).
+        end (str): Last day (YYYY-MM-DD), included.
+        run_id_template (str, optional): Run id of a day, with a {ds} placeholder.
+
+    Returns:
+        list: (ds, run_id) tuples, from start to end.
+
+    Raises:
+        ValueError: If a date is invalid or end is before start.
+    """
+    first, last = date.fromisoformat(start), date.fromisoformat(end)
+    if last < first:
+        raise ValueError(f"The backfill ends ({end}) before it starts ({start})")
+    days = [(first + timedelta(days=offset)).isoformat() for offset in range((last - first).days + 1)]
+    return [(ds, run_id_template.replace("{ds}", ds)) for ds in days]
+
+def _day_url(url, ds):
+    return url.replace("{ds}", ds)
+
+def resolve_snapshots(sources, ds, run_id, replay=False, snapshot_dir=None):
+    """
+    Finds the snapshots left by the run of a day, from the manifests of the run.
+
+    Args:
+        sources (dict): The URL of each task argument of BACKFILL_SOURCES.
+        ds (str): The day (YYYY-MM-DD), replacing the {ds} placeholder of the URLs.
+        run_id (str): The run id of the day.
+        replay (bool, optional): The events are needed in full ('json' snapshots), not only the latest of each user.
+        snapshot_dir (str, optional): Directory of the snapshots. Defaults to utils.SNAPSHOT_DIR.
+
+    Returns:
+        dict: The snapshot path of each table, None for the tables without snapshot.
+    """
+    from . import utils
+
+    snapshot_dir = snapshot_dir or utils.SNAPSHOT_DIR
+    paths = {}
+    for argument, table_name, source_formats in BACKFILL_SOURCES:
+        paths[table_name] = None
+        for source_format in source_formats[replay]:
+            manifest = utils._read_json(os.path.join(snapshot_dir, f"{utils._snapshot_key(_day_url(sources[argument], ds), source_format, run_id)}.json"))
+            if manifest and os.path.exists(manifest["snapshot_path"]):
+                paths[table_name] = manifest["snapshot_path"]
+                break
+    return paths
+
+def _init_worker(shared_paths):
+    """
+    Sets the snapshots a worker process keeps once loaded.
+
+    Args:
+        shared_paths (frozenset): Paths of the snapshots used by several validations.
+    """
+    global _shared_paths
+    _shared_paths = shared_paths
+    _shared_snapshots.clear()
+
+def _read_day_snapshot(path):
+    """
+    Reads a snapshot, from the frames of the worker when it is shared by several validations.
+
+    Args:
+        path (str): Path of the snapshot.
+
+    Returns:
+        pd.DataFrame: The snapshot data. The checks do not modify it.
+    """
+    from . import utils
+
+    df = _shared_snapshots.get(path)
+    if df is None:
+        df = utils._read_snapshot(path)
+        if path in _shared_paths:
+            _shared_snapshots[path] = df
+    return df
+
+def _validate_days(days, paths, fetch_sources, replay, task_id, sample_size, base_dir,
+                   backend_task_id=BACKFILL_BACKEND_TASK_ID, next_payment_day_severity="warning"):
+    """
+    Runs the cross-table checks of look_for_inconsistencies and the checks of
+    look_allowance_backend on the snapshots of one or more days and writes the
+    offending rows of each day to the violation sink.
+
+    The payment calendar check depends on the date, so it runs for each day, as of the
+    end of its data interval; the other checks run once for all the days.
+
+    Args:
+        days (list): (ds, run_id) tuples of the days sharing these snapshots.
+        paths (dict): The snapshot path of each table, or None to fetch the sources.
+        fetch_sources (list): (url, source_format) tuples of the sources of the day, when paths is None.
+        replay (bool): Check the backend against the state replayed from all the events.
+        task_id (str): Task id of the reports in the sink.
+        sample_size (int): Number of offending rows per check kept in the reports.
+        base_dir (str): Directory of the Parquet files of the sink.
+        backend_task_id (str, optional): Task id of the reports of the look_allowance_backend checks.
+        next_payment_day_severity (str, optional): Severity of the payment calendar check.
+
+    Returns:
+        list: The outcome of each day (see run_backfill).
+    """
+    from . import look_allowance_backend
+    from . import sharding
+    from . import utils
+    from . import violations
+
+    wall_start = time.perf_counter()
+    try:
+        if paths is None:
+            tables = utils.get_snapshot_dfs(fetch_sources, run_id=days[0][1])
+        else:
+            tables = [_read_day_snapshot(paths[table_name]) for _, table_name, _ in BACKFILL_SOURCES]
+        found = sharding._check_shard(*tables, replay=replay)
+        allowance_backend_df = tables[[table_name for _, table_name, _ in BACKFILL_SOURCES].index("allowance_backend")]
+        backend_found = look_allowance_backend._check_values_allowance_backend(allowance_backend_df)
+    except Exception as e:
+        logging.error(f"Backfill of {', '.join(ds for ds, _ in days)} failed: {e}")
+        return [_day_outcome(ds, run_id, "failed", wall_start, error=str(e)) for ds, run_id in days]
+
+    outcomes = []
+    for ds, run_id in days:
+        as_of = (date.fromisoformat(ds) + timedelta(days=1)).isoformat()
+        day_backend_found = backend_found + look_allowance_backend._check_values_next_payment_day(allowance_backend_df, as_of, next_payment_day_severity)
+        reports = [
+            violations.build_report(found, run_id, task_id, sample_size=sample_size, base_dir=base_dir),
+            violations.build_report(day_backend_found, run_id, backend_task_id, sample_size=sample_size, base_dir=base_dir),
+        ]
+        errors = [violation for report in reports for violation in report["violations"] if violation["severity"] != "warning"]
+        outcomes.append(_day_outcome(ds, run_id, "violations" if errors else "success", wall_start, reports=reports, shared_days=len(days)))
+    return outcomes
+
+def _day_outcome(ds, run_id, status, wall_start, error=None, reports=(), shared_days=1):
+    """
+    Builds the outcome of a day.
+
+    Args:
+        ds (str): The day.
+        run_id (str): Its run id.
+        status (str): 'success', 'violations', 'missing' or 'failed'.
+        wall_start (float): perf_counter value when its validation started.
+        error (str, optional): Why the day could not be validated.
+        reports (list, optional): Its reports, one per task (see violations.build_report).
+        shared_days (int, optional): Number of days validated with the same snapshots.
+
+    Returns:
+        dict: The outcome, with the keys 'ds', 'run_id', 'status', 'error',
+            'total_violations', 'counts' (offending rows by rule), 'paths' (where
+            the rows of each rule are), 'shared_days' and 'wall_seconds'.
+    """
+    report_violations = [violation for report in reports for violation in report["violations"]]
+    return {
+        "ds": ds,
+        "run_id": run_id,
+        "status": status,
+        "error": error,
+        "total_violations": sum(report["total_violations"] for report in reports),
+        "counts": {violation["rule"]: violation["count"] for violation in report_violations},
+        "paths": {violation["rule"]: violation["path"] for violation in report_violations},
+        "shared_days": shared_days,
+        "wall_seconds": round(time.perf_counter() - wall_start, 4),
+    }
+
+def run_backfill(sources, days, replay=False, snapshot_dir=None, max_workers=None, max_in_flight=None, fetch_missing=False,
+                 task_id=BACKFILL_TASK_ID, sample_size=None, base_dir=None, backend_task_id=BACKFILL_BACKEND_TASK_ID,
+                 next_payment_day_severity="warning"):
+    """
+    Validates the snapshots of a range of days in a process pool.
+
+    Args:
+        sources (dict): The URL of each task argument of BACKFILL_SOURCES, optionally with a {ds} placeholder.
+        days (list): (ds, run_id) tuples (see backfill_days).
+        replay (bool, optional): Check the backend against the state replayed from all the events (see replay.py).
+        snapshot_dir (str, optional): Directory of the snapshots. Defaults to utils.SNAPSHOT_DIR.
+        max_workers (int, optional): Number of processes. Defaults to the number of CPUs.
+        max_in_flight (int, optional): Number of validations submitted at once. Defaults to twice max_workers.
+        fetch_missing (bool, optional): Fetch the sources of the days without snapshots instead of skipping them.
+        task_id (str, optional): Task id of the reports in the sink, so the reports of the runs are kept.
+        sample_size (int, optional): Number of offending rows per check kept in the reports.
+        base_dir (str, optional): Directory of the Parquet files of the sink.
+        backend_task_id (str, optional): Task id of the reports of the look_allowance_backend checks.
+        next_payment_day_severity (str, optional): Severity of the payment calendar check.
+
+    Returns:
+        dict: The backfill summary, with the keys 'task_id', 'days', 'validations',
+            'wall_seconds' and 'outcomes' (outcome of each day, in date order).
+
+    Raises:
+        ValueError: If a source URL is missing.
+    """
+    from . import utils
+    from . import violations
+
+    missing_sources = [argument for argument, _, _ in BACKFILL_SOURCES if not sources.get(argument)]
+    if missing_sources:
+        raise ValueError(f"The sources {missing_sources} must be provided")
+    snapshot_dir = snapshot_dir or utils.SNAPSHOT_DIR
+    max_workers = max_workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or 2 * max_workers
+    sample_size = sample_size or violations.VIOLATION_SAMPLE_SIZE
+    base_dir = base_dir or violations.VIOLATIONS_DIR
+    wall_start = time.perf_counter()
+
+    # Days validated together because they have the same snapshots, or fetched one by one
+    groups = {}
+    outcomes = []
+    for ds, run_id in days:
+        paths = resolve_snapshots(sources, ds, run_id, replay, snapshot_dir)
+        absent = [table_name for table_name, path in paths.items() if path is None]
+        if not absent:
+            groups.setdefault(tuple(paths.values()), []).append((ds, run_id))
+        elif fetch_missing:
+            groups[("fetch", ds)] = [(ds, run_id)]
+        else:
+            logging.warning(f"No snapshot of {absent} for {ds} (run {run_id}), the day is skipped")
+            outcomes.append(_day_outcome(ds, run_id, "missing", time.perf_counter(), error=f"No snapshot of {absent}"))
+
+    usage = {}
+    for key in groups:
+        if key[0] != "fetch":
+            for path in set(key):
+                usage[path] = usage.get(path, 0) + 1
+    shared_paths = frozenset(path for path, count in usage.items() if count > 1)
+    logging.info(f"Backfilling {len(days)} days: {len(groups)} validations, {len(shared_paths)} shared snapshots, "
+                 f"{max_workers} processes")
+
+    pending = list(groups.items())
+    running = {}
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(shared_paths,)) as pool:
+        while pending or running:
+            while pending and len(running) < max_in_flight:
+                key, group_days = pending.pop(0)
+                if key[0] == "fetch":
+                    ds = key[1]
+                    paths = None
+                    fetch_sources = [(_day_url(sources[argument], ds), source_formats[replay][0]) for argument, _, source_formats in BACKFILL_SOURCES]
+                else:
+                    paths = dict(zip([table_name for _, table_name, _ in BACKFILL_SOURCES], key))
+                    fetch_sources = None
+                future = pool.submit(_validate_days, group_days, paths, fetch_sources, replay, task_id, sample_size, base_dir,
+                                     backend_task_id, next_payment_day_severity)
+                running[future] = (group_days, time.perf_counter())
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                group_days, submitted = running.pop(future)
+                try:
+                    group_outcomes = future.result()
+                except Exception as e:
+                    logging.error(f"Backfill of {', '.join(ds for ds, _ in group_days)} failed: {e}")
+                    group_outcomes = [_day_outcome(ds, run_id, "failed", submitted, error=str(e)) for ds, run_id in group_days]
+                for outcome in group_outcomes:
+                    logging.info(f"Day {outcome['ds']} {outcome['status']}: {outcome['total_violations']} offending rows "
+                                 f"in {outcome['wall_seconds']}s")
+                outcomes.extend(group_outcomes)
+
+    return {
+        "task_id": task_id,
+        "days": len(days),
+        "validations": len(groups),
+        "wall_seconds": round(time.perf_counter() - wall_start, 4),
+        "outcomes": sorted(outcomes, key=lambda outcome: outcome["ds"]),
+    }
+
+def main(argv=None):
+    """
+    Command line entry point. Exits with status 1 when a day was not validated or has violations with 'error' severity.
+    """
+    from .runner import _parse_overrides
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--start", required=True, help="First day (YYYY-MM-DD)")
+    parser.add_argument("--end", required=True, help="Last day (YYYY-MM-DD), included")
+    parser.add_argument("--run-id-template", default=RUN_ID_TEMPLATE, help="Run id of a day, with a {ds} placeholder")
+    parser.add_argument("--max-workers", type=int)
+    parser.add_argument("--max-in-flight", type=int, help="Number of validations submitted at once")
+    parser.add_argument("--fetch-missing", action="store_true", help="Fetch the sources of the days without snapshots")
+    parser.add_argument("--set", dest="overrides", action="append", metavar="NAME=VALUE",
+                        help="Replace a kwarg of look_for_inconsistencies (repeatable)")
+    parser.add_argument("--output", help="Write the backfill summary to this JSON file")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(processName)s %(message)s")
+
+    from config.task_config import task_dict
+
+    kwargs = dict(task_dict["look_for_inconsistencies"]["kwargs"], **_parse_overrides(args.overrides))
+    summary = run_backfill(
+        kwargs,
+        backfill_days(args.start, args.end, args.run_id_template),
+        replay=kwargs.get("replay", False),
+        max_workers=args.max_workers,
+        max_in_flight=args.max_in_flight,
+        fetch_missing=args.fetch_missing,
+        sample_size=kwargs.get("violation_sample_size"),
+        next_payment_day_severity=task_dict["look_allowance_backend"]["kwargs"].get("next_payment_day_severity", "warning"),
+    )
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(summary, output_file, indent=2, default=str)
+
+    for outcome in summary["outcomes"]:
+        print(f"{outcome['ds']:<12} {outcome['status']:<12} {outcome['total_violations']:>10} {outcome['wall_seconds']:>9.3f}s")
+    print(f"{'wall time':<12} {summary['days']} days, {summary['validations']} validations {summary['wall_seconds']:>9.3f}s")
+    return 1 if any(outcome["status"] != "success" for outcome in summary["outcomes"]) else 0
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    sys.exit(main())
@@ -0,0 +1,286 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DOWNLOAD_DIR = os.environ.get(
+    "ALLOWANCES_DOWNLOAD_DIR",
+    os.path.join(tempfile.gettempdir(), "allowances_downloads"),
+)
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+REQUEST_TIMEOUT = (10, 60)
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5
+POOL_SIZE = 10
+# Sources exported from Postgres with COPY instead of downloaded (see postgres.py)
+POSTGRES_SCHEMES = ("postgres", "postgresql")
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """
+    Returns the HTTP session shared by every download of the process.
+
+    The session keeps a pool of connections per host and retries failed
+    requests with exponential backoff.
+
+    Returns:
+        requests.Session: The shared session.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=MAX_RETRIES,
+                backoff_factor=BACKOFF_FACTOR,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["HEAD", "GET"],
+            )
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+    return _session
+
+@contextmanager
+def file_lock(lock_path):
+    """
+    Holds an exclusive lock on the given path, so that concurrent tasks on the
+    same worker wait for each other instead of writing the same files.
+
+    Args:
+        lock_path (str): Path of the lock file.
+    """
+    with open(lock_path, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _read_metadata(metadata_path):
+    """
+    Reads the metadata of a download.
+
+    Args:
+        metadata_path (str): Path of the metadata file.
+
+    Returns:
+        dict: The metadata, or an empty dict if the file does not exist or is corrupted.
+    """
+    try:
+        with open(metadata_path) as metadata_file:
+            return json.load(metadata_file)
+    except (OSError, ValueError):
+        return {}
+
+def _write_metadata(metadata_path, metadata):
+    """
+    Writes the metadata of a download through a temporary file.
+
+    Args:
+        metadata_path (str): Path of the metadata file.
+        metadata (dict): The metadata.
+    """
+    tmp_path = f"{metadata_path}.tmp"
+    with open(tmp_path, "w") as metadata_file:
+        json.dump(metadata, metadata_file)
+    os.replace(tmp_path, metadata_path)
+
+def _file_sha256(path):
+    """
+    Computes the SHA-256 of a file, reading it in chunks.
+
+    Args:
+        path (str): Path of the file.
+
+    Returns:
+        hashlib._Hash: The running hash of the content of the file.
+    """
+    content_hash = hashlib.sha256()
+    with open(path, "rb") as content_file:
+        for chunk in iter(lambda: content_file.read(DOWNLOAD_CHUNK_SIZE), b""):
+            content_hash.update(chunk)
+    return content_hash
+
+def _build_headers(metadata, complete, part_size):
+    """
+    Builds the conditional and range headers of a download.
+
+    Args:
+        metadata (dict): The metadata of the previous download of the URL.
+        complete (bool): Whether a complete copy of the URL is on disk.
+        part_size (int): Size of the partial download on disk, in bytes.
+
+    Returns:
+        dict: The request headers.
+    """
+    headers = {"Accept-Encoding": "identity"}
+    validator = metadata.get("etag") or metadata.get("last_modified")
+    if complete:
+        if metadata.get("etag"):
+            headers["If-None-Match"] = metadata["etag"]
+        if metadata.get("last_modified"):
+            headers["If-Modified-Since"] = metadata["last_modified"]
+    elif part_size and validator:
+        headers["Range"] = f"bytes={part_size}-"
+        headers["If-Range"] = validator
+    return headers
+
+def download_source(url, download_dir=DOWNLOAD_DIR):
+    """
+    Downloads a URL to disk, streaming the body in chunks.
+
+    If a complete copy of the URL is already on disk, the request is conditional
+    (If-None-Match/If-Modified-Since) and an unchanged source is not downloaded
+    again. If a previous download was interrupted, it is resumed with a Range
+    request, as long as the server still serves the same version of the source.
+    The SHA-256 of the body is computed while it is streamed, so the content of
+    the source can be identified without reading it again (see memo.py).
+    A postgres:// URL is exported with COPY instead (see postgres.py).
+
+    Args:
+        url (str): The URL to download.
+        download_dir (str, optional): Directory where the downloads are stored.
+
+    Returns:
+        dict: The download, with the keys 'url', 'path', 'etag', 'last_modified',
+            'size', 'sha256' and 'status' ('downloaded', 'resumed' or 'not_modified').
+
+    Raises:
+        requests.RequestException: If there is an issue with the GET request.
+    """
+    os.makedirs(download_dir, exist_ok=True)
+    name = hashlib.sha256(url.encode("utf-8")).hexdigest()[:32]
+    path = os.path.join(download_dir, name)
+    with file_lock(f"{path}.lock"):
+        if urlsplit(url).scheme in POSTGRES_SCHEMES:
+            return _copy_table(url, path)
+        return _download(url, path)
+
+def _copy_table(url, path):
+    """
+    Exports a Postgres table to the given path as CSV. See download_source.
+
+    A table has no ETag: the SHA-256 of the export stands for it, so when the table
+    did not change since the previous run the download is reported as 'not_modified'
+    and the snapshot of that run is reused without parsing (see utils.get_snapshot_df).
+
+    Args:
+        url (str): The postgres:// source URL.
+        path (str): Destination path of the CSV.
+
+    Returns:
+        dict: The download (see download_source).
+    """
+    from . import postgres
+
+    part_path = f"{path}.part"
+    metadata_path = f"{path}.json"
+    metadata = _read_metadata(metadata_path)
+    with open(part_path, "wb") as part_file:
+        content_hash = postgres.copy_table_to(url, part_file)
+    sha256 = content_hash.hexdigest()
+    unchanged = metadata.get("complete", False) and metadata.get("sha256") == sha256 and os.path.exists(path)
+
+    os.replace(part_path, path)
+    metadata = {"etag": f'"{sha256}"', "last_modified": "", "complete": True, "size": os.path.getsize(path), "sha256": sha256}
+    _write_metadata(metadata_path, metadata)
+    status = "not_modified" if unchanged else "downloaded"
+    if unchanged:
+        logging.info(f"{postgres.redact(url)} did not change since the previous export")
+    else:
+        logging.info(f"{postgres.redact(url)} exported to {path} ({metadata['size']} bytes)")
+    return dict(metadata, url=url, path=path, status=status)
+
+def _download(url, path):
+    """
+    Downloads a URL to the given path. See download_source.
+
+    Args:
+        url (str): The URL to download.
+        path (str): Destination path of the body.
+
+    Returns:
+        dict: The download (see download_source).
+    """
+    part_path = f"{path}.part"
+    metadata_path = f"{path}.json"
+    metadata = _read_metadata(metadata_path)
+    complete = metadata.get("complete", False) and os.path.exists(path)
+    part_size = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = _build_headers(metadata, complete, part_size)
+
+    try:
+        response = get_session().get(url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT)
+        if response.status_code == 416:
+            logging.warning(f"Partial download of {url} can not be resumed, restarting it")
+            response.close()
+            os.remove(part_path)
+            return _download(url, path)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        logging.error(f"Failed to fetch data: {e}")
+        raise
+
+    with response:
+        if response.status_code == 304:
+            logging.info(f"{url} not modified since the previous download")
+            if not metadata.get("sha256"):
+                metadata["sha256"] = _file_sha256(path).hexdigest()
+                _write_metadata(metadata_path, metadata)
+            return dict(metadata, url=url, path=path, status="not_modified")
+
+        resumed = response.status_code == 206
+        if not resumed:
+            metadata = {
+                "etag": response.headers.get("ETag", ""),
+                "last_modified": response.headers.get("Last-Modified", ""),
+            }
+        metadata["complete"] = False
+        _write_metadata(metadata_path, metadata)
+
+        content_hash = _file_sha256(part_path) if resumed else hashlib.sha256()
+        with open(part_path, "ab" if resumed else "wb") as part_file:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                part_file.write(chunk)
+                content_hash.update(chunk)
+
+    os.replace(part_path, path)
+    metadata.update(complete=True, size=os.path.getsize(path), sha256=content_hash.hexdigest())
+    _write_metadata(metadata_path, metadata)
+    status = "resumed" if resumed else "downloaded"
+    logging.info(f"{url} {status} to {path} ({metadata['size']} bytes)")
+    return dict(metadata, url=url, path=path, status=status)
+
+def download_sources(urls, download_dir=DOWNLOAD_DIR, max_workers=POOL_SIZE):
+    """
+    Downloads several URLs concurrently over the shared session.
+
+    Args:
+        urls (list): The URLs to download.
+        download_dir (str, optional): Directory where the downloads are stored.
+        max_workers (int, optional): Maximum number of concurrent downloads.
+
+    Returns:
+        dict: The downloads (see download_source) by URL.
+
+    Raises:
+        requests.RequestException: If any of the downloads fails.
+    """
+    unique_urls = list(dict.fromkeys(urls))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        downloads = executor.map(lambda url: download_source(url, download_dir), unique_urls)
+        return dict(zip(unique_urls, downloads))
@@ -0,0 +1,294 @@
+"""
+Persisted state used by the incremental mode of look_for_inconsistencies.
+
+The state is a local SQLite database holding the latest event of each user,
+a hash of each backend row, the users that were inconsistent in the last
+run and the watermark (latest event timestamp already processed). With it,
+a run only merges the events that arrived since the watermark and only
+re-validates the users whose events or backend rows changed.
+
+The state also keeps where the previous run stopped reading the events payload
+(see utils.fetch_new_events), so a run only downloads and decodes the appended
+events, and the snapshot of each backend table whose rows were hashed, so an
+unchanged table is not hashed again.
+"""
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+STATE_DIR = os.environ.get(
+    "ALLOWANCES_STATE_DIR",
+    os.path.join(tempfile.gettempdir(), "allowances_state"),
+)
+STATE_FILE_NAME = "look_for_inconsistencies.sqlite"
+EPOCH = datetime(1970, 1, 1)
+
+LATEST_EVENT_COLUMNS = [
+    "user_id",
+    "event_timestamp",
+    "event_name",
+    "allowance_scheduled_frequency",
+    "allowance_scheduled_day",
+    "allowance_amount",
+]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS latest_events (
+    user_id TEXT PRIMARY KEY,
+    sort_key INTEGER NOT NULL,
+    event_timestamp TEXT,
+    event_name TEXT,
+    allowance_scheduled_frequency TEXT,
+    allowance_scheduled_day TEXT,
+    allowance_amount REAL
+);
+CREATE TABLE IF NOT EXISTS row_hashes (
+    table_name TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    row_hash INTEGER NOT NULL,
+    PRIMARY KEY (table_name, user_id)
+);
+CREATE TABLE IF NOT EXISTS open_violations (
+    user_id TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+def open_state(state_dir=STATE_DIR):
+    """
+    Opens (and creates, if needed) the incremental state database.
+
+    Args:
+        state_dir (str, optional): Directory holding the state database.
+
+    Returns:
+        sqlite3.Connection: Connection to the state database.
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    connection = sqlite3.connect(os.path.join(state_dir, STATE_FILE_NAME))
+    connection.executescript(_SCHEMA)
+    return connection
+
+def get_watermark(connection):
+    """
+    Returns the latest event timestamp processed by a previous run.
+
+    Args:
+        connection (sqlite3.Connection): Connection to the state database.
+
+    Returns:
+        datetime: The watermark, or None if no run was processed yet.
+    """
+    row = connection.execute("SELECT value FROM metadata WHERE key = 'watermark'").fetchone()
+    if row is None:
+        return None
+    return EPOCH + timedelta(seconds=int(row[0]))
+
+def set_watermark(connection, watermark, run_id):
+    """
+    Stores the latest event timestamp processed and the run that processed it. The
+    watermark never goes back: the events appended to the payload may be older than
+    the ones already processed.
+
+    Args:
+        connection (sqlite3.Connection): Connection to the state database.
+        watermark (int): Latest processed event timestamp, in epoch seconds.
+        run_id (str): The Airflow run id.
+    """
+    row = connection.execute("SELECT value FROM metadata WHERE key = 'watermark'").fetchone()
+    if row is not None:
+        watermark = max(int(watermark), int(row[0]))
+    connection.executemany(
+        "INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)",
+        [("watermark", str(int(watermark))), ("run_id", str(run_id))],
+    )
+
+def get_events_resume(connection):
+    """
+    Returns where the previous run stopped reading the events payload.
+
+    Args:
+        connection (sqlite3.Connection): Connection to the state database.
+
+    Returns:
+        dict: The resume point (see utils.fetch_new_events), or None.
+    """
+    row = connection.execute("SELECT value FROM metadata WHERE key = 'events_resume'").fetchone()
+    return json.loads(row[0]) if row else None
+
+def set_events_resume(connection, resume):
+    """
+    Stores where this run stopped reading the events payload.
+
+    Args:
+        connection (sqlite3.Connection): Connection to the state database.
+        resume (dict): The resume point (see utils.fetch_new_events), or None to read the whole payload next time.
+    """
+    if resume is None:
+        connection.execute("DELETE FROM metadata WHERE key = 'events_resume'")
+    else:
+        connection.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('events_resume', ?)", (json.dumps(resume),))
+
+def _event_epoch(timestamps):
+    """
+    Converts event timestamps to epoch seconds.
+
+    Args:
+        timestamps (pd.Series): Event timestamps, e.g. '2024-09-21 1:39:34'.
+
+    Returns:
+        pd.Series: The timestamps in epoch seconds, 0 when they can not be parsed.
+    """
+    from . import timestamps as timestamp_formats
+
+    epoch_ns, _ = timestamp_formats.normalize_timestamps(timestamps, timestamp_formats.EVENT_TIMEZONE)
+    return (epoch_ns // 10 ** 9).fillna(0).astype('int64')
+
+def merge_latest_events(connection, events_df):
+    """
+    Merges the new events into the persisted latest-event-per-user state.
+
+    Args:
+        connection (sqlite3.Connection): Connection to the state database.
+        events_df (pd.DataFrame): The latest new event of each user.
+
+    Returns:
+        tuple: The user ids whose latest event changed (set) and the greatest
+            event timestamp merged, in epoch seconds (int or None).
+    """
+    if events_df.empty:
+        return set(), None
+
+    events_df = events_df[LATEST_EVENT_COLUMNS].copy()
+    events_df.insert(1, "sort_key", _event_epoch(events_df["event_timestamp"]))
+    connection.executemany(
+        """
+        INSERT INTO latest_events VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET
+            sort_key = excluded.sort_key,
+            event_timestamp = excluded.event_timestamp,
+            event_name = excluded.event_name,
+            allowance_scheduled_frequency = excluded.allowance_scheduled_frequency,
+            allowance_scheduled_day = excluded.allowance_scheduled_day,
+            allowance_amount = excluded.allowance_amount
+        WHERE excluded.sort_key >= latest_events.sort_key
+        """,
+        events_df.astype(object).where(events_df.notna(), None).itertuples(index=False, name=None),
+    )
+    return set(events_df["user_id"]), int(events_df["sort_key"].max())
+
+def update_row_hashes(connection, table_name, df, key_column, version=None):
+    """
+    Stores a hash of the rows of each user and returns the users whose rows changed.
+
+    Users with several rows (e.g. duplicates in payment_schedule_backend) get a
+    combined hash, so adding or removing one of their rows is also a change.
+
+    Args:
+        connection (sqlite3.Connection): Connection to the state database.
+        table_name (str): Name of the backend table.
+        df (pd.DataFrame): The full backend table of the current run.
+        key_column (str): Column holding the user id.
+        version (str, optional): Identifies the content of the table (see utils.snapshot_version).
+            When the rows of the same version were hashed by the previous run, they are not hashed again.
+
+    Returns:
+        set: The user ids whose rows are new or changed since the previous run.
+    """
+    from . import keys
+
+    version_key = f"row_hashes_version:{table_name}"
+    if version is not None:
+        row = connection.execute("SELECT value FROM metadata WHERE key = ?", (version_key,)).fetchone()
+        if row is not None and row[0] == version:
+            logging.info(f"The '{table_name}' table did not change since the previous run, its rows are not hashed")
+            return set()
+
+    row_hashes = pd.util.hash_pandas_object(keys.drop_keys(df), index=False).astype('int64')
+    current = row_hashes.groupby(df[key_column].to_numpy()).sum()
+    previous = pd.read_sql_query(
+        "SELECT user_id, row_hash FROM row_hashes WHERE table_name = ?",
+        connection,
+        params=(table_name,),
+        index_col="user_id",
+    )["row_hash"]
+
+    aligned_previous = previous.reindex(current.index)
+    changed = current[aligned_previous.isna() | (aligned_previous != current)]
+    removed = previous.index.difference(current.index)
+
+    connection.executemany(
+        "INSERT OR REPLACE INTO row_hashes (table_name, user_id, row_hash) VALUES (?, ?, ?)",
+        ((table_name, user_id, int(row_hash)) for user_id, row_hash in changed.items()),
+    )
+    connection.executemany(
+        "DELETE FROM row_hashes WHERE table_name = ? AND user_id = ?",
+        ((table_name, user_id) for user_id in removed),
+    )
+    if version is None:
+        connection.execute("DELETE FROM metadata WHERE key = ?", (version_key,))
+    else:
+        connection.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)", (version_key, version))
+    return set(changed.index)
+
+def get_latest_events(connection, user_ids):
+    """
+    Reads the latest event of the given users from the state.
+
+    Args:
+        connection (sqlite3.Connection): Connection to the state database.
+        user_ids (set): The user ids to read.
+
+    Returns:
+        pd.DataFrame: The latest event of each user, with the allowance_events columns.
+    """
+    connection.execute("CREATE TEMP TABLE IF NOT EXISTS selected_users (user_id TEXT PRIMARY KEY)")
+    connection.execute("DELETE FROM selected_users")
+    connection.executemany("INSERT INTO selected_users VALUES (?)", ((user_id,) for user_id in user_ids))
+    return pd.read_sql_query(
+        f"""
+        SELECT {', '.join(LATEST_EVENT_COLUMNS)}
+        FROM latest_events
+        JOIN selected_users USING (user_id)
+        """,
+        connection,
+    )
+
+def get_open_violations(connection):
+    """
+    Returns the users found inconsistent by the previous run.
+
+    Args:
+        connection (sqlite3.Connection): Connection to the state database.
+
+    Returns:
+        set: The user ids with open inconsistencies.
+    """
+    return {row[0] for row in connection.execute("SELECT user_id FROM open_violations")}
+
+def set_open_violations(connection, validated_users, inconsistent_users):
+    """
+    Updates the open inconsistencies with the result of the users validated in this run.
+
+    Args:
+        connection (sqlite3.Connection): Connection to the state database.
+        validated_users (set): The user ids validated in this run.
+        inconsistent_users (set): The validated user ids found inconsistent.
+    """
+    connection.executemany(
+        "DELETE FROM open_violations WHERE user_id = ?",
+        ((user_id,) for user_id in validated_users - inconsistent_users),
+    )
+    connection.executemany(
+        "INSERT OR IGNORE INTO open_violations VALUES (?)",
+        ((user_id,) for user_id in inconsistent_users),
+    )
+    logging.info(f"{len(inconsistent_users)} of {len(validated_users)} validated users are inconsistent")
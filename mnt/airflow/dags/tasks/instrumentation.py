@@ -0,0 +1,354 @@
+import contextvars
+import functools
+import logging
+import os
+import re
+import resource
+import socket
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+
+STATSD_HOST = os.environ.get("ALLOWANCES_STATSD_HOST", "localhost")
+STATSD_PORT = int(os.environ.get("ALLOWANCES_STATSD_PORT", "8125"))
+STATSD_PREFIX = os.environ.get("ALLOWANCES_STATSD_PREFIX", "allowances")
+METRICS_TEXTFILE_DIR = os.environ.get("ALLOWANCES_METRICS_TEXTFILE_DIR", "")
+TRACE_MEMORY = os.environ.get("ALLOWANCES_TRACE_MEMORY", "0") == "1"
+
+_recorder = contextvars.ContextVar("allowances_metrics_recorder", default=None)
+_memory_lock = threading.Lock()
+_active_peaks = []
+
+class _Recorder:
+    """
+    Collects the stage records of a task. Stages may run in several threads.
+    """
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.records = []
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record)
+
+class _MemoryPeak:
+    """
+    Peak of Python allocations of a running stage, in bytes.
+    """
+
+    def __init__(self):
+        self.value = 0
+
+def _safe_name(name):
+    """
+    Converts a task or stage name into a metric name component.
+
+    Args:
+        name (str): The name to convert.
+
+    Returns:
+        str: The name with every character outside [A-Za-z0-9_] replaced by '_'.
+    """
+    return re.sub(r"[^A-Za-z0-9_]", "_", str(name))
+
+def _peak_rss_mb():
+    """
+    Returns the peak resident set size of the process, in MB.
+    """
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2)
+
+def _start_memory_peak():
+    """
+    Starts measuring the peak of Python allocations of a stage.
+
+    tracemalloc only keeps one peak per process, so before resetting it the
+    current peak is carried into the stages still running. tracemalloc.reset_peak
+    only exists from Python 3.9: before that the peak is not reset, and the peak
+    of a stage is the one of the task since tracing started.
+
+    Returns:
+        _MemoryPeak: The peak of the stage, updated by _stop_memory_peak.
+    """
+    holder = _MemoryPeak()
+    with _memory_lock:
+        peak = tracemalloc.get_traced_memory()[1]
+        for active in _active_peaks:
+            active.value = max(active.value, peak)
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        _active_peaks.append(holder)
+    return holder
+
+def _stop_memory_peak(holder):
+    """
+    Stops measuring the peak of Python allocations of a stage.
+
+    Args:
+        holder (_MemoryPeak): The peak returned by _start_memory_peak.
+
+    Returns:
+        float: The peak of Python allocations during the stage, in MB.
+    """
+    with _memory_lock:
+        peak = tracemalloc.get_traced_memory()[1]
+        for active in _active_peaks:
+            active.value = max(active.value, peak)
+        _active_peaks.remove(holder)
+    return round(holder.value / 2 ** 20, 2)
+
+def count_rows(value):
+    """
+    Counts the rows of a stage input or output.
+
+    Args:
+        value: A DataFrame, a list of violations (see violations.make_violation) or any other value.
+
+    Returns:
+        int: The number of rows, or None if the value has no rows.
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value)
+    if isinstance(value, list) and all(isinstance(item, dict) and "count" in item for item in value):
+        return sum(item["count"] for item in value)
+    if isinstance(value, (list, tuple)) and value and all(isinstance(item, pd.DataFrame) for item in value):
+        return sum(len(item) for item in value)
+    return None
+
+@contextmanager
+def stage(name, rows_in=None, **labels):
+    """
+    Measures a stage of a task: wall time, CPU time, peak memory and row counts.
+
+    The caller can set 'rows_out' (or any other field) on the yielded record. When
+    no task is being instrumented (see instrumented_task), the stage is not recorded.
+    CPU time is the one of the whole process, so it includes the other threads and
+    excludes the child processes of the stage.
+
+    Args:
+        name (str): Name of the stage.
+        rows_in (int, optional): Number of input rows.
+        **labels: Extra fields of the record (source URL, table name...).
+
+    Yields:
+        dict: The record of the stage.
+    """
+    recorder = _recorder.get()
+    record = dict(labels, stage=name, rows_in=rows_in, rows_out=None)
+    if recorder is None:
+        yield record
+        return
+
+    holder = _start_memory_peak() if tracemalloc.is_tracing() else None
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield record
+    finally:
+        record["wall_seconds"] = round(time.perf_counter() - wall_start, 4)
+        record["cpu_seconds"] = round(time.process_time() - cpu_start, 4)
+        record["peak_rss_mb"] = _peak_rss_mb()
+        if holder is not None:
+            record["python_peak_mb"] = _stop_memory_peak(holder)
+        recorder.add(record)
+
+def instrumented(name=None):
+    """
+    Decorator measuring each call of a function as a stage.
+
+    The input rows are counted from the DataFrame arguments and the output rows
+    from the returned DataFrame or violations.
+
+    Args:
+        name (str, optional): Name of the stage. Defaults to the function name.
+    """
+    def decorator(function):
+        stage_name = name or function.__name__.lstrip("_")
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _recorder.get() is None:
+                return function(*args, **kwargs)
+            counts = [count_rows(value) for value in list(args) + list(kwargs.values())]
+            counts = [count for count in counts if count is not None]
+            with stage(stage_name, rows_in=sum(counts) if counts else None) as record:
+                result = function(*args, **kwargs)
+                record["rows_out"] = count_rows(result)
+            return result
+        return wrapper
+    return decorator
+
+def propagate(function):
+    """
+    Binds a function to the current instrumentation context, so that the stages it
+    runs in a thread pool are recorded in the task of the caller.
+
+    Args:
+        function (callable): The function to run in another thread.
+
+    Returns:
+        callable: The bound function.
+    """
+    context = contextvars.copy_context()
+    return functools.partial(context.run, function)
+
+def format_statsd(task_id, records, prefix=STATSD_PREFIX):
+    """
+    Formats stage records as StatsD lines, one metric per task, stage and source.
+
+    Args:
+        task_id (str): Name of the task.
+        records (list): The stage records.
+        prefix (str, optional): Prefix of the metric names.
+
+    Returns:
+        list: The StatsD lines, timers in milliseconds and gauges for rows and memory.
+    """
+    lines = []
+    for record in records:
+        stage_name = f"{record['stage']}.{record['source']}" if record.get("source") else record["stage"]
+        metric = f"{prefix}.{_safe_name(task_id)}.{_safe_name(stage_name)}"
+        lines.append(f"{metric}.wall_ms:{record['wall_seconds'] * 1000:.1f}|ms")
+        lines.append(f"{metric}.cpu_ms:{record['cpu_seconds'] * 1000:.1f}|ms")
+        for field in ("peak_rss_mb", "python_peak_mb", "rows_in", "rows_out"):
+            if record.get(field) is not None:
+                lines.append(f"{metric}.{field}:{record[field]}|g")
+    return lines
+
+def format_openmetrics(task_id, records, prefix=STATSD_PREFIX):
+    """
+    Formats stage records in the OpenMetrics text format, with the task and stage as labels.
+
+    Args:
+        task_id (str): Name of the task.
+        records (list): The stage records.
+        prefix (str, optional): Prefix of the metric names.
+
+    Returns:
+        str: The OpenMetrics exposition.
+    """
+    fields = {
+        "wall_seconds": "Wall time of the stage.",
+        "cpu_seconds": "CPU time of the process during the stage.",
+        "peak_rss_mb": "Peak resident set size of the process at the end of the stage.",
+        "python_peak_mb": "Peak of Python allocations during the stage.",
+        "rows_in": "Input rows of the stage.",
+        "rows_out": "Output rows of the stage.",
+    }
+    lines = []
+    for field, description in fields.items():
+        samples = [record for record in records if record.get(field) is not None]
+        if not samples:
+            continue
+        metric = f"{_safe_name(prefix)}_stage_{field}"
+        lines.append(f"# HELP {metric} {description}")
+        lines.append(f"# TYPE {metric} gauge")
+        for record in samples:
+            source = f',source="{record["source"]}"' if record.get("source") else ""
+            lines.append(f'{metric}{{task="{task_id}",stage="{record["stage"]}"{source}}} {record[field]}')
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+def _emit_statsd(lines, host=STATSD_HOST, port=STATSD_PORT):
+    """
+    Sends StatsD lines over UDP. Delivery is best effort and never fails the task.
+
+    Args:
+        lines (list): The StatsD lines.
+        host (str, optional): Host of the StatsD collector. Empty to disable.
+        port (int, optional): Port of the StatsD collector.
+    """
+    if not host or not lines:
+        return
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as statsd_socket:
+            packet = []
+            for line in lines:
+                packet.append(line)
+                if sum(len(item) + 1 for item in packet) > 1200:
+                    statsd_socket.sendto("\n".join(packet).encode("utf-8"), (host, port))
+                    packet = []
+            if packet:
+                statsd_socket.sendto("\n".join(packet).encode("utf-8"), (host, port))
+    except OSError as e:
+        logging.warning(f"Error sending metrics to StatsD at {host}:{port}: {e}")
+
+def _write_textfile(task_id, exposition, textfile_dir=METRICS_TEXTFILE_DIR):
+    """
+    Writes the OpenMetrics exposition of a task to a textfile collector directory.
+
+    Args:
+        task_id (str): Name of the task.
+        exposition (str): The OpenMetrics exposition.
+        textfile_dir (str, optional): Directory of the collector. Empty to disable.
+    """
+    if not textfile_dir:
+        return
+    try:
+        os.makedirs(textfile_dir, exist_ok=True)
+        path = os.path.join(textfile_dir, f"{_safe_name(task_id)}.prom")
+        with open(f"{path}.tmp", "w") as textfile:
+            textfile.write(exposition)
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        logging.warning(f"Error writing metrics to {textfile_dir}: {e}")
+
+def publish(task_id, records, ti=None):
+    """
+    Logs the stage records of a task, pushes them to XCom and emits them to StatsD
+    and to the OpenMetrics textfile directory.
+
+    Args:
+        task_id (str): Name of the task.
+        records (list): The stage records.
+        ti (TaskInstance, optional): The Airflow task instance, used to push the records to XCom.
+    """
+    for record in records:
+        logging.info(
+            f"Stage {record['stage']}: {record['wall_seconds']}s wall, {record['cpu_seconds']}s CPU, "
+            f"{record['peak_rss_mb']} MB peak RSS, rows in {record['rows_in']}, rows out {record['rows_out']}"
+        )
+    if ti is not None:
+        try:
+            ti.xcom_push(key="metrics", value=records)
+        except Exception as e:
+            logging.warning(f"Error pushing metrics to XCom: {e}")
+    _emit_statsd(format_statsd(task_id, records))
+    _write_textfile(task_id, format_openmetrics(task_id, records))
+
+def instrumented_task(task_id):
+    """
+    Decorator instrumenting an Airflow task function: every stage it runs is
+    recorded, along with a 'total' stage, and the records are published when the
+    task ends, whether it succeeds or fails.
+
+    Python allocations are only traced with tracemalloc when the
+    ALLOWANCES_TRACE_MEMORY environment variable is set to 1, since tracing slows
+    the task down.
+
+    Args:
+        task_id (str): Name of the task, used when the Airflow task instance is not given.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(**kwargs):
+            ti = kwargs.get('ti')
+            recorder = _Recorder(getattr(ti, 'task_id', task_id))
+            token = _recorder.set(recorder)
+            started_tracing = TRACE_MEMORY and not tracemalloc.is_tracing()
+            if started_tracing:
+                tracemalloc.start()
+            try:
+                with stage("total"):
+                    return function(**kwargs)
+            finally:
+                if started_tracing:
+                    tracemalloc.stop()
+                _recorder.reset(token)
+                publish(recorder.task_id, recorder.records, ti=ti)
+        return wrapper
+    return decorator
@@ -0,0 +1,390 @@
+import numpy as np
+import pandas as pd
+
+KEY_SUFFIXES = ("_hi", "_lo")
+UUID_LENGTH = 36
+DASH_POSITIONS = [8, 13, 18, 23]
+HEX_POSITIONS = [position for position in range(UUID_LENGTH) if position not in DASH_POSITIONS]
+# Low half of the keys of the values that are not UUIDs. RFC 4122 UUIDs have the
+# variant bits '10' at the top of their low half, so they never use this value;
+# the other UUIDs ending with it are keyed like the strings that are not UUIDs.
+NOT_UUID_LO = np.uint64(2 ** 64 - 1)
+# Key of the null values, which no string takes
+NULL_KEY = (np.uint64(0), NOT_UUID_LO)
+# Version of the encoding of encode_uuids: the snapshots keyed by another version are parsed again
+KEY_VERSION = 2
+
+_HEX_VALUES = np.full(256, 255, dtype=np.uint8)
+for _value, _digit in enumerate(b"0123456789abcdef"):
+    _HEX_VALUES[_digit] = _value
+for _value, _digit in enumerate(b"ABCDEF"):
+    _HEX_VALUES[_digit] = 10 + _value
+
+def key_columns(column):
+    """
+    Returns the names of the two integer key columns of a user id column.
+
+    Args:
+        column (str): The user id column ('uuid' or 'user_id').
+
+    Returns:
+        tuple: The names of the high and low halves of the key.
+    """
+    return tuple(f"{column}{suffix}" for suffix in KEY_SUFFIXES)
+
+def is_key_column(df, column):
+    """
+    Tells whether a column is the integer key of another column of the DataFrame.
+
+    Args:
+        df (pd.DataFrame): The table.
+        column (str): The column name.
+
+    Returns:
+        bool: True for the key columns added by add_keys.
+    """
+    return any(
+        isinstance(column, str) and column.endswith(suffix) and column[:-len(suffix)] in df.columns
+        for suffix in KEY_SUFFIXES
+    )
+
+def drop_keys(df):
+    """
+    Removes the integer key columns, e.g. before writing rows to a report.
+
+    Args:
+        df (pd.DataFrame): The table.
+
+    Returns:
+        pd.DataFrame: The table without its key columns.
+    """
+    dropped = [column for column in df.columns if is_key_column(df, column)]
+    return df.drop(columns=dropped) if dropped else df
+
+def _ascii_matrix(text):
+    """
+    Lays out strings of UUID_LENGTH characters as a matrix of bytes.
+
+    Args:
+        text (np.ndarray): Strings of UUID_LENGTH characters.
+
+    Returns:
+        np.ndarray: uint8 matrix of shape (len(text), UUID_LENGTH), non-ASCII characters as '?'.
+    """
+    try:
+        encoded = text.astype(f"S{UUID_LENGTH}")
+    except UnicodeEncodeError:
+        encoded = np.array([value.encode("ascii", "replace") for value in text], dtype=f"S{UUID_LENGTH}")
+    return np.frombuffer(encoded.tobytes(), dtype=np.uint8).reshape(len(text), UUID_LENGTH)
+
+def encode_uuids(values):
+    """
+    Encodes user ids as two uint64 halves, without going through Python UUID objects.
+
+    Canonical UUID strings are parsed with vectorized byte operations into the 128
+    bits of the UUID, so two ids are equal when both halves are equal and the
+    big-endian order of the halves is the order of the UUIDs. Unlike pd.merge and
+    pd.Series.duplicated, the spellings of a UUID in upper and lower case are the same
+    user; the other strings are compared as they are. They get a non-zero 64-bit hash
+    as high half and NOT_UUID_LO as low half, and null values get NULL_KEY, so they
+    still match each other in joins like in pd.merge but no user id.
+
+    Args:
+        values (pd.Series): The user ids.
+
+    Returns:
+        tuple: The high and low halves (np.ndarray of uint64).
+    """
+    n_values = len(values)
+    high = np.full(n_values, NULL_KEY[0], dtype=np.uint64)
+    low = np.full(n_values, NULL_KEY[1], dtype=np.uint64)
+    null_mask = values.isna().to_numpy()
+    text = values.astype(object).where(~null_mask, "").astype(str).to_numpy(dtype=object)
+    candidates = ~null_mask & (pd.Series(text, dtype=object).str.len() == UUID_LENGTH).to_numpy()
+
+    if candidates.any():
+        candidate_positions = np.flatnonzero(candidates)
+        matrix = _ascii_matrix(text[candidates])
+        nibbles = _HEX_VALUES[matrix[:, HEX_POSITIONS]]
+        is_uuid = (matrix[:, DASH_POSITIONS] == ord("-")).all(axis=1) & (nibbles < 16).all(axis=1)
+        packed = np.ascontiguousarray((nibbles[:, 0::2] << 4) | nibbles[:, 1::2])
+        halves = packed.view(">u8").astype(np.uint64)
+        parsed = is_uuid & (halves[:, 1] != NOT_UUID_LO)
+        positions = candidate_positions[parsed]
+        high[positions] = halves[parsed, 0]
+        low[positions] = halves[parsed, 1]
+        reserved = candidate_positions[is_uuid & ~parsed]
+        text[reserved] = [value.lower() for value in text[reserved]]
+        candidates[candidate_positions[~parsed]] = False
+
+    not_uuid = ~null_mask & ~candidates
+    if not_uuid.any():
+        hashes = pd.util.hash_array(text[not_uuid])
+        hashes[hashes == NULL_KEY[0]] = 1
+        high[not_uuid] = hashes
+        low[not_uuid] = NOT_UUID_LO
+    return high, low
+
+def add_keys(df, column):
+    """
+    Adds the two uint64 key columns of a user id column and sorts the rows by key.
+
+    The rows are sorted with a stable sort, so the rows of a same user keep their
+    order, and keep their index labels. Once stored in a snapshot, the table is its
+    own sorted index: the joins and duplicate checks on it need no sort.
+
+    Args:
+        df (pd.DataFrame): The table.
+        column (str): The user id column.
+
+    Returns:
+        pd.DataFrame: The table sorted by key, with the key columns.
+    """
+    high_column, low_column = key_columns(column)
+    df[high_column], df[low_column] = encode_uuids(df[column])
+    sort_keys = sortable_keys(df, column)
+    if is_sorted(sort_keys):
+        return df
+    return df.take(np.argsort(sort_keys, kind="stable"))
+
+def key_halves(df, column):
+    """
+    Returns the two uint64 halves of the key of each row.
+
+    The key columns are encoded on the fly when the table has none (e.g. a table
+    read from the incremental state).
+
+    Args:
+        df (pd.DataFrame): The table.
+        column (str): The user id column.
+
+    Returns:
+        tuple: The high and low halves (np.ndarray of uint64).
+    """
+    high_column, low_column = key_columns(column)
+    if high_column in df.columns and low_column in df.columns:
+        return df[high_column].to_numpy(dtype=np.uint64), df[low_column].to_numpy(dtype=np.uint64)
+    return encode_uuids(df[column])
+
+def sortable_keys(df, column):
+    """
+    Packs the key of each row into one 16-byte value ordered like the UUIDs.
+
+    Args:
+        df (pd.DataFrame): The table.
+        column (str): The user id column.
+
+    Returns:
+        np.ndarray: The keys, as a 'S16' array.
+    """
+    high, low = key_halves(df, column)
+    packed = np.empty((len(df), 2), dtype=">u8")
+    packed[:, 0] = high
+    packed[:, 1] = low
+    return packed.view("S16").ravel()
+
+def is_sorted(sort_keys):
+    """
+    Checks in linear time whether keys are already sorted.
+
+    Args:
+        sort_keys (np.ndarray): The keys, as returned by sortable_keys.
+
+    Returns:
+        bool: True if the keys are in ascending order.
+    """
+    return bool((sort_keys[1:] >= sort_keys[:-1]).all())
+
+def sort_order(sort_keys):
+    """
+    Returns the positions of the keys in ascending order, without sorting keys already sorted.
+
+    Args:
+        sort_keys (np.ndarray): The keys, as returned by sortable_keys.
+
+    Returns:
+        np.ndarray: The positions of the keys in ascending order (stable).
+    """
+    if is_sorted(sort_keys):
+        return np.arange(len(sort_keys))
+    return np.argsort(sort_keys, kind="stable")
+
+def duplicated(df, column, keep="first"):
+    """
+    Flags the rows whose user id appears more than once, like pd.Series.duplicated,
+    the UUIDs whatever their case (see encode_uuids).
+
+    Equal keys are adjacent once sorted, so the duplicates are found by comparing
+    each key with the next one instead of hashing the strings.
+
+    Args:
+        df (pd.DataFrame): The table.
+        column (str): The user id column.
+        keep (str or bool, optional): 'first' or 'last' leaves that occurrence
+            unflagged, False flags every occurrence.
+
+    Returns:
+        np.ndarray: Boolean mask of the duplicated rows.
+    """
+    sort_keys = sortable_keys(df, column)
+    order = sort_order(sort_keys)
+    ordered = sort_keys[order]
+    same_as_previous = np.zeros(len(ordered), dtype=bool)
+    same_as_next = np.zeros(len(ordered), dtype=bool)
+    same_as_previous[1:] = ordered[1:] == ordered[:-1]
+    same_as_next[:-1] = same_as_previous[1:]
+
+    if keep == "first":
+        flagged = same_as_previous
+    elif keep == "last":
+        flagged = same_as_next
+    else:
+        flagged = same_as_previous | same_as_next
+    mask = np.zeros(len(ordered), dtype=bool)
+    mask[order] = flagged
+    return mask
+
+def group_codes(df, column):
+    """
+    Numbers the distinct user ids of a table, like pd.factorize but in key order.
+
+    Args:
+        df (pd.DataFrame): The table.
+        column (str): The user id column.
+
+    Returns:
+        tuple: The code of each row (np.ndarray of int64) and the position of the
+            first row of each code (np.ndarray of int64).
+    """
+    sort_keys = sortable_keys(df, column)
+    order = sort_order(sort_keys)
+    ordered = sort_keys[order]
+    starts = np.ones(len(ordered), dtype=bool)
+    starts[1:] = ordered[1:] != ordered[:-1]
+    codes = np.empty(len(ordered), dtype=np.int64)
+    codes[order] = np.cumsum(starts) - 1
+    return codes, order[starts]
+
+def latest_positions(df, column, order_values):
+    """
+    Finds the latest row of each user id, like sorting by order_values and keeping the last duplicate.
+
+    The users are numbered from their keys (see group_codes), so on a table stored
+    in key order nothing is sorted, and the rows returned are in key order too.
+
+    Args:
+        df (pd.DataFrame): The table.
+        column (str): The user id column.
+        order_values (np.ndarray): The value ordering the rows of a user (e.g. the event epoch).
+            Among the rows with the greatest value, the last one is kept.
+
+    Returns:
+        np.ndarray: The position of the latest row of each user id, in key order.
+    """
+    codes, _ = group_codes(df, column)
+    greatest = pd.Series(order_values).groupby(codes).transform("max").to_numpy()
+    candidates = np.flatnonzero(order_values == greatest)
+    return pd.Series(candidates).groupby(codes[candidates]).max().to_numpy()
+
+def _joined(left, right, left_positions, right_positions, suffixes):
+    """
+    Assembles the rows of a join from the positions of the matched rows.
+
+    Args:
+        left (pd.DataFrame): The left table.
+        right (pd.DataFrame): The right table.
+        left_positions (np.ndarray): Position of the left row of each result row.
+        right_positions (np.ndarray): Position of the right row of each result row.
+        suffixes (tuple): Suffixes of the columns present in both tables.
+
+    Returns:
+        pd.DataFrame: The joined rows.
+    """
+    overlap = set(left.columns) & set(right.columns)
+    left_part = left.take(left_positions).reset_index(drop=True)
+    right_part = right.take(right_positions).reset_index(drop=True)
+    left_part.columns = [f"{name}{suffixes[0]}" if name in overlap else name for name in left.columns]
+    right_part.columns = [f"{name}{suffixes[1]}" if name in overlap else name for name in right.columns]
+    return pd.concat([left_part, right_part], axis=1)
+
+def match_keys(left_high, left_low, ordered_right_high, right_order, right_low):
+    """
+    Finds the pairs of left and right rows with equal keys.
+
+    The rows of each left key are found with a binary search on the high halves of
+    the right keys, then kept when the low halves are equal too. The order of the
+    right table can be computed once and reused for many lookups (see streaming.py).
+
+    Args:
+        left_high (np.ndarray): High halves of the left keys.
+        left_low (np.ndarray): Low halves of the left keys.
+        ordered_right_high (np.ndarray): High halves of the right keys, in key order.
+        right_order (np.ndarray): Positions of the right rows in key order (see sort_order).
+        right_low (np.ndarray): Low halves of the right keys, in row order.
+
+    Returns:
+        tuple: The positions of the matched left rows and of the matched right rows
+            (np.ndarray of int64), in left row order.
+    """
+    starts = np.searchsorted(ordered_right_high, left_high, side="left")
+    counts = np.searchsorted(ordered_right_high, left_high, side="right") - starts
+
+    left_positions = np.repeat(np.arange(len(left_high)), counts)
+    offsets = np.arange(len(left_positions)) - np.repeat(np.cumsum(counts) - counts, counts)
+    right_positions = right_order[np.repeat(starts, counts) + offsets]
+    same_low = left_low[left_positions] == right_low[right_positions]
+    return left_positions[same_low], right_positions[same_low]
+
+def merge(left, right, left_on, right_on, how="inner", indicator=False, suffixes=("_x", "_y")):
+    """
+    Joins two tables on their user ids with a sorted-merge join on the integer keys.
+
+    Replaces pd.merge for the joins on user ids: the right table is usually stored
+    in key order already (see add_keys), so the rows of each left key are found with
+    a binary search on the high halves of the keys, then kept when the low halves
+    are equal too, and no hash table of strings is built. The UUIDs match whatever
+    their case (see encode_uuids). The inner join keeps the
+    order of the left rows; the outer join lists the left rows, then the right rows
+    without a match.
+
+    Args:
+        left (pd.DataFrame): The left table.
+        right (pd.DataFrame): The right table.
+        left_on (str): User id column of the left table.
+        right_on (str): User id column of the right table.
+        how (str, optional): 'inner' or 'outer'.
+        indicator (bool, optional): Add the '_merge' column of pd.merge ('both', 'left_only', 'right_only').
+        suffixes (tuple, optional): Suffixes of the columns present in both tables.
+
+    Returns:
+        pd.DataFrame: The joined table, with a fresh index.
+
+    Raises:
+        ValueError: If the join type is not supported.
+    """
+    if how not in ("inner", "outer"):
+        raise ValueError(f"Unsupported join type '{how}'")
+
+    left_high, left_low = key_halves(left, left_on)
+    right_high, right_low = key_halves(right, right_on)
+    right_order = sort_order(sortable_keys(right, right_on))
+    left_positions, right_positions = match_keys(left_high, left_low, right_high[right_order], right_order, right_low)
+    parts = [_joined(left, right, left_positions, right_positions, suffixes)]
+    origins = [np.full(len(left_positions), "both", dtype=object)]
+
+    if how == "outer":
+        matched_left = np.zeros(len(left), dtype=bool)
+        matched_left[left_positions] = True
+        left_only = np.flatnonzero(~matched_left)
+        matched_right = np.zeros(len(right), dtype=bool)
+        matched_right[right_positions] = True
+        right_only = np.flatnonzero(~matched_right)
+        parts.append(_joined(left, right.iloc[:0], left_only, np.array([], dtype=np.int64), suffixes))
+        parts.append(_joined(left.iloc[:0], right, np.array([], dtype=np.int64), right_only, suffixes))
+        origins.append(np.full(len(left_only), "left_only", dtype=object))
+        origins.append(np.full(len(right_only), "right_only", dtype=object))
+
+    joined = pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0]
+    if indicator:
+        joined["_merge"] = pd.Categorical(np.concatenate(origins), categories=["left_only", "right_only", "both"])
+    return joined
@@ -1,6 +1,12 @@
 import logging
-import pandas as pd
+from datetime import datetime
+from functools import partial
 
+from . import instrumentation
+from . import memo
+from . import violation_history
+
+@instrumentation.instrumented()
 def _check_values_allowance_backend(allowance_backend_df):
     """
     Checks the allowance_backend DataFrame for various data quality issues.
@@ -9,116 +15,191 @@ def _check_values_allowance_backend(allowance_backend_df):
         allowance_backend_df (pd.DataFrame): The DataFrame containing allowance backend data.
     
     Returns:
-        list: A list of error messages indicating any data quality issues found.
+        list: The violations found (see violations.make_violation), with the offending rows.
     
-    The function performs the following checks:
-    1. Null Values: Checks for columns containing null values and logs a warning for each column with null values.
-    2. Duplicate Values: Checks for duplicate 'uuid' values and logs a warning if any duplicates are found.
-    3. Invalid Payment Dates: Checks for 'next_payment_day' values that are not between 1 and 31 and logs a warning if any invalid dates are found.
-    4. Invalid Frequencies: Checks for 'frequency' values that are not in the allowed list ['daily', 'biweekly', 'weekly', 'monthly'] and logs a warning if any invalid frequencies are found.
-    5. Invalid Days: Checks for 'day' values that are not in the allowed list ['fifteenth_day', 'first_day', 'friday', 'monday', 'tuesday', 'thursday', 'saturday', 'sunday', 'daily', 'wednesday'] and logs a warning if any invalid days are found.
-    Each check is wrapped in a try-except block to catch and log any exceptions that occur during the check.
+    The checks are declared in config/rules_config.py (rules_dict['allowance_backend'])
+    and evaluated in a single pass over the columns:
+    1. Null Values: Checks for columns containing null values.
+    2. Duplicate Values: Checks for duplicate 'uuid' values.
+    3. Invalid Payment Dates: Checks for 'next_payment_day' values that are not between 1 and 31.
+    4. Invalid Frequencies: Checks for 'frequency' values that are not in the allowed list ['daily', 'biweekly', 'weekly', 'monthly'].
+    5. Invalid Days: Checks for 'day' values that are not in the allowed list ['fifteenth_day', 'first_day', 'friday', 'monday', 'tuesday', 'thursday', 'saturday', 'sunday', 'daily', 'wednesday'].
+    A rule that raises an exception is reported as a violation with its error instead of stopping the other checks.
     """
-    
-    errors = []
-    try:
-        null_counts = allowance_backend_df.isnull().sum()
-        for column, count in null_counts.items():
-            if count > 0:
-                error_message = f"Column '{column}' contains {count} null values."
-                errors.append(error_message)
-    except Exception as e:
-        errors.append(f"Error during null value check: {str(e)}")
-        logging.error(e)
 
-    try:
-        grouped  = allowance_backend_df.groupby('uuid').size()
-        duplicate_values = grouped[grouped > 1]
-        
-        if not duplicate_values.empty:
-            error_message = f"The 'allowance_backend' table has duplicate values: \n{duplicate_values}"
-            errors.append(error_message)
-    except Exception as e:
-        errors.append(f"Error during duplicate value check: {str(e)}")
-        logging.error(e)
+    from config.rules_config import rules_dict
+    from . import rules
 
-    try:
-        invalid_payment_date = allowance_backend_df[(allowance_backend_df['next_payment_day'] < 1) | (allowance_backend_df['next_payment_day'] > 31)]
-        if not invalid_payment_date.empty:
-            error_message = f"The 'allowance_backend' table has invalid payment dates: \n{invalid_payment_date}"
-            errors.append(error_message)
-    except Exception as e:
-        errors.append(f"Error during invalid payment date check: {str(e)}")
-        logging.error(e)
+    return rules.check_rules('allowance_backend', allowance_backend_df, rules_dict['allowance_backend'])
 
+@instrumentation.instrumented()
+def _check_values_next_payment_day(allowance_backend_df, as_of, severity='warning'):
+    """
+    Checks that the 'next_payment_day' of each enabled allowance is the one of its frequency and day as of the run date.
+
+    Args:
+        allowance_backend_df (pd.DataFrame): The DataFrame containing allowance backend data.
+        as_of (str or datetime): The run date.
+        severity (str, optional): 'error' fails the task, 'warning' is only reported.
+
+    Returns:
+        list: The violations found (see violations.make_violation), with the offending rows
+            and their 'expected_next_payment_day'.
+    """
+
+    from . import payment_calendar
+    from . import violations
+
+    found = []
     try:
-        invalid_frequency = allowance_backend_df[~allowance_backend_df['frequency'].isin(['daily', 'biweekly', 'weekly', 'monthly'])]
-        if not invalid_frequency.empty:
-            error_message = f"The 'allowance_backend' table has invalid frequencies: \n{invalid_frequency}"
-            errors.append(error_message)
-    except Exception as e:
-        errors.append(f"Error during invalid frequency check: {str(e)}")
-        logging.error(e)
-    
-    try:
-        list_days = ['fifteenth_day', 'first_day', 'friday', 'monday', 'tuesday',
-        'thursday', 'saturday', 'sunday', 'daily', 'wednesday']
-        invalid_day = allowance_backend_df[~allowance_backend_df['day'].isin(list_days)]
-        if not invalid_day.empty:
-            error_message = f"The 'allowance_backend' table has invalid day: \n{invalid_day}"
-            errors.append(error_message)
+        enabled_df = allowance_backend_df[allowance_backend_df['status'] == 'enabled']
+        expected = payment_calendar.expected_next_payment_day(enabled_df['frequency'], enabled_df['day'], as_of)
+        mismatch = (enabled_df['next_payment_day'] != expected).fillna(True).to_numpy(dtype=bool)
+        if mismatch.any():
+            found.append(violations.make_violation(
+                'allowance_backend_next_payment_day_matches_calendar',
+                f"The 'allowance_backend' table has next_payment_day values different from the payment calendar as of {as_of}",
+                rows=enabled_df[mismatch].assign(expected_next_payment_day=expected[mismatch]),
+                severity=severity,
+            ))
     except Exception as e:
-        errors.append(f"Error during invalid day check: {str(e)}")
+        found.append(violations.make_violation('allowance_backend_next_payment_day_matches_calendar', "Error during next payment day check", severity=severity, error=str(e)))
         logging.error(e)
+    return found
 
-    return errors
+def _check_partition(allowance_backend_df, as_of, next_payment_day_severity):
+    """
+    Runs the checks of the task on a partition of the allowance backend (see out_of_core.py).
+
+    Args:
+        allowance_backend_df (pd.DataFrame): The rows of the partition.
+        as_of (str): The run date of the payment calendar check (YYYY-MM-DD).
+        next_payment_day_severity (str): Severity of the payment calendar check.
+
+    Returns:
+        list: The violations found in the partition.
+    """
+    found = _check_values_allowance_backend(allowance_backend_df)
+    found.extend(_check_values_next_payment_day(allowance_backend_df, as_of, next_payment_day_severity))
+    return found
+
+def _run_date(kwargs):
+    """
+    Resolves the run date of the payment calendar check.
+
+    A scheduled run starts at the end of its data interval, the day after its 'ds', and
+    reads the backend as it is then: its next payment days are the ones as of that date.
+
+    Args:
+        kwargs (dict): The task arguments.
+
+    Returns:
+        str: 'as_of', or the end of the Airflow data interval ('data_interval_end', or
+            'next_ds' before Airflow 2.2), or 'ds', or today (YYYY-MM-DD).
+    """
+    import pandas as pd
+
+    if kwargs.get('as_of'):
+        return kwargs['as_of']
+    for name in ('data_interval_end', 'next_ds', 'ds'):
+        if kwargs.get(name):
+            return pd.Timestamp(kwargs[name]).strftime('%Y-%m-%d')
+    return datetime.now().strftime('%Y-%m-%d')
 
+@instrumentation.instrumented_task('look_allowance_backend')
+@violation_history.tracked('look_allowance_backend')
+@memo.memoized('look_allowance_backend', ['allowance_backend'], ['next_payment_day_severity', 'violation_sample_size'], {'as_of': _run_date})
 def look_for_inconsistencies(**kwargs):
     """
     This function checks for inconsistencies in the allowance backend data.
     
     Args:
-        **kwargs: Arbitrary keyword arguments. Expects 'allowance_backend' key with the URL to the allowance backend CSV.
+        **kwargs: Arbitrary keyword arguments. Expects 'allowance_backend' key with the URL to the allowance backend CSV,
+            and optionally the Airflow 'run_id', used to share the source snapshot between tasks,
+            and 'violation_sample_size', the number of offending rows per rule kept in the report.
+            The run date used by the payment calendar check is 'as_of', or the end of the Airflow data interval, or today;
+            'next_payment_day_severity' sets the severity of that check.
+            'memoize' set to False always runs the checks instead of reusing the report of a previous
+            run with the same inputs and rules (see memo.py).
+            'out_of_core' set to True spills the table to disk by user id partition and runs the checks
+            one partition at a time, within 'memory_budget_mb' (see out_of_core.py).
+            'history' set to False fails on every violation instead of only the ones not found
+            by the previous run (see violation_history.py).
     
+    Returns:
+        dict: The report (see violations.build_report), when the checks pass.
+
     Raises:
         ValueError: If 'allowance_backend' URL is not provided in kwargs.
+        violations.ViolationsError: If the checks find violations with 'error' severity (only new ones with history).
         Exception: If there is an error in extracting data to bronze or checking values in the allowance backend.
     
     The function performs the following steps:
         1. Imports necessary utilities from the config module.
         2. Retrieves the allowance backend URL from kwargs.
         3. Raises a ValueError if the URL is not provided.
-        4. Attempts to read the CSV data from the provided URL into a DataFrame.
+        4. Attempts to read the CSV data from the snapshot of the current run, or from the provided URL, into a DataFrame.
         5. Logs and raises any exceptions encountered during the data extraction.
-        6. Checks for inconsistencies in the allowance backend data.
+        6. Checks for inconsistencies in the allowance backend data, and the next_payment_day
+           of the enabled allowances against the payment calendar as of the run date.
         7. Logs and raises any exceptions encountered during the inconsistency check.
+        8. Writes the offending rows of each rule to the violation sink, pushes the per-rule
+           counts and samples to XCom and raises a summary bounded to those samples.
     """
     
 
     from . import utils
+    from . import violations
     
     allowance_backend_url = kwargs.get('allowance_backend')
+    run_id = kwargs.get('run_id')
 
     if not allowance_backend_url:
         raise ValueError("The 'allowance_backend_url'must be provided")
 
+    as_of = _run_date(kwargs)
+    next_payment_day_severity = kwargs.get('next_payment_day_severity', 'warning')
+    task_id = getattr(kwargs.get('ti'), 'task_id', 'look_allowance_backend')
+    sample_size = kwargs.get('violation_sample_size', violations.VIOLATION_SAMPLE_SIZE)
+
+    if kwargs.get('out_of_core', False):
+        from . import out_of_core
+
+        try:
+            found = out_of_core.run_partitioned_checks(
+                [(allowance_backend_url, 'allowance_backend')],
+                partial(_check_partition, as_of=as_of, next_payment_day_severity=next_payment_day_severity),
+                run_id,
+                task_id,
+                kwargs.get('memory_budget_mb', out_of_core.MEMORY_BUDGET_MB),
+                sample_size,
+            )
+        except Exception as e:
+            logging.critical(f"Critical error in run_partitioned_checks: {e}")
+            raise
+        report = violations.build_report(found, run_id, task_id, ti=kwargs.get('ti'), sample_size=sample_size)
+        return violations.raise_for_errors(report, sample_size)
+
     try:
-        allowance_backend_df = utils.get_csv_df(allowance_backend_url)
+        allowance_backend_df = utils.get_snapshot_df(allowance_backend_url, 'allowance_backend', run_id=run_id)
     except Exception as e:
         logging.critical(f"Critical error in extract_data_to_bronze: {e}")
         raise
 
     try:
-        errors = _check_values_allowance_backend(allowance_backend_df)
+        found = _check_values_allowance_backend(allowance_backend_df)
     except Exception as e:
         logging.critical(f"Critical error in check_values_allowance_backend: {e}")
         raise
 
-    if errors:
-        error_summary = "Errors found during execution:\n" + "\n".join(errors)
-        raise Exception(error_summary)
-    else:
-        logging.info("All checks passed successfully.")
+    try:
+        found.extend(_check_values_next_payment_day(allowance_backend_df, as_of, next_payment_day_severity))
+    except Exception as e:
+        logging.critical(f"Critical error in check_values_next_payment_day: {e}")
+        raise
+
+    report = violations.build_report(found, run_id, task_id, ti=kwargs.get('ti'), sample_size=sample_size)
+    return violations.raise_for_errors(report, sample_size)
 
 
 if __name__ == "__main__":
@@ -1,29 +1,63 @@
 import logging
-import pandas as pd
-from datetime import datetime, timedelta
+from functools import partial
 
-def _check_values_allowance_backend(allowance_events_df, allowance_backend_df):
+from . import instrumentation
+from . import memo
+from . import violation_history
+from . import keys
+
+def _unparseable_events_violation(unparseable_events_df):
+    """
+    Reports the events whose timestamp can not be parsed, since they can not be ordered.
+
+    Args:
+        unparseable_events_df (pd.DataFrame): The events whose timestamp can not be parsed.
+
+    Returns:
+        dict: The violation (see violations.make_violation).
+    """
+    from . import violations
+
+    return violations.make_violation(
+        'allowance_events_timestamp_parseable',
+        "The 'allowance_events' table has event timestamps that can not be parsed",
+        rows=unparseable_events_df,
+    )
+
+@instrumentation.instrumented()
+def _check_values_allowance_backend(allowance_events_df, allowance_backend_df, inconsistent_users=None):
     """
     Check if the values in the 'allowance_backend' table are consistent with the 'allowance_events' table.
 
     Args:
         allowance_events_df (pd.DataFrame): The 'allowance_events' table.
         allowance_backend_df (pd.DataFrame): The 'allowance_backend' table.
+        inconsistent_users (set, optional): If given, the ids of the inconsistent users are added to it.
 
     Returns:
-        pd.DataFrame: The inconsistencies found between the two tables.
+        list: The inconsistencies found between the two tables (see violations.make_violation).
     """
-    allowance_events_df['event_timestamp'] = pd.to_datetime(allowance_events_df['event_timestamp'])
-    allowance_events_df['event_timestamp'] = allowance_events_df['event_timestamp'].astype(int) // 10**9
+    from . import timestamps
+    from . import violations
+
+    event_timestamps, unparseable = timestamps.normalize_timestamps(allowance_events_df['event_timestamp'], timestamps.EVENT_TIMEZONE)
+    allowance_events_df = allowance_events_df.assign(event_timestamp=event_timestamps)
     
-    errors = []
+    found = []
+    if unparseable.any():
+        found.append(_unparseable_events_violation(allowance_events_df[unparseable]))
+        allowance_events_df = allowance_events_df[~unparseable]
     try:
-        allowance_events_df = allowance_events_df.sort_values(by='event_timestamp') \
-                                                    .drop_duplicates(subset='user_id', keep='last')
+        with instrumentation.stage('sort_dedup_events', rows_in=len(allowance_events_df)) as record:
+            event_epochs = allowance_events_df['event_timestamp'].to_numpy(dtype='int64', na_value=-1)
+            allowance_events_df = allowance_events_df.iloc[keys.latest_positions(allowance_events_df, 'user_id', event_epochs)]
+            record['rows_out'] = len(allowance_events_df)
         
         allowance_backend_df = allowance_backend_df[allowance_backend_df['status'] == 'enabled']
 
-        allowance_events_backend_df = pd.merge(allowance_events_df, allowance_backend_df, left_on='user_id', right_on='uuid', how='inner')
+        with instrumentation.stage('merge_events_backend', rows_in=len(allowance_events_df) + len(allowance_backend_df)) as record:
+            allowance_events_backend_df = keys.merge(allowance_events_df, allowance_backend_df, left_on='user_id', right_on='uuid', how='inner')
+            record['rows_out'] = len(allowance_events_backend_df)
 
         inconsistent_values = allowance_events_backend_df[(allowance_events_backend_df['allowance_scheduled_frequency'] != allowance_events_backend_df['frequency']) 
                                                                 | (allowance_events_backend_df['allowance_scheduled_day'] != allowance_events_backend_df['day'])
@@ -31,37 +65,113 @@ def _check_values_allowance_backend(allowance_events_df, allowance_backend_df):
                                                                 | (allowance_events_backend_df['uuid'].isna())]
     
         if not inconsistent_values.empty:
-            error_message = f"The 'allowance_backend' table has inconsistent values: \n{inconsistent_values}"
-            errors.append(error_message)
+            found.append(violations.make_violation(
+                'allowance_backend_matches_events',
+                "The 'allowance_backend' table has inconsistent values",
+                rows=inconsistent_values,
+            ))
+            if inconsistent_users is not None:
+                inconsistent_users.update(inconsistent_values['uuid'].dropna())
     except Exception as e:
-        errors.append(f"Error during allowance backend check: {str(e)}")
+        found.append(violations.make_violation('allowance_backend_matches_events', "Error during allowance backend check", error=str(e)))
         logging.error(e)
+        if inconsistent_users is not None:
+            inconsistent_users.update(allowance_backend_df['uuid'].dropna())
     
-    return errors
+    return found
+
+@instrumentation.instrumented()
+def _check_values_replayed_state(allowance_events_df, allowance_backend_df, inconsistent_users=None):
+    """
+    Check every column of the 'allowance_backend' table against the state replayed from all the 'allowance_events'.
+
+    Args:
+        allowance_events_df (pd.DataFrame): All the events of the 'allowance_events' table, not only the latest per user.
+        allowance_backend_df (pd.DataFrame): The 'allowance_backend' table.
+        inconsistent_users (set, optional): If given, the ids of the inconsistent users are added to it.
+
+    Returns:
+        list: The inconsistencies found between the two tables (see violations.make_violation).
+
+    The checks are:
+    1. Status: the backend status differs from the one set by the latest lifecycle event (disabled, deleted, resumed...).
+    2. Schedule: an enabled allowance has a frequency or day different from the latest event that set them.
+    3. Creation date: the backend creation_date differs from the creation event (warning).
+    4. Missing users: users with events and no backend row, or backend rows without any event (warning).
+    5. Event timestamps: the events whose timestamp can not be parsed, and so can not be ordered.
+    """
+    from . import replay
+    from . import violations
+
+    found = []
+    try:
+        with instrumentation.stage('replay_events', rows_in=len(allowance_events_df)) as record:
+            expected_df = replay.replay_events(allowance_events_df)
+            record['rows_out'] = len(expected_df)
+        unparseable_events = expected_df.attrs.get(replay.UNPARSEABLE_EVENTS_ATTR)
+        if unparseable_events:
+            found.append(_unparseable_events_violation(allowance_events_df.loc[unparseable_events]))
+        with instrumentation.stage('merge_replay_backend', rows_in=len(expected_df) + len(allowance_backend_df)) as record:
+            joined_df, masks = replay.compare_state(expected_df, allowance_backend_df)
+            record['rows_out'] = len(joined_df)
 
-def _check_values_payment_schedule_backend(allowance_backend_df, payment_schedule_backend_df):
+        checks = [
+            ('allowance_backend_status_matches_events', 'status', "The 'allowance_backend' table has a status different from the events", 'error'),
+            ('allowance_backend_matches_events', 'schedule', "The 'allowance_backend' table has inconsistent values", 'error'),
+            ('allowance_backend_missing_users', 'missing_in_backend', "The 'allowance_backend' table is missing users with events", 'error'),
+            ('allowance_backend_creation_date_matches_events', 'creation_date', "The 'allowance_backend' table has a creation_date different from the creation event", 'warning'),
+            ('allowance_backend_users_without_events', 'missing_in_events', "The 'allowance_backend' table has users without events", 'warning'),
+        ]
+        for rule, mask_name, message, severity in checks:
+            inconsistent_values = joined_df[masks[mask_name]]
+            if not inconsistent_values.empty:
+                found.append(violations.make_violation(rule, message, rows=inconsistent_values, severity=severity))
+                if inconsistent_users is not None and severity == 'error':
+                    inconsistent_users.update(inconsistent_values['uuid'].fillna(inconsistent_values['expected_user_id']))
+    except Exception as e:
+        found.append(violations.make_violation('allowance_backend_matches_events', "Error during allowance backend replay check", error=str(e)))
+        logging.error(e)
+        if inconsistent_users is not None:
+            inconsistent_users.update(allowance_backend_df['uuid'].dropna())
+
+    return found
+
+@instrumentation.instrumented()
+def _check_values_payment_schedule_backend(allowance_backend_df, payment_schedule_backend_df, inconsistent_users=None):
     """
     Check if the values in the 'payment_schedule_backend' table are consistent with the 'allowance_backend' table.
 
     Args:
         allowance_backend_df (pd.DataFrame): The 'allowance_backend' table.
         payment_schedule_backend_df (pd.DataFrame): The 'payment_schedule_backend' table.
+        inconsistent_users (set, optional): If given, the ids of the inconsistent users are added to it.
 
     Returns:
-        pd.DataFrame: The inconsistencies found between the two tables.
+        list: The inconsistencies found between the two tables (see violations.make_violation).
     """
 
-    allowance_backend_payment_df = pd.merge(allowance_backend_df, payment_schedule_backend_df, left_on='uuid', right_on='user_id', how='inner')
-    errors = []
+    from . import violations
+
+    with instrumentation.stage('merge_backend_payments', rows_in=len(allowance_backend_df) + len(payment_schedule_backend_df)) as record:
+        allowance_backend_payment_df = keys.merge(allowance_backend_df, payment_schedule_backend_df, left_on='uuid', right_on='user_id', how='inner')
+        record['rows_out'] = len(allowance_backend_payment_df)
+    found = []
+    if inconsistent_users is None:
+        inconsistent_users = set()
     try:
         inconsistent_values_disabled_payments = allowance_backend_payment_df[(allowance_backend_payment_df['status'] == 'disabled') & (allowance_backend_payment_df['payment_date'].notna())]
         
         if not inconsistent_values_disabled_payments.empty:
-            error_message = f"The 'payment_schedule_backend' table has inconsistent disabled values: \n{inconsistent_values_disabled_payments}"
-            errors.append(error_message)
+            found.append(violations.make_violation(
+                'payment_schedule_backend_disabled_payments',
+                "The 'payment_schedule_backend' table has inconsistent disabled values",
+                rows=inconsistent_values_disabled_payments,
+            ))
+            inconsistent_users.update(inconsistent_values_disabled_payments['uuid'])
     except Exception as e:
-        errors.append(f"Error during disabled payments check: {str(e)}")
+        found.append(violations.make_violation('payment_schedule_backend_disabled_payments', "Error during disabled payments check", error=str(e)))
         logging.error(e)
+        inconsistent_users.update(allowance_backend_payment_df['uuid'])
 
     allowance_backend_payment_df = allowance_backend_payment_df[allowance_backend_payment_df['status'] == 'enabled']
 
@@ -69,14 +179,82 @@ def _check_values_payment_schedule_backend(allowance_backend_df, payment_schedul
         inconsistent_values_on_payments = allowance_backend_payment_df[(allowance_backend_payment_df['next_payment_day'] != allowance_backend_payment_df['payment_date'])]
         
         if not inconsistent_values_on_payments.empty:
-            error_message = f"The 'payment_schedule_backend' table has different values than 'allowance_backend': \n{inconsistent_values_on_payments}"
-            errors.append(error_message)
+            found.append(violations.make_violation(
+                'payment_schedule_backend_matches_allowance_backend',
+                "The 'payment_schedule_backend' table has different values than 'allowance_backend'",
+                rows=inconsistent_values_on_payments,
+            ))
+            inconsistent_users.update(inconsistent_values_on_payments['uuid'])
     except Exception as e:
-        errors.append(f"Error during enabled payments check: {str(e)}")
+        found.append(violations.make_violation('payment_schedule_backend_matches_allowance_backend', "Error during enabled payments check", error=str(e)))
         logging.error(e)
+        inconsistent_users.update(allowance_backend_payment_df['uuid'])
     
-    return errors
+    return found
+
+@instrumentation.instrumented()
+def _check_values_incremental(allowance_events_url, allowance_backend_df, payment_schedule_backend_df, run_id, state_dir, backend_versions=None):
+    """
+    Checks only the users whose events or backend rows changed since the previous run.
 
+    Args:
+        allowance_events_url (str): URL to fetch allowance events data.
+        allowance_backend_df (pd.DataFrame): The 'allowance_backend' table.
+        payment_schedule_backend_df (pd.DataFrame): The 'payment_schedule_backend' table.
+        run_id (str): The Airflow run id.
+        state_dir (str): Directory holding the incremental state.
+        backend_versions (dict, optional): Content version of each backend table (see utils.snapshot_version).
+
+    Returns:
+        list: The inconsistencies found (see violations.make_violation).
+
+    The function performs the following steps:
+    1. Downloads only the events appended since the previous run (see utils.fetch_new_events),
+       or keeps the events newer than the persisted watermark when the payload can not be resumed,
+       and merges their latest event per user into the state.
+    2. Compares the hash of each backend row with the one persisted by the previous run,
+       unless the table did not change.
+    3. Validates the users with new events, changed backend rows or inconsistencies still open from the previous run.
+    4. Persists the inconsistent users and the new watermark.
+    """
+
+    from . import utils
+    from . import incremental_state
+
+    connection = incremental_state.open_state(state_dir)
+    try:
+        backend_versions = backend_versions or {}
+        watermark = incremental_state.get_watermark(connection)
+        new_events_df, resume = utils.fetch_new_events(allowance_events_url, incremental_state.get_events_resume(connection), since=watermark)
+        changed_users, new_watermark = incremental_state.merge_latest_events(connection, new_events_df)
+        changed_users |= incremental_state.update_row_hashes(connection, 'allowance_backend', allowance_backend_df, 'uuid',
+                                                             backend_versions.get('allowance_backend'))
+        changed_users |= incremental_state.update_row_hashes(connection, 'payment_schedule_backend', payment_schedule_backend_df, 'user_id',
+                                                             backend_versions.get('payment_schedule_backend'))
+        validated_users = changed_users | incremental_state.get_open_violations(connection)
+        logging.info(f"Incremental run since {watermark}: {len(new_events_df)} users with new events, {len(validated_users)} users to validate")
+
+        allowance_events_df = incremental_state.get_latest_events(connection, validated_users)
+        allowance_backend_df = allowance_backend_df[allowance_backend_df['uuid'].isin(validated_users)]
+        payment_schedule_backend_df = payment_schedule_backend_df[payment_schedule_backend_df['user_id'].isin(validated_users)]
+
+        inconsistent_users = set()
+        found = _check_values_allowance_backend(allowance_events_df, allowance_backend_df, inconsistent_users)
+        found.extend(_check_values_payment_schedule_backend(allowance_backend_df, payment_schedule_backend_df, inconsistent_users))
+
+        incremental_state.set_open_violations(connection, validated_users, inconsistent_users)
+        if new_watermark is not None:
+            incremental_state.set_watermark(connection, new_watermark, run_id)
+        incremental_state.set_events_resume(connection, resume)
+        connection.commit()
+    finally:
+        connection.close()
+
+    return found
+
+@instrumentation.instrumented_task('look_for_inconsistencies')
+@violation_history.tracked('look_for_inconsistencies')
+@memo.memoized('look_for_inconsistencies', ['allowance_events', 'allowance_backend', 'payment_schedule_backend'], ['replay', 'violation_sample_size'])
 def look_for_inconsistencies(**kwargs):
     """
     This function checks for inconsistencies between allowance events, allowance backend, and payment schedule backend data.
@@ -85,53 +263,141 @@ def look_for_inconsistencies(**kwargs):
         'allowance_events' (str): URL to fetch allowance events data.
         'allowance_backend' (str): URL to fetch allowance backend data.
         'payment_schedule_backend' (str): URL to fetch payment schedule backend data.
+        'run_id' (str): Airflow run id, used to share the source snapshots between tasks.
+        'incremental' (bool, optional): Only validate the users changed since the previous run.
+        'state_dir' (str, optional): Directory holding the incremental state.
+        'violation_sample_size' (int, optional): Number of offending rows per check kept in the report.
+        'n_shards' (int, optional): Hash-partition the tables by user id and run steps 2 and 3 per shard in a process pool.
+        'max_workers' (int, optional): Number of processes used with n_shards. Defaults to the number of CPUs.
+        'replay' (bool, optional): Check the backend against the state replayed from all the events instead of the latest event only.
+        'memoize' (bool, optional): Reuse the report of a previous run with the same inputs and rules (see memo.py).
+            Incremental runs are never memoized.
+        'out_of_core' (bool, optional): Spill the tables to hash-partitioned runs on disk and run steps 2 and 3
+            one partition at a time, for tables larger than the memory of the worker (see out_of_core.py).
+        'memory_budget_mb' (int, optional): Memory available for a partition with out_of_core.
+        'history' (bool, optional): Only fail on the violations not found by the previous run (see violation_history.py).
+            Defaults to True unless ALLOWANCES_VIOLATION_HISTORY=0; incremental runs are not tracked.
+    Returns:
+    dict: The report (see violations.build_report), when the checks pass.
     Raises:
     ValueError: If any of 'allowance_events_url', 'allowance_backend_url', or 'payment_schedule_backend_url' are not provided.
+    violations.ViolationsError: If the checks find violations with 'error' severity (only new ones with history).
     Exception: If there is a critical error in fetching data or checking values.
     The function performs the following steps:
-    1. Fetches data from the provided URLs.
-    2. Checks values between allowance events and allowance backend data.
+    1. Fetches data from the provided URLs concurrently, or reads the snapshot of the current run.
+       Only the latest event of each user is kept while the events are streamed.
+    2. Checks values between allowance events and allowance backend data. With replay, every event of
+       each user is folded into the expected allowance state and every backend column is checked against it.
     3. Checks values between allowance backend and payment schedule backend data.
+    In incremental mode, steps 2 and 3 only run for the users changed since the previous run.
+    In out-of-core mode, step 1 spills the tables to disk by user id partition and steps 2 and 3
+    run one partition at a time.
+    4. Writes the offending rows of each check to the violation sink, pushes the per-check
+       counts and samples to XCom and raises a summary bounded to those samples.
     """
 
     from . import utils
+    from . import violations
     
     allowance_events_url = kwargs.get('allowance_events')
     allowance_backend_url = kwargs.get('allowance_backend')
     payment_schedule_backend_url = kwargs.get('payment_schedule_backend')
+    run_id = kwargs.get('run_id')
+    incremental = kwargs.get('incremental', False)
+    n_shards = kwargs.get('n_shards', 1)
+    replay = kwargs.get('replay', False)
+    out_of_core = kwargs.get('out_of_core', False)
 
     if not allowance_events_url or not allowance_backend_url or not payment_schedule_backend_url:
         raise ValueError("The 'allowance_events_url', 'allowance_backend_url', and 'payment_schedule_backend_url' must be provided")
 
+    if out_of_core and incremental:
+        logging.warning("Incremental runs only load the changed users, the out-of-core mode is not used")
+        out_of_core = False
+
     try:
-        allowance_events_df = utils.fetch_json_from_url(allowance_events_url)
-        allowance_backend_df = utils.get_csv_df(allowance_backend_url)
-        payment_schedule_backend_df = utils.get_csv_df(payment_schedule_backend_url)
+        sources = [(allowance_backend_url, 'allowance_backend'), (payment_schedule_backend_url, 'payment_schedule_backend')]
+        if incremental and replay:
+            logging.warning("The incremental state only keeps the latest event of each user, the replay check is skipped")
+        elif not incremental:
+            sources.append((allowance_events_url, 'json' if replay else 'json_latest'))
+        if not out_of_core:
+            snapshots = utils.get_snapshot_dfs(sources, run_id=run_id)
+            allowance_backend_df, payment_schedule_backend_df = snapshots[:2]
+            if not incremental:
+                allowance_events_df = snapshots[2]
     except Exception as e:
         logging.critical(f"Critical error in get data: {e}")
         raise
 
-    try:
-        errors_allowance = _check_values_allowance_backend(allowance_events_df, allowance_backend_df)
-    except Exception as e:
-        logging.critical(f"Critical error in check_values_allowance_backend: {e}")
-        raise
+    task_id = getattr(kwargs.get('ti'), 'task_id', 'look_for_inconsistencies')
+    sample_size = kwargs.get('violation_sample_size', violations.VIOLATION_SAMPLE_SIZE)
+    found = []
+    if out_of_core:
+        from . import out_of_core as out_of_core_checks
+        from . import sharding
 
-    try:
-        errors_payment = _check_values_payment_schedule_backend(allowance_backend_df, payment_schedule_backend_df)
-    except Exception as e:
-        logging.critical(f"Critical error in check_values_payment_schedule_backend: {e}")
-        raise
+        try:
+            found.extend(out_of_core_checks.run_partitioned_checks(
+                [(allowance_events_url, 'allowance_events'), (allowance_backend_url, 'allowance_backend'), (payment_schedule_backend_url, 'payment_schedule_backend')],
+                partial(sharding._check_shard, replay=replay),
+                run_id,
+                task_id,
+                kwargs.get('memory_budget_mb', out_of_core_checks.MEMORY_BUDGET_MB),
+                sample_size,
+            ))
+        except Exception as e:
+            logging.critical(f"Critical error in run_partitioned_checks: {e}")
+            raise
+    elif incremental:
+        from . import incremental_state
 
-    errors = []
-    errors.extend(errors_allowance)
-    errors.extend(errors_payment)
+        try:
+            found.extend(_check_values_incremental(
+                allowance_events_url,
+                allowance_backend_df,
+                payment_schedule_backend_df,
+                run_id,
+                kwargs.get('state_dir', incremental_state.STATE_DIR),
+                {table_name: utils.snapshot_version(url, table_name, run_id)
+                 for url, table_name in [(allowance_backend_url, 'allowance_backend'), (payment_schedule_backend_url, 'payment_schedule_backend')]},
+            ))
+        except Exception as e:
+            logging.critical(f"Critical error in check_values_incremental: {e}")
+            raise
+    elif n_shards > 1:
+        from . import sharding
 
-    if errors:
-        error_summary = "Errors found during execution:\n" + "\n".join(errors)
-        raise Exception(error_summary)
+        try:
+            found.extend(sharding.run_sharded_checks(
+                allowance_events_df,
+                allowance_backend_df,
+                payment_schedule_backend_df,
+                n_shards,
+                kwargs.get('max_workers'),
+                replay,
+            ))
+        except Exception as e:
+            logging.critical(f"Critical error in run_sharded_checks: {e}")
+            raise
     else:
-        logging.info("All checks passed successfully.")
+        try:
+            if replay:
+                found.extend(_check_values_replayed_state(allowance_events_df, allowance_backend_df))
+            else:
+                found.extend(_check_values_allowance_backend(allowance_events_df, allowance_backend_df))
+        except Exception as e:
+            logging.critical(f"Critical error in check_values_allowance_backend: {e}")
+            raise
+
+        try:
+            found.extend(_check_values_payment_schedule_backend(allowance_backend_df, payment_schedule_backend_df))
+        except Exception as e:
+            logging.critical(f"Critical error in check_values_payment_schedule_backend: {e}")
+            raise
+
+    report = violations.build_report(found, run_id, task_id, ti=kwargs.get('ti'), sample_size=sample_size)
+    return violations.raise_for_errors(report, sample_size)
 
 
 if __name__ == "__main__":
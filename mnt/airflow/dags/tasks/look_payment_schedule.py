@@ -1,6 +1,10 @@
 import logging
-import pandas as pd
 
+from . import instrumentation
+from . import memo
+from . import violation_history
+
+@instrumentation.instrumented()
 def _check_values_payment_schedule_backend(payment_schedule_backend_df):
     """
     Checks for various data quality issues in the payment schedule backend DataFrame.
@@ -9,47 +13,23 @@ def _check_values_payment_schedule_backend(payment_schedule_backend_df):
         payment_schedule_backend_df (pd.DataFrame): DataFrame containing the payment schedule backend data.
     
     Returns:
-        list: A list of error messages indicating any data quality issues found.
-    The function performs the following checks:
-    1. Null Values: Checks for columns containing null values and logs a warning for each column with null values.
-    2. Duplicate Values: Checks for duplicate user IDs and logs a warning if any duplicates are found.
-    3. Invalid Payment Dates: Checks for payment dates that are not within the valid range (1 to 31) and logs a warning if any invalid dates are found.
-    If any exceptions occur during the checks, they are caught and logged as errors.
+        list: The violations found (see violations.make_violation), with the offending rows.
+    The checks are declared in config/rules_config.py (rules_dict['payment_schedule_backend'])
+    and evaluated in a single pass over the columns:
+    1. Null Values: Checks for columns containing null values.
+    2. Duplicate Values: Checks for duplicate user IDs.
+    3. Invalid Payment Dates: Checks for payment dates that are not within the valid range (1 to 31).
+    A rule that raises an exception is reported as a violation with its error instead of stopping the other checks.
     """
-    
-    errors = []
-    try:
-        null_counts = payment_schedule_backend_df.isnull().sum()
-        for column, count in null_counts.items():
-            if count > 0:
-                error_message = f"Column '{column}' contains {count} null values."
-                errors.append(error_message)
-    except Exception as e:
-        errors.append(f"Error during null value check: {str(e)}")
-        logging.error(e)
-
-    try:
-        grouped  = payment_schedule_backend_df.groupby('user_id').size()
-        duplicate_values = grouped[grouped > 1]
-        
-        if not duplicate_values.empty:
-            error_message = f"The 'payment_schedule_backend' table has duplicate values: \n{duplicate_values}"
-            errors.append(error_message)
-    except Exception as e:
-        errors.append(f"Error during duplicate value check: {str(e)}")
-        logging.error(e)
 
-    try:
-        invalid_payment_date = payment_schedule_backend_df[(payment_schedule_backend_df['payment_date'] < 1) | (payment_schedule_backend_df['payment_date'] > 31)]
-        if not invalid_payment_date.empty:
-            error_message = f"The 'payment_schedule_backend' table has invalid payment dates: \n{invalid_payment_date}"
-            errors.append(error_message)
-    except Exception as e:
-        errors.append(f"Error during invalid payment date check: {str(e)}")
-        logging.error(e)
+    from config.rules_config import rules_dict
+    from . import rules
 
-    return errors
+    return rules.check_rules('payment_schedule_backend', payment_schedule_backend_df, rules_dict['payment_schedule_backend'])
 
+@instrumentation.instrumented_task('look_payment_schedule')
+@violation_history.tracked('look_payment_schedule')
+@memo.memoized('look_payment_schedule', ['payment_schedule_backend'], ['violation_sample_size'])
 def look_for_inconsistencies(**kwargs):
     """
     This function checks for inconsistencies in the payment schedule data.
@@ -57,45 +37,77 @@ def look_for_inconsistencies(**kwargs):
     Args:
         **kwargs: Arbitrary keyword arguments. Expected to contain:
             - payment_schedule_backend (str): URL to the payment schedule backend CSV file.
+            - run_id (str, optional): Airflow run id, used to share the source snapshot between tasks.
+            - violation_sample_size (int, optional): Number of offending rows per rule kept in the report.
+            - memoize (bool, optional): Reuse the report of a previous run with the same inputs and rules (see memo.py).
+            - out_of_core (bool, optional): Spill the table to disk by user id partition and run the checks
+              one partition at a time, within memory_budget_mb (see out_of_core.py).
+            - history (bool, optional): Only fail on the violations not found by the previous run (see violation_history.py).
     
+    Returns:
+        dict: The report (see violations.build_report), when the checks pass.
+
     Raises:
         ValueError: If 'payment_schedule_backend_url' is not provided in kwargs.
+        violations.ViolationsError: If the checks find violations with 'error' severity (only new ones with history).
         Exception: If there is an error in extracting data to bronze or checking values in the payment schedule backend.
     
     The function performs the following steps:
         1. Imports necessary utilities from the config module.
         2. Retrieves the allowance backend URL from kwargs.
         3. Raises a ValueError if the URL is not provided.
-        4. Attempts to read the CSV data from the provided URL into a DataFrame.
+        4. Attempts to read the CSV data from the snapshot of the current run, or from the provided URL, into a DataFrame.
         5. Logs and raises any exceptions encountered during the data extraction.
         6. Checks for inconsistencies in the allowance backend data.
         7. Logs and raises any exceptions encountered during the inconsistency check.
+        8. Writes the offending rows of each rule to the violation sink, pushes the per-rule
+           counts and samples to XCom and raises a summary bounded to those samples.
     """
 
     from . import utils
+    from . import violations
     
     payment_schedule_backend_url = kwargs.get('payment_schedule_backend')
+    run_id = kwargs.get('run_id')
 
     if not payment_schedule_backend_url:
         raise ValueError("The 'payment_schedule_backend_url' must be provided")
 
+    task_id = getattr(kwargs.get('ti'), 'task_id', 'look_payment_schedule')
+    sample_size = kwargs.get('violation_sample_size', violations.VIOLATION_SAMPLE_SIZE)
+
+    if kwargs.get('out_of_core', False):
+        from . import out_of_core
+
+        try:
+            found = out_of_core.run_partitioned_checks(
+                [(payment_schedule_backend_url, 'payment_schedule_backend')],
+                _check_values_payment_schedule_backend,
+                run_id,
+                task_id,
+                kwargs.get('memory_budget_mb', out_of_core.MEMORY_BUDGET_MB),
+                sample_size,
+            )
+        except Exception as e:
+            logging.critical(f"Critical error in run_partitioned_checks: {e}")
+            raise
+        report = violations.build_report(found, run_id, task_id, ti=kwargs.get('ti'), sample_size=sample_size)
+        return violations.raise_for_errors(report, sample_size)
+
     try:
-        payment_schedule_backend_df = utils.get_csv_df(payment_schedule_backend_url)
+        payment_schedule_backend_df = utils.get_snapshot_df(payment_schedule_backend_url, 'payment_schedule_backend', run_id=run_id)
     except Exception as e:
         logging.critical(f"Critical error in extract_data_to_bronze: {e}")
         raise
 
     try:
-        errors = _check_values_payment_schedule_backend(payment_schedule_backend_df)
+        found = _check_values_payment_schedule_backend(payment_schedule_backend_df)
     except Exception as e:
         logging.critical(f"Critical error in check_values_allowance_backend: {e}")
         raise
 
-    if errors:
-        error_summary = "Errors found during execution:\n" + "\n".join(errors)
-        raise Exception(error_summary)
-    else:
-        logging.info("All checks passed successfully.")
+    report = violations.build_report(found, run_id, task_id, ti=kwargs.get('ti'), sample_size=sample_size)
+    return violations.raise_for_errors(report, sample_size)
 
 
 if __name__ == "__main__":
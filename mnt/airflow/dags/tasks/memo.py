@@ -0,0 +1,206 @@
+import functools
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from datetime import datetime
+
+from . import downloads
+from . import instrumentation
+
+MEMO_DIR = os.environ.get(
+    "ALLOWANCES_MEMO_DIR",
+    os.path.join(tempfile.gettempdir(), "allowances_memo"),
+)
+MEMO_RETENTION_DAYS = int(os.environ.get("ALLOWANCES_MEMO_RETENTION_DAYS", "7"))
+MEMO_ENABLED = os.environ.get("ALLOWANCES_MEMO", "1") == "1"
+
+_DAGS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Code whose changes can change the result of a check
+FINGERPRINT_DIRS = ["tasks", "config"]
+
+@functools.lru_cache(maxsize=None)
+def rules_fingerprint():
+    """
+    Computes the version fingerprint of the checks: the declared rules and the code that evaluates them.
+
+    Returns:
+        str: Hex digest of the rules of config/rules_config.py and of the source
+            files of the tasks and config packages.
+    """
+    from config.rules_config import rules_dict
+
+    fingerprint = hashlib.sha256(json.dumps(rules_dict, sort_keys=True, default=str).encode("utf-8"))
+    for directory in FINGERPRINT_DIRS:
+        source_dir = os.path.join(_DAGS_DIR, directory)
+        for file_name in sorted(os.listdir(source_dir)):
+            if file_name.endswith(".py"):
+                fingerprint.update(file_name.encode("utf-8"))
+                with open(os.path.join(source_dir, file_name), "rb") as source_file:
+                    fingerprint.update(source_file.read())
+    return fingerprint.hexdigest()
+
+def memo_key(task_id, input_hashes, params):
+    """
+    Builds the key of a task result from everything it depends on.
+
+    Args:
+        task_id (str): Name of the task.
+        input_hashes (dict): Content hash of each input, by URL.
+        params (dict): The task arguments that change the result.
+
+    Returns:
+        str: Hex digest identifying the result.
+    """
+    content = json.dumps({
+        "task_id": task_id,
+        "rules": rules_fingerprint(),
+        "inputs": input_hashes,
+        "params": params,
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:32]
+
+def _memo_path(key, memo_dir):
+    """
+    Returns the path of a memoized result.
+
+    Args:
+        key (str): The key returned by memo_key.
+        memo_dir (str): Directory of the memoized results.
+
+    Returns:
+        str: Path of the JSON file of the result.
+    """
+    return os.path.join(memo_dir, f"{key}.json")
+
+def lookup(key, memo_dir=MEMO_DIR):
+    """
+    Reads a memoized result.
+
+    Args:
+        key (str): The key returned by memo_key.
+        memo_dir (str, optional): Directory of the memoized results.
+
+    Returns:
+        dict: The memoized result, with the keys 'key', 'run_id', 'created_at' and
+            'report', or None if there is none or it is corrupted.
+    """
+    try:
+        with open(_memo_path(key, memo_dir)) as memo_file:
+            return json.load(memo_file)
+    except (OSError, ValueError):
+        return None
+
+def store(key, run_id, report, memo_dir=MEMO_DIR):
+    """
+    Memoizes the report of a task, through a temporary file so readers never see a partial file.
+
+    Args:
+        key (str): The key returned by memo_key.
+        run_id (str): The Airflow run id that computed the report.
+        report (dict): The report (see violations.build_report).
+        memo_dir (str, optional): Directory of the memoized results.
+    """
+    os.makedirs(memo_dir, exist_ok=True)
+    path = _memo_path(key, memo_dir)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as memo_file:
+        json.dump({"key": key, "run_id": run_id, "created_at": datetime.now().isoformat(), "report": report}, memo_file, default=str)
+    os.replace(tmp_path, path)
+    _purge_old_results(memo_dir)
+
+def _purge_old_results(memo_dir):
+    """
+    Removes the memoized results older than MEMO_RETENTION_DAYS.
+
+    Args:
+        memo_dir (str): Directory of the memoized results.
+    """
+    limit = datetime.now().timestamp() - MEMO_RETENTION_DAYS * 24 * 60 * 60
+    for file_name in os.listdir(memo_dir):
+        file_path = os.path.join(memo_dir, file_name)
+        try:
+            if os.path.getmtime(file_path) < limit:
+                os.remove(file_path)
+        except OSError as e:
+            logging.warning(f"Could not remove old memoized result {file_path}: {e}")
+
+def _replay_report(memoized, kwargs):
+    """
+    Returns a memoized report as the result of the current run: it is pushed to XCom
+    and fails the task like the original run did.
+
+    Args:
+        memoized (dict): The memoized result returned by lookup.
+        kwargs (dict): The task arguments.
+
+    Returns:
+        dict: The report, when it has no errors.
+
+    Raises:
+        violations.ViolationsError: If the report has violations with 'error' severity.
+    """
+    from . import violations
+
+    report = dict(memoized["report"], run_id=kwargs.get("run_id"), memoized_from=memoized["run_id"])
+    ti = kwargs.get("ti")
+    if ti is not None:
+        ti.xcom_push(key="violations", value=report)
+    logging.info(f"Inputs and rules unchanged since run {memoized['run_id']}, reusing its result")
+    return violations.raise_for_errors(report, kwargs.get("violation_sample_size", violations.VIOLATION_SAMPLE_SIZE))
+
+def memoized(task_id, sources, params=(), resolved_params=None):
+    """
+    Decorator memoizing the report of a look_* task by the content of its inputs,
+    the rule set fingerprint and its parameters.
+
+    Before the task runs, its sources are downloaded (conditionally, see
+    downloads.download_source) to get the SHA-256 of their content. When a previous
+    run had the same inputs, rules and parameters, its report is returned, or raised,
+    right away without parsing or validating anything, so Airflow retries and
+    re-runs cost a conditional GET per source. Otherwise the task runs and its
+    report is memoized, whether the checks pass or find errors. Exceptions other
+    than violations are not memoized.
+
+    Incremental runs depend on the state of the previous runs and are never
+    memoized. The 'memoize' argument (or ALLOWANCES_MEMO=0) disables the memoization.
+
+    Args:
+        task_id (str): Name of the task.
+        sources (list): Names of the arguments holding the source URLs.
+        params (list, optional): Names of the arguments that change the result.
+        resolved_params (dict, optional): Functions computing, from the task arguments,
+            the values that change the result but are not given as-is (e.g. a run date
+            that defaults to today), by name.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(**kwargs):
+            from . import violations
+
+            urls = [kwargs.get(source) for source in sources]
+            if not kwargs.get("memoize", MEMO_ENABLED) or kwargs.get("incremental") or not all(urls):
+                return function(**kwargs)
+
+            memo_dir = kwargs.get("memo_dir", MEMO_DIR)
+            with instrumentation.stage("memo_lookup") as record:
+                downloaded = downloads.download_sources(urls)
+                input_hashes = {url: download["sha256"] for url, download in downloaded.items()}
+                key_params = {param: kwargs.get(param) for param in params}
+                key_params.update({name: resolve(kwargs) for name, resolve in (resolved_params or {}).items()})
+                key = memo_key(task_id, input_hashes, key_params)
+                memoized_result = lookup(key, memo_dir)
+                record["hit"] = memoized_result is not None
+            if memoized_result is not None:
+                return _replay_report(memoized_result, kwargs)
+
+            try:
+                report = function(**kwargs)
+            except violations.ViolationsError as e:
+                store(key, kwargs.get("run_id"), e.report, memo_dir)
+                raise
+            store(key, kwargs.get("run_id"), report, memo_dir)
+            return report
+        return wrapper
+    return decorator
@@ -0,0 +1,250 @@
+"""
+Runs the checks of the look_* tasks on sources larger than the memory of the worker.
+
+The sources are read in chunks of bounded size and every chunk is hash-partitioned
+by user id (see sharding.shard_ids) into Arrow IPC runs spilled to local disk. The
+checks then run partition by partition: the rows of a same user are all in the same
+partition, whatever the table, so the joins, the replay of the events and the
+duplicate checks of a partition give the same result as on the whole tables. The
+number of partitions is chosen so that a partition fits in the memory budget.
+"""
+import logging
+import math
+import os
+import shutil
+import tempfile
+
+import pandas as pd
+import pyarrow as pa
+
+from . import instrumentation
+from . import keys
+
+SPILL_DIR = os.environ.get(
+    "ALLOWANCES_SPILL_DIR",
+    os.path.join(tempfile.gettempdir(), "allowances_spill"),
+)
+MEMORY_BUDGET_MB = int(os.environ.get("ALLOWANCES_MEMORY_BUDGET_MB", "2048"))
+MAX_CHUNK_ROWS = int(os.environ.get("ALLOWANCES_SPILL_CHUNK_ROWS", "200000"))
+MIN_CHUNK_ROWS = 1000
+# Memory used by the checks of a partition per byte of source data: the parsed
+# frames with their key columns, the sorted copies and the joined frames
+MEMORY_PER_SOURCE_BYTE = 6
+# Memory used per row of a chunk being parsed and spilled: the decoded JSON records,
+# the DataFrame and its Arrow copy (about 1.2 KB measured on the events, the widest source)
+MEMORY_PER_CHUNK_ROW = 2048
+# Suffix of the spilled column holding the raw values of a timestamp column that could not be parsed
+RAW_SUFFIX = "__raw"
+
+KEY_COLUMNS = {
+    "allowance_events": "user_id",
+    "allowance_backend": "uuid",
+    "payment_schedule_backend": "user_id",
+}
+
+def partition_count(source_bytes, memory_budget_mb=MEMORY_BUDGET_MB):
+    """
+    Computes the number of partitions needed for the checks of a partition to fit in the memory budget.
+
+    Args:
+        source_bytes (int): Total size of the sources on disk.
+        memory_budget_mb (int, optional): Memory available for the checks, in MB.
+
+    Returns:
+        int: The number of partitions, at least 1.
+    """
+    return max(1, math.ceil(source_bytes * MEMORY_PER_SOURCE_BYTE / (memory_budget_mb * 1024 * 1024)))
+
+def chunk_rows_for(memory_budget_mb=MEMORY_BUDGET_MB):
+    """
+    Computes the number of rows read at a time while spilling, for a chunk to fit in the memory budget.
+
+    Args:
+        memory_budget_mb (int, optional): Memory available, in MB.
+
+    Returns:
+        int: The number of rows, between MIN_CHUNK_ROWS and MAX_CHUNK_ROWS.
+    """
+    return int(min(MAX_CHUNK_ROWS, max(MIN_CHUNK_ROWS, memory_budget_mb * 1024 * 1024 // MEMORY_PER_CHUNK_ROW)))
+
+def _arrow_schema(table_name):
+    """
+    Returns the schema of the spilled runs of a table, so every chunk is written with the same types.
+
+    Args:
+        table_name (str): 'allowance_events' or a table of utils.TABLE_SCHEMAS.
+
+    Returns:
+        pyarrow.Schema: The schema, with the key columns of the user id.
+    """
+    from . import utils
+
+    if table_name == "allowance_events":
+        fields = [(name, pa.float64() if name == "allowance_amount" else pa.string()) for name, _ in utils.ALLOWANCE_EVENT_FIELDS]
+    else:
+        schema = utils.TABLE_SCHEMAS[table_name]
+        fields = []
+        for column, dtype in schema["dtypes"].items():
+            if column in schema["timestamp_columns"]:
+                fields.extend([(column, pa.int64()), (f"{column}{RAW_SUFFIX}", pa.string())])
+            else:
+                fields.append((column, pa.int32() if dtype == "Int32" else pa.string()))
+    fields.extend((column, pa.uint64()) for column in keys.key_columns(KEY_COLUMNS[table_name]))
+    return pa.schema(fields)
+
+def _iter_source_chunks(path, table_name, chunk_rows):
+    """
+    Reads a downloaded source in chunks of at most chunk_rows rows.
+
+    Args:
+        path (str): Path of the downloaded source.
+        table_name (str): 'allowance_events' or a table of utils.TABLE_SCHEMAS.
+        chunk_rows (int): Maximum number of rows per chunk.
+
+    Yields:
+        pd.DataFrame: Each chunk, with the raw values of its unparseable timestamps
+            in the RAW_SUFFIX columns.
+    """
+    from . import utils
+
+    with open(path, "rb") as stream:
+        if table_name == "allowance_events":
+            yield from utils.iter_allowance_event_chunks(utils._iter_stream_chunks(stream), chunk_rows)
+            return
+        for chunk, unparseable in utils.iter_backend_chunks(stream, table_name, chunk_rows):
+            for column, raw_values in unparseable.items():
+                chunk[f"{column}{RAW_SUFFIX}"] = raw_values.reindex(chunk.index)
+            for column, dtype in utils.TABLE_SCHEMAS[table_name]["dtypes"].items():
+                if dtype == "category":
+                    chunk[column] = chunk[column].astype(object)
+            yield chunk
+
+def spill_source(path, table_name, n_partitions, spill_dir, chunk_rows=MAX_CHUNK_ROWS):
+    """
+    Hash-partitions a source by user id into one Arrow IPC run per partition.
+
+    Only one chunk of the source is in memory at a time. The rows keep the order of
+    the source within a partition, so the events of a user are replayed in order.
+
+    Args:
+        path (str): Path of the downloaded source.
+        table_name (str): 'allowance_events' or a table of utils.TABLE_SCHEMAS.
+        n_partitions (int): Number of partitions.
+        spill_dir (str): Directory of the runs.
+        chunk_rows (int, optional): Maximum number of rows read at a time.
+
+    Returns:
+        list: The path of the run of each partition.
+    """
+    from . import sharding
+
+    key_column = KEY_COLUMNS[table_name]
+    high_column, low_column = keys.key_columns(key_column)
+    schema = _arrow_schema(table_name)
+    paths = [os.path.join(spill_dir, f"{table_name}.{partition}.arrow") for partition in range(n_partitions)]
+    writers = [pa.ipc.new_stream(partition_path, schema) for partition_path in paths]
+    try:
+        for chunk in _iter_source_chunks(path, table_name, chunk_rows):
+            chunk[high_column], chunk[low_column] = keys.encode_uuids(chunk[key_column])
+            for writer, rows in zip(writers, sharding.shard_frame(chunk, key_column, n_partitions)):
+                if len(rows):
+                    writer.write_table(pa.Table.from_pandas(rows, schema=schema, preserve_index=False, safe=False))
+    finally:
+        for writer in writers:
+            writer.close()
+    return paths
+
+def read_partition(path, table_name):
+    """
+    Reads the run of a partition into a DataFrame typed like the in-memory loaders
+    (see utils.read_allowance_events and utils.read_backend_table), sorted by key.
+
+    Args:
+        path (str): Path of the run.
+        table_name (str): 'allowance_events' or a table of utils.TABLE_SCHEMAS.
+
+    Returns:
+        pd.DataFrame: The rows of the partition.
+    """
+    from . import timestamps
+    from . import utils
+
+    with pa.memory_map(path, "r") as source:
+        table = pa.ipc.open_stream(source).read_all()
+    df = table.to_pandas(types_mapper={pa.int32(): pd.Int32Dtype(), pa.int64(): pd.Int64Dtype()}.get)
+    key_column = KEY_COLUMNS[table_name]
+    df = df.take(keys.sort_order(keys.sortable_keys(df, key_column))).reset_index(drop=True)
+    if table_name == "allowance_events":
+        return df
+
+    schema = utils.TABLE_SCHEMAS[table_name]
+    for column, dtype in schema["dtypes"].items():
+        if dtype == "category":
+            df[column] = df[column].astype("category")
+    for column in schema["small_int_columns"]:
+        df[column] = utils._downcast_small_int(df[column])
+    for column in schema["timestamp_columns"]:
+        raw_values = df.pop(f"{column}{RAW_SUFFIX}")
+        timestamps.record_unparseable(df, column, raw_values, raw_values.notna().to_numpy())
+    return df
+
+def run_partitioned_checks(sources, check, run_id, task_id, memory_budget_mb=MEMORY_BUDGET_MB,
+                           sample_size=None, spill_dir=SPILL_DIR, chunk_rows=None):
+    """
+    Runs checks on sources that do not fit in memory, one partition at a time.
+
+    The sources are downloaded, spilled to hash-partitioned runs (see spill_source) and
+    the check is called with the frames of each partition. The offending rows of each
+    partition are written to the violation sink right away, so only their samples stay
+    in memory (see violations.spill_rows). The runs are removed at the end.
+
+    Args:
+        sources (list): (url, table_name) tuples, table_name being 'allowance_events'
+            or a table of utils.TABLE_SCHEMAS.
+        check (callable): Called with the frames of a partition, in the order of the
+            sources; returns the violations found (see violations.make_violation).
+        run_id (str): The Airflow run id.
+        task_id (str): Name of the task, used for the violation sink.
+        memory_budget_mb (int, optional): Memory available for the checks of a partition, in MB.
+        sample_size (int, optional): Number of offending rows per rule kept in memory.
+        spill_dir (str, optional): Directory of the runs.
+        chunk_rows (int, optional): Maximum number of rows read at a time. Defaults to
+            the number of rows that fit in the memory budget (see chunk_rows_for).
+
+    Returns:
+        list: The violations of every partition, merged (see violations.merge_violations).
+
+    Raises:
+        requests.RequestException: If the download of a source fails.
+    """
+    from . import downloads
+    from . import violations
+
+    sample_size = sample_size or violations.VIOLATION_SAMPLE_SIZE
+    chunk_rows = chunk_rows or chunk_rows_for(memory_budget_mb)
+    with instrumentation.stage("download_sources"):
+        downloaded = downloads.download_sources([url for url, _ in sources])
+    source_bytes = sum(os.path.getsize(download["path"]) for download in downloaded.values())
+    n_partitions = partition_count(source_bytes, memory_budget_mb)
+    logging.info(f"Checking {source_bytes} bytes of sources in {n_partitions} partitions of chunks of "
+                 f"{chunk_rows} rows with a memory budget of {memory_budget_mb} MB")
+
+    os.makedirs(spill_dir, exist_ok=True)
+    run_dir = tempfile.mkdtemp(prefix=f"{violations._safe_name(run_id)}-{task_id}-", dir=spill_dir)
+    sink = violations.open_sink(run_id or "manual", task_id)
+    try:
+        with instrumentation.stage("spill_partitions", partitions=n_partitions):
+            runs = [spill_source(downloaded[url]["path"], table_name, n_partitions, run_dir, chunk_rows) for url, table_name in sources]
+
+        partial_results = []
+        with instrumentation.stage("partition_checks", partitions=n_partitions) as record:
+            for partition in range(n_partitions):
+                frames = [read_partition(paths[partition], table_name) for (_, table_name), paths in zip(sources, runs)]
+                partial_results.append(violations.spill_rows(check(*frames), sink, sample_size))
+                del frames
+            found = violations.merge_violations(partial_results)
+            record["rows_out"] = sum(violation["count"] for violation in found)
+    finally:
+        sink.close()
+        shutil.rmtree(run_dir, ignore_errors=True)
+    return found
@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+
+WEEKDAYS = {
+    'monday': 0,
+    'tuesday': 1,
+    'wednesday': 2,
+    'thursday': 3,
+    'friday': 4,
+    'saturday': 5,
+    'sunday': 6,
+}
+MONTH_DAYS = {
+    'first_day': 1,
+    'fifteenth_day': 15,
+}
+DAILY = 'daily'
+BIWEEKLY = 'biweekly'
+
+# 1970-01-01, day 0 of datetime64[D], was a Thursday
+_EPOCH_WEEKDAY = 3
+
+def _lookup(values, mapping, default=-1):
+    """
+    Maps the values of a column to integers.
+
+    Only the distinct values are mapped (the categories of categorical columns),
+    and the result is taken back to the rows through their codes.
+
+    Args:
+        values (pd.Series): The column.
+        mapping (dict): The integer of each known value.
+        default (int, optional): The integer of the unknown and null values.
+
+    Returns:
+        np.ndarray: The integer of each row.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes, uniques = values.cat.codes.to_numpy(), values.cat.categories
+    else:
+        codes, uniques = pd.factorize(values)
+    mapped = np.array([mapping.get(value, default) for value in uniques] + [default], dtype=np.int64)
+    return mapped[codes]
+
+def next_payment_dates(frequency, day, as_of):
+    """
+    Computes the date of the next payment of every allowance at once.
+
+    The rules are the ones of the exploratory analysis: 'daily' allowances are paid
+    the day after as_of, 'first_day'/'fifteenth_day' allowances on the next 1st/15th
+    of a month after as_of, and weekday allowances on the next occurrence of the
+    weekday strictly after as_of, one week later for 'biweekly' allowances.
+
+    Args:
+        frequency (pd.Series): The allowance frequencies.
+        day (pd.Series): The allowance days.
+        as_of (str, datetime or np.datetime64): The reference date (the run date).
+
+    Returns:
+        np.ndarray: The next payment dates (datetime64[D]), NaT for unknown days.
+    """
+    as_of = np.datetime64(pd.Timestamp(as_of).date(), 'D')
+    weekday = _lookup(day, WEEKDAYS)
+    month_day = _lookup(day, MONTH_DAYS)
+    daily = _lookup(day, {DAILY: 1}, default=0).astype(bool)
+    biweekly = _lookup(frequency, {BIWEEKLY: 1}, default=0).astype(bool)
+
+    as_of_weekday = (as_of.astype(np.int64) + _EPOCH_WEEKDAY) % 7
+    days_until = (weekday - as_of_weekday + 7) % 7
+    days_until[days_until == 0] = 7
+    days_until += 7 * biweekly
+    result = as_of + days_until.astype('timedelta64[D]')
+
+    month_start = as_of.astype('datetime64[M]')
+    this_month = month_start.astype('datetime64[D]') + (month_day - 1).astype('timedelta64[D]')
+    next_month = (month_start + 1).astype('datetime64[D]') + (month_day - 1).astype('timedelta64[D]')
+    monthly_dates = np.where(this_month > as_of, this_month, next_month)
+
+    result = np.where(month_day > 0, monthly_dates, result)
+    result = np.where(daily, as_of + 1, result)
+    result[(weekday < 0) & (month_day < 0) & ~daily] = np.datetime64('NaT')
+    return result
+
+def expected_next_payment_day(frequency, day, as_of):
+    """
+    Computes the expected day of month of the next payment of every allowance.
+
+    Args:
+        frequency (pd.Series): The allowance frequencies.
+        day (pd.Series): The allowance days.
+        as_of (str, datetime or np.datetime64): The reference date (the run date).
+
+    Returns:
+        pd.Series: The expected day of month (Int32), null for unknown days.
+    """
+    dates = next_payment_dates(frequency, day, as_of)
+    unknown = np.isnat(dates)
+    days = (dates - dates.astype('datetime64[M]')).astype('timedelta64[D]').astype(np.int64) + 1
+    days[unknown] = 0
+    return pd.Series(pd.arrays.IntegerArray(days.astype(np.int32), unknown), index=day.index)
@@ -0,0 +1,327 @@
+"""
+PostgreSQL connectors: the backend tables are exported with COPY ... TO STDOUT and the
+offending rows are bulk-loaded with COPY ... FROM STDIN, over a connection pool
+shared by the tasks of the process. No row is fetched or inserted one at a time.
+
+A source is a postgres URL naming the table to export, e.g.
+postgresql://airflow@postgres:5432/backend?table=public.allowance_backend&sslmode=require.
+The other query parameters are passed to libpq. Prefer PGPASSWORD or a .pgpass file
+to a password in the URL, which is written to the task logs.
+"""
+import hashlib
+import io
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import psycopg2
+from psycopg2 import pool, sql
+
+POOL_MIN_CONNECTIONS = 1
+POOL_MAX_CONNECTIONS = int(os.environ.get("ALLOWANCES_PG_POOL_SIZE", "10"))
+COPY_BUFFER_SIZE = 1024 * 1024
+VIOLATIONS_TABLE = os.environ.get("ALLOWANCES_VIOLATIONS_TABLE", "allowance_violations")
+
+# Connection pools of the process, by DSN
+_pools = {}
+_pools_lock = threading.Lock()
+
+def parse_source_url(url):
+    """
+    Splits a Postgres source URL into the connection string and the table to export.
+
+    Args:
+        url (str): The source URL, with a 'table' query parameter.
+
+    Returns:
+        tuple: The libpq connection URI (str) and the table name (str, optionally schema-qualified).
+
+    Raises:
+        ValueError: If the URL has no 'table' parameter.
+    """
+    parts = urlsplit(url)
+    params = parse_qsl(parts.query, keep_blank_values=True)
+    tables = [value for name, value in params if name == "table"]
+    if not tables:
+        raise ValueError(f"The Postgres source {redact(url)} must name a table, e.g. ?table=public.allowance_backend")
+    query = urlencode([(name, value) for name, value in params if name != "table"])
+    return urlunsplit(parts._replace(query=query)), tables[0]
+
+def redact(url):
+    """
+    Hides the password of a Postgres URL, for the logs.
+
+    Args:
+        url (str): The URL.
+
+    Returns:
+        str: The URL without its password.
+    """
+    parts = urlsplit(url)
+    if parts.password is None:
+        return url
+    return urlunsplit(parts._replace(netloc=parts.netloc.replace(f":{parts.password}@", ":***@", 1)))
+
+def get_pool(dsn):
+    """
+    Returns the connection pool of a database, shared by the tasks of the process.
+
+    A pool is never shared with a forked child process (see runner.py and sharding.py):
+    the child opens its own connections.
+
+    Args:
+        dsn (str): The libpq connection URI.
+
+    Returns:
+        psycopg2.pool.ThreadedConnectionPool: The pool.
+    """
+    with _pools_lock:
+        key = (os.getpid(), dsn)
+        if key not in _pools:
+            _pools[key] = pool.ThreadedConnectionPool(POOL_MIN_CONNECTIONS, POOL_MAX_CONNECTIONS, dsn)
+        return _pools[key]
+
+@contextmanager
+def connection(dsn):
+    """
+    Borrows a connection from the pool of a database. The transaction is committed
+    when the block succeeds and rolled back when it raises.
+
+    Args:
+        dsn (str): The libpq connection URI.
+
+    Yields:
+        psycopg2.extensions.connection: The connection.
+    """
+    connection_pool = get_pool(dsn)
+    conn = connection_pool.getconn()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        connection_pool.putconn(conn, close=bool(conn.closed))
+
+def _table_identifier(table):
+    """
+    Quotes a table name, optionally schema-qualified.
+
+    Args:
+        table (str): The table name, e.g. 'public.allowance_backend'.
+
+    Returns:
+        psycopg2.sql.Composed: The quoted name.
+    """
+    return sql.SQL(".").join(sql.Identifier(part) for part in table.split("."))
+
+class _HashingWriter:
+    """
+    File-like object passing the COPY output to a file and hashing it on the way.
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self.content_hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.output.write(data)
+        self.content_hash.update(data)
+        self.size += len(data)
+
+def copy_table_to(url, output):
+    """
+    Exports a Postgres table as CSV with a header, streamed by COPY ... TO STDOUT.
+
+    The CSV is the format of the gist sources, so the export is read by the typed
+    loader of the table (see utils.read_backend_table) like any other source.
+
+    Args:
+        url (str): The source URL (see parse_source_url).
+        output (file-like): Binary file the CSV is written to.
+
+    Returns:
+        hashlib._Hash: The running SHA-256 of the CSV.
+
+    Raises:
+        ValueError: If the URL has no 'table' parameter.
+        psycopg2.Error: If the export fails.
+    """
+    dsn, table = parse_source_url(url)
+    writer = _HashingWriter(output)
+    query = sql.SQL("COPY {} TO STDOUT WITH (FORMAT csv, HEADER true)").format(_table_identifier(table))
+    try:
+        with connection(dsn) as conn:
+            with conn.cursor() as cursor:
+                cursor.copy_expert(query, writer, size=COPY_BUFFER_SIZE)
+    except psycopg2.Error as e:
+        logging.error(f"Failed to export {table} from {redact(dsn)}: {e}")
+        raise
+    return writer.content_hash
+
+def _copy_text(value):
+    """
+    Escapes a value for the text format of COPY.
+
+    Args:
+        value (str): The value.
+
+    Returns:
+        str: The value with backslashes, tabs and line breaks escaped.
+    """
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+class PostgresViolationSink:
+    """
+    Writes the offending rows of each rule to a Postgres table, one JSONB row per offending
+    row, in batches of violations.SINK_BATCH_SIZE loaded with COPY ... FROM STDIN.
+
+    Has the interface of violations.ViolationSink. Each write is its own transaction; the
+    rows of a previous attempt of the same run, task and rule are replaced. Unless clear
+    is False, the rows of a previous attempt of the run and task are removed when the
+    sink is opened, so a retry leaves no row of the rules that no longer fire.
+    """
+
+    def __init__(self, run_id, task_id, dsn, table=VIOLATIONS_TABLE, clear=True):
+        self.run_id = str(run_id)
+        self.task_id = str(task_id)
+        self.dsn = dsn
+        self.table = table
+        self._table_ready = False
+        self.paths = {}
+        if clear:
+            self._clear()
+
+    def _clear(self):
+        """
+        Deletes the rows of the run and task. Failures are logged: the rows of the rules
+        that fire again are still replaced by their first write.
+        """
+        try:
+            with connection(self.dsn) as conn:
+                with conn.cursor() as cursor:
+                    self._create_table(cursor)
+                    cursor.execute(
+                        sql.SQL("DELETE FROM {} WHERE run_id = %s AND task_id = %s").format(_table_identifier(self.table)),
+                        (self.run_id, self.task_id),
+                    )
+            self._table_ready = True
+        except psycopg2.Error as e:
+            logging.warning(f"Could not remove the violations of a previous attempt from {redact(self.dsn)}: {e}")
+
+    def _create_table(self, cursor):
+        """
+        Creates the violations table and its index if they do not exist.
+
+        Args:
+            cursor (psycopg2.extensions.cursor): Cursor of the current transaction.
+        """
+        cursor.execute(sql.SQL(
+            "CREATE TABLE IF NOT EXISTS {} ("
+            "run_id text NOT NULL, task_id text NOT NULL, rule text NOT NULL, "
+            "row_data jsonb NOT NULL, created_at timestamptz NOT NULL DEFAULT now())"
+        ).format(_table_identifier(self.table)))
+        cursor.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} (run_id, task_id, rule)").format(
+            sql.Identifier(f"{self.table.split('.')[-1]}_run_idx"),
+            _table_identifier(self.table),
+        ))
+
+    def write(self, rule, rows):
+        """
+        Appends offending rows to the violations table.
+
+        Args:
+            rule (str): Name of the rule.
+            rows (pd.DataFrame): The offending rows.
+
+        Returns:
+            str: Where the rows of the rule are, as 'table?run_id=...&task_id=...&rule=...'.
+        """
+        from . import violations
+
+        table = _table_identifier(self.table)
+        prefix = "\t".join(_copy_text(value) for value in (self.run_id, self.task_id, rule)) + "\t"
+        with connection(self.dsn) as conn:
+            with conn.cursor() as cursor:
+                if not self._table_ready:
+                    self._create_table(cursor)
+                if rule not in self.paths:
+                    cursor.execute(
+                        sql.SQL("DELETE FROM {} WHERE run_id = %s AND task_id = %s AND rule = %s").format(table),
+                        (self.run_id, self.task_id, rule),
+                    )
+                for start in range(0, len(rows), violations.SINK_BATCH_SIZE):
+                    batch = rows.iloc[start:start + violations.SINK_BATCH_SIZE]
+                    records = batch.to_json(orient="records", lines=True, date_format="iso")
+                    # JSON escapes the control characters, only its backslashes need escaping for COPY
+                    records = records.replace("\\", "\\\\").splitlines()
+                    buffer = io.StringIO("".join(f"{prefix}{record}\n" for record in records))
+                    cursor.copy_expert(
+                        sql.SQL("COPY {} (run_id, task_id, rule, row_data) FROM STDIN").format(table),
+                        buffer,
+                        size=COPY_BUFFER_SIZE,
+                    )
+        self._table_ready = True
+        self.paths[rule] = f"{self.table}?{urlencode({'run_id': self.run_id, 'task_id': self.task_id, 'rule': rule})}"
+        return self.paths[rule]
+
+    def close(self):
+        """
+        Nothing to close: every write is committed and its connection returned to the pool.
+        """
+
+def purge_violations(dsn, task_id_prefix, retention_seconds, table=VIOLATIONS_TABLE):
+    """
+    Deletes the offending rows written more than retention_seconds ago by the tasks
+    whose name starts with task_id_prefix. Failures are logged, not raised.
+
+    Args:
+        dsn (str): The libpq connection URI of the sink.
+        task_id_prefix (str): Prefix of the names of the tasks.
+        retention_seconds (float): Age of the oldest rows kept.
+        table (str, optional): The violations table.
+    """
+    pattern = task_id_prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    try:
+        with connection(dsn) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    sql.SQL("DELETE FROM {} WHERE task_id LIKE %s AND created_at < now() - %s * interval '1 second'").format(_table_identifier(table)),
+                    (pattern, retention_seconds),
+                )
+                logging.info(f"Removed {cursor.rowcount} old violations of {task_id_prefix}* from {table}")
+    except psycopg2.Error as e:
+        logging.warning(f"Could not remove old violations from {redact(dsn)}: {e}")
+
+def read_violations(dsn, location):
+    """
+    Reads back the offending rows of a rule written by PostgresViolationSink, with COPY ... TO STDOUT.
+
+    Args:
+        dsn (str): The libpq connection URI of the sink.
+        location (str): Where the rows are, as returned by PostgresViolationSink.write.
+
+    Returns:
+        pd.DataFrame: The offending rows.
+    """
+    import pandas as pd
+
+    table, _, query = location.partition("?")
+    params = dict(parse_qsl(query))
+    copy_query = sql.SQL(
+        "COPY (SELECT row_data FROM {} WHERE run_id = {} AND task_id = {} AND rule = {}) TO STDOUT WITH (FORMAT csv)"
+    ).format(_table_identifier(table), sql.Literal(params["run_id"]), sql.Literal(params["task_id"]), sql.Literal(params["rule"]))
+    buffer = io.BytesIO()
+    with connection(dsn) as conn:
+        with conn.cursor() as cursor:
+            cursor.copy_expert(copy_query, buffer, size=COPY_BUFFER_SIZE)
+    if not buffer.getbuffer().nbytes:
+        return pd.DataFrame()
+    buffer.seek(0)
+    records = pd.read_csv(buffer, header=None, names=["row_data"], dtype=str)["row_data"]
+    return pd.read_json(io.StringIO("\n".join(records)), lines=True, convert_dates=False)
@@ -0,0 +1,136 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from . import instrumentation
+
+# Task argument, table and snapshot format of each profiled source
+PROFILED_SOURCES = [
+    ('allowance_events', 'allowance_events', 'json'),
+    ('allowance_backend', 'allowance_backend', 'allowance_backend'),
+    ('payment_schedule_backend', 'payment_schedule_backend', 'payment_schedule_backend'),
+]
+
+def _profile_out_of_core(sources, memory_budget_mb):
+    """
+    Profiles the sources chunk by chunk, without loading them (see profiling.profile_source_file).
+
+    Args:
+        sources (list): (url, table_name, source_format) tuples.
+        memory_budget_mb (int): Memory available for a chunk, in MB.
+
+    Returns:
+        list: The profile of each source (profiling.SourceProfile), in the same order.
+    """
+    from . import downloads
+    from . import out_of_core
+    from . import profiling
+
+    with instrumentation.stage('download_sources'):
+        downloaded = downloads.download_sources([url for url, _, _ in sources])
+    chunk_rows = out_of_core.chunk_rows_for(memory_budget_mb)
+    profiles = []
+    for url, table_name, _ in sources:
+        with instrumentation.stage('profile', source=table_name):
+            profiles.append(profiling.profile_source_file(downloaded[url]['path'], table_name, chunk_rows))
+    return profiles
+
+@instrumentation.instrumented_task('profile_sources')
+def profile_sources(**kwargs):
+    """
+    This function profiles the columns of the sources and checks their drift from the previous runs.
+
+    Args:
+        **kwargs: Arbitrary keyword arguments. Expected to contain at least one of:
+            - allowance_events (str): URL to fetch allowance events data.
+            - allowance_backend (str): URL to fetch allowance backend data.
+            - payment_schedule_backend (str): URL to fetch payment schedule backend data.
+            And optionally:
+            - run_id (str): Airflow run id, used to share the source snapshots between tasks.
+            - drift_severity (str): 'warning' (default) only reports the drift, 'error' fails the task.
+            - profile_dir (str): Directory of the profiles of the previous runs.
+            - violation_sample_size (int): Number of drifted metrics per table kept in the report.
+            - out_of_core (bool): Profile the sources chunk by chunk instead of loading them,
+              within memory_budget_mb (see out_of_core.py).
+
+    Returns:
+        dict: The report (see violations.build_report), when the checks pass.
+
+    Raises:
+        ValueError: If none of the source URLs is provided.
+        violations.ViolationsError: If a table drifted and drift_severity is 'error'.
+        Exception: If there is an error in fetching or profiling the data.
+
+    The function performs the following steps:
+        1. Reads the profile of each source computed when its snapshot was parsed, so
+           the sources are not scanned again (see profiling.py). Out of core, the
+           sources are profiled chunk by chunk.
+        2. Compares each profile with the merged profiles of the previous runs: row
+           counts, distinct users, null fractions, value frequencies and distributions
+           (thresholds in config/profile_config.py), and keeps the profile of the run.
+        3. Pushes the statistics of each table to XCom ('profiles'), writes the drifted
+           metrics of each table to the violation sink and raises a bounded summary
+           when the drift severity is 'error'.
+    """
+
+    import pandas as pd
+    from config.profile_config import drift_config
+    from . import profiling
+    from . import utils
+    from . import violations
+
+    run_id = kwargs.get('run_id')
+    sources = [(kwargs[argument], table_name, source_format) for argument, table_name, source_format in PROFILED_SOURCES if kwargs.get(argument)]
+    if not sources:
+        raise ValueError(f"At least one of {[argument for argument, _, _ in PROFILED_SOURCES]} must be provided")
+
+    try:
+        if kwargs.get('out_of_core', False):
+            from . import out_of_core
+
+            profiles = _profile_out_of_core(sources, kwargs.get('memory_budget_mb', out_of_core.MEMORY_BUDGET_MB))
+        else:
+            with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+                futures = [
+                    executor.submit(instrumentation.propagate(utils.get_snapshot_profile), url, source_format, run_id)
+                    for url, _, source_format in sources
+                ]
+                profiles = [future.result() for future in futures]
+    except Exception as e:
+        logging.critical(f"Critical error in get profiles: {e}")
+        raise
+
+    task_id = getattr(kwargs.get('ti'), 'task_id', 'profile_sources')
+    sample_size = kwargs.get('violation_sample_size', violations.VIOLATION_SAMPLE_SIZE)
+    profile_dir = kwargs.get('profile_dir', profiling.PROFILE_DIR)
+    found = []
+    summaries = {}
+    try:
+        for (_, table_name, _), profile in zip(sources, profiles):
+            previous = profiling.previous_profiles(table_name, run_id or utils.DEFAULT_RUN_ID, drift_config['baseline_runs'], profile_dir)
+            drifts = profiling.detect_drift(profile, previous, drift_config['thresholds'])
+            profiling.record_profile(table_name, run_id or utils.DEFAULT_RUN_ID, profile, profile_dir)
+            summaries[table_name] = profile.summary()
+            logging.info(f"Profile of {table_name} ({len(previous)} previous runs): {summaries[table_name]}")
+            if drifts:
+                found.append(violations.make_violation(
+                    f'{table_name}_distribution_drift',
+                    f"The '{table_name}' table drifted from the previous runs",
+                    rows=pd.DataFrame(drifts),
+                    severity=kwargs.get('drift_severity', 'warning'),
+                ))
+                for drift in drifts:
+                    logging.warning(f"Drift of {table_name}.{drift['column']} ({drift['metric']} {drift['score']} > {drift['threshold']}): "
+                                    f"{drift['baseline']} -> {drift['current']}")
+    except Exception as e:
+        logging.critical(f"Critical error in detect_drift: {e}")
+        raise
+
+    ti = kwargs.get('ti')
+    if ti is not None:
+        ti.xcom_push(key='profiles', value=summaries)
+    report = violations.build_report(found, run_id, task_id, ti=ti, sample_size=sample_size)
+    return violations.raise_for_errors(report, sample_size)
+
+
+if __name__ == "__main__":
+    profile_sources()
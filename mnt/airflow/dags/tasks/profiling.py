@@ -0,0 +1,640 @@
+"""
+Column profiles of the sources, built from compact mergeable sketches, and their drift
+from one run to the next.
+
+A profile is computed on the frame of a source right after it is parsed, before its
+snapshot is written (see utils.get_snapshot_df), so profiling adds no pass over the
+source; when a source did not change, the profile of its snapshot is reused. Out of
+core, the sketches are updated chunk by chunk and merged (see profile_source_file).
+
+The profile of each run is kept as a small JSON file (a few KB per table) and compared
+with the profiles of the previous runs, merged into a baseline:
+- distinct values: HyperLogLog on the 128-bit user keys (see keys.encode_uuids),
+- value frequencies: frequency tables of the low-cardinality columns, compared with
+  the population stability index,
+- distributions: quantile sketches with a relative accuracy (log-spaced buckets),
+  compared with the Kolmogorov-Smirnov distance,
+- row counts and null fractions.
+"""
+import base64
+import logging
+import math
+import os
+import tempfile
+import zlib
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from . import keys
+
+PROFILE_DIR = os.environ.get(
+    "ALLOWANCES_PROFILE_DIR",
+    os.path.join(tempfile.gettempdir(), "allowances_profiles"),
+)
+PROFILE_ENABLED = os.environ.get("ALLOWANCES_PROFILE", "1") == "1"
+PROFILE_RETENTION_RUNS = 30
+# 2 ** 12 registers of one byte: 1.6% standard error on the distinct counts
+HLL_PRECISION = 12
+QUANTILE_RELATIVE_ACCURACY = 0.01
+# Values whose absolute value is below this one are counted as zero by the quantile sketches
+QUANTILE_MIN_VALUE = 1e-9
+MAX_FREQUENCY_VALUES = 100
+OTHER_VALUES = "__other__"
+# Smoothing of the shares absent from one of the frequency tables compared by the PSI
+PSI_EPSILON = 1e-4
+
+_MIX_CONSTANTS = (np.uint64(0x9E3779B97F4A7C15), np.uint64(0xBF58476D1CE4E5B9), np.uint64(0x94D049BB133111EB))
+
+def _mix64(values):
+    """
+    Scrambles uint64 values with the splitmix64 finalizer, so every bit of the result depends on every bit of the input.
+
+    Args:
+        values (np.ndarray): The values (uint64).
+
+    Returns:
+        np.ndarray: The scrambled values (uint64).
+    """
+    increment, first, second = _MIX_CONSTANTS
+    z = values + increment
+    z = (z ^ (z >> np.uint64(30))) * first
+    z = (z ^ (z >> np.uint64(27))) * second
+    return z ^ (z >> np.uint64(31))
+
+class HyperLogLog:
+    """
+    Estimates the number of distinct 64-bit hashes with 2 ** precision one-byte registers.
+    Two sketches of the same precision merge into the sketch of the union of their values.
+    """
+
+    def __init__(self, precision=HLL_PRECISION, registers=None):
+        self.precision = precision
+        self.registers = np.zeros(2 ** precision, dtype=np.uint8) if registers is None else registers
+
+    def add_hashes(self, hashes):
+        """
+        Adds hashed values.
+
+        Args:
+            hashes (np.ndarray): Uniformly distributed uint64 hashes.
+        """
+        if not len(hashes):
+            return
+        remaining_bits = 64 - self.precision
+        positions = (hashes >> np.uint64(remaining_bits)).astype(np.intp)
+        rest = hashes & np.uint64(2 ** remaining_bits - 1)
+        # The rest has at most 52 bits, so it is exact as a float and frexp gives its bit length
+        _, bit_lengths = np.frexp(rest.astype(np.float64))
+        ranks = (remaining_bits - bit_lengths + 1).astype(np.uint8)
+        np.maximum.at(self.registers, positions, ranks)
+
+    def merge(self, other):
+        """
+        Adds the values of another sketch of the same precision.
+
+        Args:
+            other (HyperLogLog): The other sketch.
+
+        Raises:
+            ValueError: If the precisions differ.
+        """
+        if other.precision != self.precision:
+            raise ValueError(f"Can not merge HyperLogLog sketches of precisions {self.precision} and {other.precision}")
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self):
+        """
+        Returns:
+            float: The estimated number of distinct values.
+        """
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * size and zeros:
+            # Linear counting is more accurate on small sets
+            estimate = size * math.log(size / zeros)
+        return float(estimate)
+
+    def to_dict(self):
+        return {"precision": self.precision, "registers": base64.b64encode(zlib.compress(self.registers.tobytes())).decode("ascii")}
+
+    @classmethod
+    def from_dict(cls, content):
+        registers = np.frombuffer(zlib.decompress(base64.b64decode(content["registers"])), dtype=np.uint8).copy()
+        return cls(content["precision"], registers)
+
+class QuantileSketch:
+    """
+    Sketches a numeric distribution in log-spaced buckets: any quantile is estimated
+    within the relative accuracy, whatever the number of values, and two sketches of
+    the same accuracy merge into the sketch of all their values. The minimum and the
+    maximum are exact.
+    """
+
+    def __init__(self, relative_accuracy=QUANTILE_RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def _bucket_counts(self, magnitudes):
+        indexes, counts = np.unique(np.ceil(np.log(magnitudes) / math.log(self.gamma)).astype(np.int64), return_counts=True)
+        return zip(indexes.tolist(), counts.tolist())
+
+    def add(self, values):
+        """
+        Adds values. The null values are skipped.
+
+        Args:
+            values (np.ndarray): The values (float64, NaN for nulls).
+        """
+        values = values[~np.isnan(values)]
+        for store, magnitudes in ((self.positive, values[values > QUANTILE_MIN_VALUE]), (self.negative, -values[values < -QUANTILE_MIN_VALUE])):
+            for index, count in self._bucket_counts(magnitudes):
+                store[index] = store.get(index, 0) + count
+        self.zeros += int(np.count_nonzero(np.abs(values) <= QUANTILE_MIN_VALUE))
+        self.count += len(values)
+        if len(values):
+            self._update_range(float(values.min()), float(values.max()))
+
+    def _update_range(self, minimum, maximum):
+        self.min = minimum if self.min is None else min(self.min, minimum)
+        self.max = maximum if self.max is None else max(self.max, maximum)
+
+    def merge(self, other):
+        """
+        Adds the values of another sketch of the same accuracy.
+
+        Args:
+            other (QuantileSketch): The other sketch.
+
+        Raises:
+            ValueError: If the accuracies differ.
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError(f"Can not merge quantile sketches of accuracies {self.relative_accuracy} and {other.relative_accuracy}")
+        for store, other_store in ((self.positive, other.positive), (self.negative, other.negative)):
+            for index, count in other_store.items():
+                store[index] = store.get(index, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        if other.count:
+            self._update_range(other.min, other.max)
+
+    def _value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def buckets(self):
+        """
+        Returns:
+            tuple: The representative value of each non-empty bucket, in increasing
+                order (np.ndarray of float64), and its count (np.ndarray of int64).
+        """
+        negative = sorted(self.negative.items(), reverse=True)
+        positive = sorted(self.positive.items())
+        values = [-self._value(index) for index, _ in negative] + [0.0] * bool(self.zeros) + [self._value(index) for index, _ in positive]
+        counts = [count for _, count in negative] + [self.zeros] * bool(self.zeros) + [count for _, count in positive]
+        return np.array(values, dtype=np.float64), np.array(counts, dtype=np.int64)
+
+    def quantile(self, q):
+        """
+        Args:
+            q (float): The quantile, between 0 and 1.
+
+        Returns:
+            float: The estimated quantile, within the minimum and the maximum, or None without values.
+        """
+        if not self.count:
+            return None
+        values, counts = self.buckets()
+        value = float(values[np.searchsorted(np.cumsum(counts), q * (self.count - 1), side="right")])
+        return min(max(value, self.min), self.max)
+
+    def distance(self, other):
+        """
+        Computes the Kolmogorov-Smirnov distance between the distributions of two sketches:
+        the largest difference between their cumulative distributions.
+
+        Args:
+            other (QuantileSketch): A sketch of the same accuracy.
+
+        Returns:
+            float: The distance, between 0 and 1 (0 when a sketch is empty).
+        """
+        if not self.count or not other.count:
+            return 0.0
+        values, counts = self.buckets()
+        other_values, other_counts = other.buckets()
+        grid = np.union1d(values, other_values)
+        cumulative = []
+        for sketch_values, sketch_counts, total in ((values, counts, self.count), (other_values, other_counts, other.count)):
+            aligned = np.zeros(len(grid))
+            aligned[np.searchsorted(grid, sketch_values)] = sketch_counts
+            cumulative.append(np.cumsum(aligned) / total)
+        return float(np.max(np.abs(cumulative[0] - cumulative[1])))
+
+    def to_dict(self):
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "positive": sorted(self.positive.items()),
+            "negative": sorted(self.negative.items()),
+            "zeros": self.zeros,
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, content):
+        sketch = cls(content["relative_accuracy"])
+        sketch.positive = {index: count for index, count in content["positive"]}
+        sketch.negative = {index: count for index, count in content["negative"]}
+        sketch.zeros = content["zeros"]
+        sketch.count = content["count"]
+        sketch.min = content["min"]
+        sketch.max = content["max"]
+        return sketch
+
+class FrequencyTable:
+    """
+    Counts the values of a low-cardinality column. Only the MAX_FREQUENCY_VALUES most
+    frequent values are stored; the others are counted together as OTHER_VALUES.
+    """
+
+    def __init__(self, counts=None):
+        self.counts = dict(counts or {})
+
+    def add(self, values):
+        """
+        Adds values. The null values are skipped.
+
+        Args:
+            values (pd.Series): The values.
+        """
+        for value, count in values.value_counts(dropna=True).items():
+            if count:
+                self.counts[str(value)] = self.counts.get(str(value), 0) + int(count)
+
+    def merge(self, other):
+        for value, count in other.counts.items():
+            self.counts[value] = self.counts.get(value, 0) + count
+
+    def shares(self):
+        """
+        Returns:
+            dict: The share of each value among the non-null values.
+        """
+        total = sum(self.counts.values())
+        return {value: count / total for value, count in self.counts.items()} if total else {}
+
+    def stability_index(self, baseline):
+        """
+        Computes the population stability index of the values against a baseline table:
+        0 for the same shares, above 0.2 for a significant shift.
+
+        Args:
+            baseline (FrequencyTable): The baseline table.
+
+        Returns:
+            float: The index (0 when a table is empty).
+        """
+        shares, baseline_shares = self.shares(), baseline.shares()
+        if not shares or not baseline_shares:
+            return 0.0
+        index = 0.0
+        for value in set(shares) | set(baseline_shares):
+            share = max(shares.get(value, 0.0), PSI_EPSILON)
+            baseline_share = max(baseline_shares.get(value, 0.0), PSI_EPSILON)
+            index += (share - baseline_share) * math.log(share / baseline_share)
+        return index
+
+    def to_dict(self):
+        ordered = sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))
+        counts = dict(ordered[:MAX_FREQUENCY_VALUES])
+        others = sum(count for _, count in ordered[MAX_FREQUENCY_VALUES:])
+        if others:
+            counts[OTHER_VALUES] = counts.get(OTHER_VALUES, 0) + others
+        return counts
+
+    @classmethod
+    def from_dict(cls, content):
+        return cls(content)
+
+class SourceProfile:
+    """
+    The profile of a table: its number of rows and, for the columns declared in
+    config/profile_config.py, their null values and sketches. Two profiles of the
+    same table merge into the profile of all their rows.
+    """
+
+    def __init__(self, table_name, columns=None):
+        if columns is None:
+            from config.profile_config import profile_dict
+
+            columns = profile_dict[table_name]
+        self.table_name = table_name
+        self.columns = {kind: list(columns.get(kind, [])) for kind in ("distinct", "frequencies", "quantiles")}
+        self.rows = 0
+        self.nulls = {column: 0 for column in self.profiled_columns()}
+        self.distinct = {column: HyperLogLog() for column in self.columns["distinct"]}
+        self.frequencies = {column: FrequencyTable() for column in self.columns["frequencies"]}
+        self.quantiles = {column: QuantileSketch() for column in self.columns["quantiles"]}
+
+    def profiled_columns(self):
+        """
+        Returns:
+            list: Every column of the profile, in declaration order.
+        """
+        return list(dict.fromkeys(column for columns in self.columns.values() for column in columns))
+
+    def update(self, df):
+        """
+        Adds the rows of a frame (a whole table or a chunk of it).
+
+        Args:
+            df (pd.DataFrame): The rows, with the profiled columns.
+        """
+        self.rows += len(df)
+        for column in self.nulls:
+            self.nulls[column] += int(df[column].isna().sum())
+        for column, sketch in self.distinct.items():
+            high, low = keys.key_halves(df, column)
+            present = df[column].notna().to_numpy()
+            sketch.add_hashes(_mix64(high[present] ^ _mix64(low[present])))
+        for column, table in self.frequencies.items():
+            table.add(df[column])
+        for column, sketch in self.quantiles.items():
+            sketch.add(pd.to_numeric(df[column], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan))
+
+    def distinct_estimate(self, column):
+        """
+        Estimates the distinct values of a column. The HyperLogLog estimate can exceed
+        the number of values on small tables, so it is capped at the non-null rows.
+
+        Args:
+            column (str): A column of the distinct sketches.
+
+        Returns:
+            float: The estimated number of distinct values.
+        """
+        return min(self.distinct[column].estimate(), self.rows - self.nulls[column])
+
+    def merge(self, other):
+        """
+        Adds the rows of another profile of the same table.
+
+        Args:
+            other (SourceProfile): The other profile.
+        """
+        self.rows += other.rows
+        for column in self.nulls:
+            self.nulls[column] += other.nulls.get(column, 0)
+        for sketches, other_sketches in ((self.distinct, other.distinct), (self.frequencies, other.frequencies), (self.quantiles, other.quantiles)):
+            for column, sketch in sketches.items():
+                if column in other_sketches:
+                    sketch.merge(other_sketches[column])
+
+    def summary(self):
+        """
+        Returns:
+            dict: The statistics of the profile, for the logs and the report: the rows
+                and, by column, the null fraction, the estimated distinct values, the
+                most frequent values with their share and the quartiles.
+        """
+        columns = {}
+        for column in self.profiled_columns():
+            stats = {"null_fraction": round(self.nulls[column] / self.rows, 6) if self.rows else 0.0}
+            if column in self.distinct:
+                stats["distinct"] = round(self.distinct_estimate(column))
+            if column in self.frequencies:
+                shares = sorted(self.frequencies[column].shares().items(), key=lambda item: -item[1])
+                stats["top_values"] = {value: round(share, 4) for value, share in shares[:5]}
+            if column in self.quantiles:
+                sketch = self.quantiles[column]
+                stats.update({f"p{round(q * 100)}": float(f"{sketch.quantile(q):.4g}") if sketch.count else None
+                              for q in (0.0, 0.25, 0.5, 0.75, 0.99, 1.0)})
+            columns[column] = stats
+        return {"table": self.table_name, "rows": self.rows, "columns": columns}
+
+    def to_dict(self):
+        return {
+            "table": self.table_name,
+            "columns": self.columns,
+            "rows": self.rows,
+            "nulls": self.nulls,
+            "distinct": {column: sketch.to_dict() for column, sketch in self.distinct.items()},
+            "frequencies": {column: table.to_dict() for column, table in self.frequencies.items()},
+            "quantiles": {column: sketch.to_dict() for column, sketch in self.quantiles.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, content):
+        profile = cls(content["table"], content["columns"])
+        profile.rows = content["rows"]
+        profile.nulls = dict(content["nulls"])
+        profile.distinct = {column: HyperLogLog.from_dict(sketch) for column, sketch in content["distinct"].items()}
+        profile.frequencies = {column: FrequencyTable.from_dict(table) for column, table in content["frequencies"].items()}
+        profile.quantiles = {column: QuantileSketch.from_dict(sketch) for column, sketch in content["quantiles"].items()}
+        return profile
+
+def profile_frame(table_name, df):
+    """
+    Profiles a whole table.
+
+    Args:
+        table_name (str): Name of the table in config/profile_config.py.
+        df (pd.DataFrame): The table.
+
+    Returns:
+        SourceProfile: The profile.
+    """
+    profile = SourceProfile(table_name)
+    profile.update(df)
+    return profile
+
+def profile_source_file(path, table_name, chunk_rows):
+    """
+    Profiles a downloaded source chunk by chunk, so only one chunk is in memory at a time
+    (see out_of_core.py).
+
+    Args:
+        path (str): Path of the downloaded source.
+        table_name (str): 'allowance_events' or a table of utils.TABLE_SCHEMAS.
+        chunk_rows (int): Maximum number of rows per chunk.
+
+    Returns:
+        SourceProfile: The profile.
+    """
+    from . import out_of_core
+
+    profile = SourceProfile(table_name)
+    for chunk in out_of_core._iter_source_chunks(path, table_name, chunk_rows):
+        profile.update(chunk)
+    return profile
+
+def snapshot_profile_path(snapshot_path):
+    """
+    Returns the path of the profile of a snapshot, computed when the snapshot was parsed.
+
+    Args:
+        snapshot_path (str): Path of the snapshot.
+
+    Returns:
+        str: The path of the profile.
+    """
+    return f"{snapshot_path}.profile.json"
+
+def _history_dir(table_name, profile_dir):
+    from . import violations
+
+    return os.path.join(profile_dir, violations._safe_name(table_name))
+
+def record_profile(table_name, run_id, profile, profile_dir=PROFILE_DIR):
+    """
+    Keeps the profile of a run, replacing the one of a previous attempt of the run,
+    and removes the profiles beyond the PROFILE_RETENTION_RUNS most recent runs.
+
+    Args:
+        table_name (str): Name of the table.
+        run_id (str): The Airflow run id.
+        profile (SourceProfile): The profile.
+        profile_dir (str, optional): Directory of the profiles.
+    """
+    from . import utils
+    from . import violations
+
+    directory = _history_dir(table_name, profile_dir)
+    os.makedirs(directory, exist_ok=True)
+    utils._write_json_atomic(os.path.join(directory, f"{violations._safe_name(run_id)}.json"), {
+        "run_id": run_id,
+        "recorded_at": datetime.now().isoformat(),
+        "profile": profile.to_dict(),
+    })
+    for file_name, _ in _recorded_runs(directory)[PROFILE_RETENTION_RUNS:]:
+        try:
+            os.remove(os.path.join(directory, file_name))
+        except OSError as e:
+            logging.warning(f"Could not remove old profile {file_name}: {e}")
+
+def _recorded_runs(directory):
+    """
+    Lists the recorded profiles of a table, the most recent first.
+
+    Args:
+        directory (str): Directory of the profiles of the table.
+
+    Returns:
+        list: (file name, content) tuples.
+    """
+    from . import utils
+
+    if not os.path.isdir(directory):
+        return []
+    recorded = []
+    for file_name in os.listdir(directory):
+        if file_name.endswith(".json"):
+            content = utils._read_json(os.path.join(directory, file_name))
+            if content is not None:
+                recorded.append((file_name, content))
+    return sorted(recorded, key=lambda item: item[1]["recorded_at"], reverse=True)
+
+def previous_profiles(table_name, run_id, limit, profile_dir=PROFILE_DIR):
+    """
+    Returns the profiles of the most recent runs before the current one.
+
+    Args:
+        table_name (str): Name of the table.
+        run_id (str): The current run id, left out.
+        limit (int): Maximum number of profiles.
+        profile_dir (str, optional): Directory of the profiles.
+
+    Returns:
+        list: The profiles (SourceProfile), the most recent first.
+    """
+    recorded = [content for _, content in _recorded_runs(_history_dir(table_name, profile_dir)) if content["run_id"] != run_id]
+    return [SourceProfile.from_dict(content["profile"]) for content in recorded[:limit]]
+
+def _drift(table_name, column, metric, baseline, current, score, threshold):
+    return {
+        "table": table_name,
+        "column": column,
+        "metric": metric,
+        "baseline": baseline,
+        "current": current,
+        "score": round(float(score), 4),
+        "threshold": threshold,
+    }
+
+def _quartiles(sketch):
+    return ", ".join(f"p{round(q * 100)}={sketch.quantile(q):.4g}" for q in (0.25, 0.5, 0.75)) if sketch.count else ""
+
+def _top_shares(table):
+    shares = sorted(table.shares().items(), key=lambda item: -item[1])[:3]
+    return ", ".join(f"{value}={share:.1%}" for value, share in shares)
+
+def detect_drift(profile, previous, thresholds):
+    """
+    Compares a profile with the profiles of the previous runs.
+
+    The row count and distinct values are compared with their average over the previous
+    runs; the null fractions, value frequencies and distributions with the merged
+    profile of the previous runs.
+
+    Args:
+        profile (SourceProfile): The profile of the run.
+        previous (list): The profiles of the previous runs (see previous_profiles).
+        thresholds (dict): The drift thresholds (see config/profile_config.py).
+
+    Returns:
+        list: The drifted metrics, as dicts with the keys 'table', 'column', 'metric',
+            'baseline', 'current', 'score' and 'threshold' (strings for the values
+            compared, so the rows have one type per column).
+    """
+    if not previous:
+        return []
+    table_name = profile.table_name
+    drifts = []
+
+    baseline_rows = sum(other.rows for other in previous) / len(previous)
+    score = abs(profile.rows - baseline_rows) / max(baseline_rows, 1)
+    if score > thresholds["row_count"]:
+        drifts.append(_drift(table_name, "*", "row_count", f"{baseline_rows:.0f}", str(profile.rows), score, thresholds["row_count"]))
+
+    baseline = SourceProfile(table_name, profile.columns)
+    for other in previous:
+        baseline.merge(other)
+
+    for column, sketch in profile.distinct.items():
+        estimates = [other.distinct_estimate(column) for other in previous if column in other.distinct]
+        if estimates:
+            baseline_distinct = sum(estimates) / len(estimates)
+            current = profile.distinct_estimate(column)
+            score = abs(current - baseline_distinct) / max(baseline_distinct, 1)
+            if score > thresholds["distinct"]:
+                drifts.append(_drift(table_name, column, "distinct", f"{baseline_distinct:.0f}", f"{current:.0f}", score, thresholds["distinct"]))
+
+    for column, nulls in profile.nulls.items():
+        if baseline.rows and profile.rows:
+            baseline_fraction = baseline.nulls[column] / baseline.rows
+            fraction = nulls / profile.rows
+            score = abs(fraction - baseline_fraction)
+            if score > thresholds["null_fraction"]:
+                drifts.append(_drift(table_name, column, "null_fraction", f"{baseline_fraction:.4f}", f"{fraction:.4f}", score, thresholds["null_fraction"]))
+
+    for column, table in profile.frequencies.items():
+        score = table.stability_index(baseline.frequencies[column])
+        if score > thresholds["frequency_psi"]:
+            drifts.append(_drift(table_name, column, "frequency_psi", _top_shares(baseline.frequencies[column]), _top_shares(table), score, thresholds["frequency_psi"]))
+
+    for column, sketch in profile.quantiles.items():
+        score = sketch.distance(baseline.quantiles[column])
+        if score > thresholds["quantile_ks"]:
+            drifts.append(_drift(table_name, column, "quantile_ks", _quartiles(baseline.quantiles[column]), _quartiles(sketch), score, thresholds["quantile_ks"]))
+    return drifts
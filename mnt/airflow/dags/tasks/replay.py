@@ -0,0 +1,178 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+from . import keys
+from . import timestamps
+
+CREATION_DATE_TOLERANCE_SECONDS = 5
+UNPARSEABLE_EVENTS_ATTR = "unparseable_events"
+
+CREATED_EVENT = "allowance.created"
+EVENT_STATUS = {
+    "allowance.created": "enabled",
+    "allowance.enabled": "enabled",
+    "allowance.resumed": "enabled",
+    "allowance.disabled": "disabled",
+    "allowance.paused": "disabled",
+    "allowance.deleted": "disabled",
+    "allowance.removed": "disabled",
+}
+STATE_FIELDS = {
+    "frequency": "allowance_scheduled_frequency",
+    "day": "allowance_scheduled_day",
+    "amount": "allowance_amount",
+}
+
+_POSITION_BITS = 32
+_POSITION_MASK = (1 << _POSITION_BITS) - 1
+
+def event_epochs(event_timestamps, timezone=timestamps.EVENT_TIMEZONE):
+    """
+    Converts the local event timestamps ('2024-09-21 1:39:34') into epoch nanoseconds.
+
+    The events are stamped in the local time of the allowance service: the
+    creation_date of the backend matches the first event of the user once
+    converted from that timezone.
+
+    Args:
+        event_timestamps (pd.Series): The event timestamps.
+        timezone (str, optional): Timezone of the event timestamps.
+
+    Returns:
+        tuple: The epoch nanoseconds (np.ndarray of int64, 0 for the timestamps that
+            can not be parsed) and the boolean mask of the unparseable timestamps.
+    """
+    epoch_ns, unparseable = timestamps.normalize_timestamps(event_timestamps, timezone)
+    return epoch_ns.to_numpy(dtype="int64", na_value=0), unparseable
+
+def _latest_positions(order_keys, mask, codes, n_users):
+    """
+    Finds, for each user, the latest event among the ones selected by the mask.
+
+    The order key packs the event epoch and the event position, so the latest event
+    is a grouped max, computed by hashing in linear time instead of sorting.
+    Events with the same timestamp are ordered by their position in the stream.
+
+    Args:
+        order_keys (np.ndarray): Order key of each event (epoch << 32 | position).
+        mask (np.ndarray): Boolean mask of the events considered.
+        codes (np.ndarray): User code of each event.
+        n_users (int): Number of users.
+
+    Returns:
+        np.ndarray: Position of the latest selected event of each user, -1 if the user has none.
+    """
+    latest_keys = pd.Series(np.where(mask, order_keys, -1)).groupby(codes, sort=True).max()
+    latest = latest_keys.reindex(np.arange(n_users), fill_value=-1).to_numpy()
+    return np.where(latest >= 0, latest & _POSITION_MASK, -1)
+
+def _take(values, positions):
+    """
+    Takes values by position, with missing values where the position is -1.
+
+    Args:
+        values (pd.Series): The values.
+        positions (np.ndarray): The positions.
+
+    Returns:
+        pd.Series: The values taken, with a fresh index.
+    """
+    taken = values.iloc[np.maximum(positions, 0)].reset_index(drop=True)
+    return taken.where(positions >= 0)
+
+def replay_events(allowance_events_df, timezone=timestamps.EVENT_TIMEZONE):
+    """
+    Folds the full event stream into the expected final state of each allowance.
+
+    Each field of the state comes from the latest event of the user that carries
+    it: the status from the latest lifecycle event (see EVENT_STATUS), the schedule
+    and amount from the latest event with a value. Every step is a grouped
+    operation over the whole stream, so the replay stays linear in the number of
+    events, without sorting and without per-user Python loops. The users are
+    numbered from their integer keys (see keys.group_codes), in key order.
+
+    Args:
+        allowance_events_df (pd.DataFrame): All the events, as returned by utils.read_allowance_events.
+        timezone (str, optional): Timezone of the event timestamps.
+
+    Returns:
+        pd.DataFrame: One row per user, with the columns 'user_id', 'status',
+            'status_event' (the lifecycle event that set the status), 'frequency',
+            'day', 'amount', 'created_at' and 'last_event_at' (epoch nanoseconds), 'event_count'
+            and the integer keys of 'user_id' when the events have them. Events without user are ignored.
+            The index labels of the events whose timestamp can not be parsed are
+            in the UNPARSEABLE_EVENTS_ATTR attribute of the result.
+    """
+    allowance_events_df = allowance_events_df[allowance_events_df['user_id'].notna()]
+    codes, first_positions = keys.group_codes(allowance_events_df, 'user_id')
+    n_users = len(first_positions)
+    epochs, unparseable = event_epochs(allowance_events_df['event_timestamp'], timezone)
+    positions = np.arange(len(allowance_events_df), dtype=np.int64)
+    order_keys = ((epochs // 10 ** 9) << _POSITION_BITS) | positions
+    event_names = allowance_events_df['event_name'].reset_index(drop=True)
+
+    state = pd.DataFrame({"user_id": allowance_events_df['user_id'].to_numpy()[first_positions]})
+    for key_column in keys.key_columns('user_id'):
+        if key_column in allowance_events_df.columns:
+            state[key_column] = allowance_events_df[key_column].to_numpy()[first_positions]
+    lifecycle = event_names.isin(list(EVENT_STATUS)).to_numpy()
+    status_events = _take(event_names, _latest_positions(order_keys, lifecycle, codes, n_users))
+    state["status"] = status_events.map(EVENT_STATUS)
+    state["status_event"] = status_events
+
+    for field, column in STATE_FIELDS.items():
+        values = allowance_events_df[column].reset_index(drop=True)
+        state[field] = _take(values, _latest_positions(order_keys, values.notna().to_numpy(), codes, n_users))
+
+    created = (event_names == CREATED_EVENT).to_numpy()
+    valid = codes >= 0
+    first_created = pd.Series(np.where(created, epochs, np.iinfo(np.int64).max)).groupby(codes).min()
+    first_event = pd.Series(epochs).groupby(codes).min()
+    state["created_at"] = np.where(first_created.to_numpy() < np.iinfo(np.int64).max, first_created.to_numpy(), first_event.to_numpy())
+    state["last_event_at"] = pd.Series(epochs).groupby(codes).max().to_numpy()
+    state["event_count"] = np.bincount(codes[valid], minlength=n_users)
+    state.attrs[UNPARSEABLE_EVENTS_ATTR] = allowance_events_df.index[unparseable].tolist()
+    logging.info(f"Replayed {len(allowance_events_df)} events into the state of {n_users} allowances")
+    return state
+
+def compare_state(expected_df, allowance_backend_df, tolerance=CREATION_DATE_TOLERANCE_SECONDS):
+    """
+    Compares the replayed state with the 'allowance_backend' table in a single outer join.
+
+    Args:
+        expected_df (pd.DataFrame): The replayed state, as returned by replay_events.
+        allowance_backend_df (pd.DataFrame): The 'allowance_backend' table.
+        tolerance (int, optional): Difference tolerated between creation_date and the creation event, in seconds.
+
+    Returns:
+        tuple: The joined DataFrame (backend columns plus the replayed state prefixed
+            with 'expected_') and a dict of boolean masks of its mismatching rows, with
+            the keys 'missing_in_backend', 'missing_in_events', 'status', 'schedule' and 'creation_date'.
+    """
+    expected = expected_df.add_prefix("expected_")
+    joined = keys.merge(allowance_backend_df, expected, left_on='uuid', right_on='expected_user_id', how='outer', indicator=True)
+    in_both = (joined['_merge'] == 'both').to_numpy()
+
+    asserted_status = in_both & joined['expected_status_event'].notna().to_numpy() \
+        & (joined['expected_status_event'] != CREATED_EVENT).to_numpy()
+    status_mismatch = asserted_status & (joined['status'].astype(object) != joined['expected_status']).to_numpy()
+
+    enabled = in_both & (joined['status'] == 'enabled').to_numpy() & (joined['expected_status'] != 'disabled').to_numpy()
+    schedule_mismatch = enabled & (
+        (joined['frequency'].astype(object) != joined['expected_frequency']).to_numpy()
+        | (joined['day'].astype(object) != joined['expected_day']).to_numpy()
+    )
+
+    creation_gap = (joined['creation_date'].astype('Float64') - joined['expected_created_at']).abs()
+    creation_mismatch = in_both & creation_gap.gt(tolerance * 10 ** 9).fillna(False).to_numpy(dtype=bool)
+
+    masks = {
+        "missing_in_backend": (joined['_merge'] == 'right_only').to_numpy(),
+        "missing_in_events": (joined['_merge'] == 'left_only').to_numpy(),
+        "status": status_mismatch,
+        "schedule": schedule_mismatch,
+        "creation_date": creation_mismatch,
+    }
+    return joined.drop(columns='_merge'), masks
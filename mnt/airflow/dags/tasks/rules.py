@@ -0,0 +1,189 @@
+import logging
+import numpy as np
+import pandas as pd
+
+from . import keys
+from . import timestamps
+
+def _expand_rules(df, rules):
+    """
+    Expands the rules declared for every column ('*') into one rule per column.
+    The integer key columns derived from the user ids (see keys.add_keys) are not checked.
+
+    Args:
+        df (pd.DataFrame): The table the rules are evaluated on.
+        rules (list): The rules declared for the table.
+
+    Returns:
+        dict: The rules grouped by column, in declaration order.
+    """
+    rules_by_column = {}
+    for position, rule in enumerate(rules):
+        columns = [column for column in df.columns if not keys.is_key_column(df, column)] if rule["column"] == "*" else [rule["column"]]
+        for column in columns:
+            rules_by_column.setdefault(column, []).append(dict(rule, column=column, declared_column=rule["column"], position=position))
+    return rules_by_column
+
+def _isin_mask(values, allowed):
+    """
+    Flags the values that are not in the allowed list.
+
+    For categorical columns the allowed list is only checked against the
+    categories, and the result is mapped back to the rows through the codes.
+
+    Args:
+        values (pd.Series): The column checked.
+        allowed (list): The allowed values.
+
+    Returns:
+        np.ndarray: Boolean mask of the invalid rows (null values are invalid).
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        allowed_categories = np.append(values.cat.categories.isin(allowed), False)
+        return ~allowed_categories[values.cat.codes.to_numpy()]
+    return ~values.isin(allowed).to_numpy()
+
+def _range_mask(values, null_mask, params):
+    """
+    Flags the values outside the [min, max] range. Null values are not flagged.
+
+    Args:
+        values (pd.Series): The column checked.
+        null_mask (np.ndarray): Boolean mask of the null rows.
+        params (dict): Rule parameters, with optional 'min' and 'max'.
+
+    Returns:
+        np.ndarray: Boolean mask of the rows out of range.
+    """
+    numbers = values.to_numpy(dtype='float64', na_value=np.nan)
+    mask = np.zeros(len(values), dtype=bool)
+    if "min" in params:
+        mask |= numbers < params["min"]
+    if "max" in params:
+        mask |= numbers > params["max"]
+    return mask & ~null_mask
+
+def _unique_mask(df, column, null_mask):
+    """
+    Flags every occurrence of the values that appear more than once. Null values are not flagged.
+
+    User id columns with integer keys (see keys.add_keys) are checked on the keys,
+    which are adjacent once sorted, instead of hashing the strings.
+
+    Args:
+        df (pd.DataFrame): The table checked.
+        column (str): The column checked.
+        null_mask (np.ndarray): Boolean mask of the null rows.
+
+    Returns:
+        np.ndarray: Boolean mask of the duplicated rows.
+    """
+    if all(key_column in df.columns for key_column in keys.key_columns(column)):
+        return keys.duplicated(df, column, keep=False) & ~null_mask
+    return df[column].duplicated(keep=False).to_numpy() & ~null_mask
+
+def _evaluate_column(df, column, column_rules):
+    """
+    Evaluates every rule of a column, reading the column and its null mask only once.
+
+    Args:
+        df (pd.DataFrame): The table checked.
+        column (str): The column checked.
+        column_rules (list): The rules declared for the column.
+
+    Returns:
+        list: Tuples (rule, mask) for each rule of the column.
+    """
+    values = df[column]
+    null_mask = values.isna().to_numpy()
+    results = []
+    for rule in column_rules:
+        params = rule.get("params", {})
+        if rule["type"] == "not_null":
+            mask = null_mask & ~timestamps.unparseable_mask(values)
+        elif rule["type"] == "unique":
+            mask = _unique_mask(df, column, null_mask)
+        elif rule["type"] == "range":
+            mask = _range_mask(values, null_mask, params)
+        elif rule["type"] == "isin":
+            mask = _isin_mask(values, params["values"])
+        elif rule["type"] == "parseable_timestamp":
+            mask = timestamps.unparseable_mask(values)
+        else:
+            raise ValueError(f"Unknown rule type '{rule['type']}' in rule '{rule['name']}'")
+        results.append((rule, mask))
+    return results
+
+def evaluate_rules(df, rules):
+    """
+    Evaluates all the rules declared for a table in a single pass over its columns.
+
+    Args:
+        df (pd.DataFrame): The table checked.
+        rules (list): The rules declared for the table (see config/rules_config.py).
+
+    Returns:
+        list: One dict per evaluated rule, in declaration order, with the keys 'rule',
+            'mask' (boolean np.ndarray of the violating rows), 'count' (number of
+            violating rows) and 'error' (message of the exception raised by the rule, or None).
+    """
+    results = []
+    for column, column_rules in _expand_rules(df, rules).items():
+        try:
+            column_results = _evaluate_column(df, column, column_rules)
+        except Exception as e:
+            logging.error(e)
+            for rule in column_rules:
+                results.append({"rule": rule, "mask": None, "count": 0, "error": str(e)})
+            continue
+        for rule, mask in column_results:
+            results.append({"rule": rule, "mask": mask, "count": int(mask.sum()), "error": None})
+    return sorted(results, key=lambda result: result["rule"]["position"])
+
+def _describe_violation(table_name, result):
+    """
+    Builds the description of a violated rule, without the offending rows.
+
+    Args:
+        table_name (str): Name of the table checked.
+        result (dict): The rule result, as returned by evaluate_rules.
+
+    Returns:
+        str: The description of the violation.
+    """
+    rule = result["rule"]
+    if rule["type"] == "not_null":
+        return f"Column '{rule['column']}' contains {result['count']} null values."
+    return f"The '{table_name}' table has {rule['message']}"
+
+def check_rules(table_name, df, rules):
+    """
+    Evaluates the rules of a table and returns the violated ones.
+
+    Args:
+        table_name (str): Name of the table checked.
+        df (pd.DataFrame): The table checked.
+        rules (list): The rules declared for the table.
+
+    Returns:
+        list: The violations found (see violations.make_violation), with the offending rows.
+    """
+    from . import violations
+
+    found = []
+    for result in evaluate_rules(df, rules):
+        rule = result["rule"]
+        rule_name = f"{rule['name']}.{rule['column']}" if rule["declared_column"] == "*" else rule["name"]
+        if result["error"] is not None:
+            found.append(violations.make_violation(rule_name, f"Error during {rule['name']} check", severity=rule["severity"], error=result["error"]))
+        elif result["count"] > 0:
+            rows = df[result["mask"]]
+            if rule["type"] == "parseable_timestamp":
+                rows = rows.assign(raw_value=timestamps.unparseable_values(df[rule["column"]]).reindex(rows.index))
+            found.append(violations.make_violation(
+                rule_name,
+                _describe_violation(table_name, result),
+                rows=rows,
+                severity=rule["severity"],
+            ))
+    return found
@@ -0,0 +1,272 @@
+"""
+Runs the task graph of config/task_config.py without Airflow, for local and CI runs.
+
+The 'depends_on' of each task are resolved into a DAG and every task starts as soon
+as its upstream tasks succeeded, so the independent look_* tasks run concurrently in
+a thread pool (sharing the frames they load, see utils.shared_frames) or in a process
+pool (sharing the Arrow snapshots of the run). The timings of the run show how much
+of the Airflow run time is spent on the work itself.
+
+Usage (from mnt/airflow/dags):
+    python -m tasks.runner --ds 2024-12-03 --set allowance_backend=http://localhost:8000/allowance_backend_table
+"""
+import argparse
+import importlib
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+from datetime import datetime
+
+EXECUTORS = {"thread": ThreadPoolExecutor, "process": ProcessPoolExecutor}
+
+class LocalTaskInstance:
+    """
+    Stands for the Airflow task instance given to the tasks: keeps what they push to XCom.
+    """
+
+    def __init__(self, task_id, run_id):
+        self.task_id = task_id
+        self.run_id = run_id
+        self.xcoms = {}
+
+    def xcom_push(self, key, value):
+        self.xcoms[key] = value
+
+def resolve_order(task_dict, selected=None):
+    """
+    Sorts the tasks topologically from their 'depends_on'.
+
+    Args:
+        task_dict (dict): The tasks (see config/task_config.py).
+        selected (list, optional): Run only these tasks and their upstream tasks.
+
+    Returns:
+        list: The task ids, every task after its upstream tasks.
+
+    Raises:
+        ValueError: If a task depends on an unknown task or the dependencies have a cycle.
+    """
+    pending = list(selected or task_dict)
+    needed = set()
+    while pending:
+        task_id = pending.pop()
+        if task_id not in task_dict:
+            raise ValueError(f"Unknown task '{task_id}'")
+        if task_id not in needed:
+            needed.add(task_id)
+            pending.extend(task_dict[task_id]["depends_on"])
+
+    order = []
+    remaining = {task_id: set(task_dict[task_id]["depends_on"]) for task_id in task_dict if task_id in needed}
+    while remaining:
+        ready = [task_id for task_id, upstream in remaining.items() if not upstream]
+        if not ready:
+            raise ValueError(f"The dependencies of the tasks {sorted(remaining)} have a cycle")
+        for task_id in ready:
+            order.append(task_id)
+            del remaining[task_id]
+        for upstream in remaining.values():
+            upstream.difference_update(ready)
+    return order
+
+def build_kwargs(task, task_id, run_id, ds, overrides=None):
+    """
+    Builds the arguments of a task like the DAG does: its configured kwargs plus the Airflow context.
+
+    Args:
+        task (dict): The task settings.
+        task_id (str): Name of the task.
+        run_id (str): The run id.
+        ds (str): The run date (YYYY-MM-DD).
+        overrides (dict, optional): Values replacing the configured kwargs of the same name.
+
+    Returns:
+        dict: The task arguments.
+    """
+    kwargs = dict(task.get("kwargs", {}))
+    for name, value in (overrides or {}).items():
+        if name in kwargs:
+            kwargs[name] = value
+    kwargs.update(run_id=run_id, ds=ds, ti=LocalTaskInstance(task_id, run_id))
+    return kwargs
+
+def run_task(task_id, module_path, function_name, kwargs):
+    """
+    Runs a task and captures its outcome instead of raising.
+
+    Args:
+        task_id (str): Name of the task.
+        module_path (str): Module of the task function.
+        function_name (str): Name of the task function.
+        kwargs (dict): The task arguments (see build_kwargs).
+
+    Returns:
+        dict: The outcome, with the keys 'task_id', 'status' ('success' or 'failed'),
+            'error', 'started_at', 'wall_seconds' and 'xcoms'.
+    """
+    started_at = time.time()
+    wall_start = time.perf_counter()
+    error = None
+    try:
+        function = getattr(importlib.import_module(module_path), function_name)
+        function(**kwargs)
+    except Exception as e:
+        logging.error(f"Task {task_id} failed: {e}")
+        error = str(e)
+    ti = kwargs.get("ti")
+    return {
+        "task_id": task_id,
+        "status": "failed" if error is not None else "success",
+        "error": error,
+        "started_at": started_at,
+        "wall_seconds": round(time.perf_counter() - wall_start, 4),
+        "xcoms": getattr(ti, "xcoms", {}),
+    }
+
+def _critical_path_seconds(order, task_dict, results):
+    """
+    Computes the run time the task graph needs with unlimited workers: its longest chain of tasks.
+
+    Args:
+        order (list): The task ids, in topological order.
+        task_dict (dict): The tasks.
+        results (dict): The outcome of each task that ran.
+
+    Returns:
+        float: The wall time of the longest chain, in seconds.
+    """
+    finish = {}
+    for task_id in order:
+        upstream = [finish.get(dependency, 0) for dependency in task_dict[task_id]["depends_on"]]
+        finish[task_id] = max(upstream, default=0) + results.get(task_id, {}).get("wall_seconds", 0)
+    return round(max(finish.values(), default=0), 4)
+
+def run_pipeline(task_dict, run_id=None, ds=None, selected=None, executor="thread", max_workers=None, overrides=None):
+    """
+    Runs the task graph, starting every task as soon as its upstream tasks succeeded.
+
+    A task whose upstream task failed is not run and is reported as 'upstream_failed',
+    like in Airflow. With the thread executor the tasks share the frames they load.
+
+    Args:
+        task_dict (dict): The tasks (see config/task_config.py).
+        run_id (str, optional): The run id. Defaults to 'local__<timestamp>'.
+        ds (str, optional): The run date (YYYY-MM-DD). Defaults to today.
+        selected (list, optional): Run only these tasks and their upstream tasks.
+        executor (str, optional): 'thread' or 'process'.
+        max_workers (int, optional): Number of workers. Defaults to the number of tasks.
+        overrides (dict, optional): Values replacing the configured task kwargs of the same name.
+
+    Returns:
+        dict: The run summary, with the keys 'run_id', 'ds', 'executor', 'wall_seconds',
+            'task_seconds' (sum of the task times), 'critical_path_seconds' and 'tasks'
+            (outcome of each task, see run_task).
+
+    Raises:
+        ValueError: If the executor is unknown or the dependencies are invalid.
+    """
+    from . import utils
+
+    if executor not in EXECUTORS:
+        raise ValueError(f"Unknown executor '{executor}', expected one of {sorted(EXECUTORS)}")
+    order = resolve_order(task_dict, selected)
+    run_id = run_id or f"local__{datetime.now().strftime('%Y-%m-%dT%H:%M:%S')}"
+    ds = ds or datetime.now().strftime("%Y-%m-%d")
+    results = {}
+    running = {}
+    wall_start = time.perf_counter()
+
+    sharing = utils.shared_frames() if executor == "thread" else nullcontext()
+    with sharing, EXECUTORS[executor](max_workers=max_workers or len(order)) as pool:
+        pending = list(order)
+        while pending or running:
+            for task_id in list(pending):
+                upstream = task_dict[task_id]["depends_on"]
+                if any(results.get(dependency, {}).get("status") in ("failed", "upstream_failed") for dependency in upstream):
+                    results[task_id] = {"task_id": task_id, "status": "upstream_failed", "error": None, "wall_seconds": 0, "xcoms": {}}
+                    pending.remove(task_id)
+                elif all(results.get(dependency, {}).get("status") == "success" for dependency in upstream):
+                    task = task_dict[task_id]
+                    kwargs = build_kwargs(task, task_id, run_id, ds, overrides)
+                    logging.info(f"Starting task {task_id}")
+                    running[pool.submit(run_task, task_id, task["module_path"], task["function_name"], kwargs)] = task_id
+                    pending.remove(task_id)
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                results[running.pop(future)] = result
+                logging.info(f"Task {result['task_id']} {result['status']} in {result['wall_seconds']}s")
+
+    return {
+        "run_id": run_id,
+        "ds": ds,
+        "executor": executor,
+        "wall_seconds": round(time.perf_counter() - wall_start, 4),
+        "task_seconds": round(sum(result["wall_seconds"] for result in results.values()), 4),
+        "critical_path_seconds": _critical_path_seconds(order, task_dict, results),
+        "tasks": [results[task_id] for task_id in order],
+    }
+
+def _parse_overrides(assignments):
+    """
+    Parses the --set name=value arguments. Values are read as JSON when possible.
+
+    Args:
+        assignments (list): The 'name=value' strings.
+
+    Returns:
+        dict: The values by name.
+
+    Raises:
+        ValueError: If an assignment has no '='.
+    """
+    overrides = {}
+    for assignment in assignments or []:
+        name, separator, value = assignment.partition("=")
+        if not separator:
+            raise ValueError(f"Invalid --set '{assignment}', expected name=value")
+        try:
+            overrides[name] = json.loads(value)
+        except ValueError:
+            overrides[name] = value
+    return overrides
+
+def main(argv=None):
+    """
+    Command line entry point. Exits with status 1 when a task failed.
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tasks", nargs="+", help="Run only these tasks and their upstream tasks")
+    parser.add_argument("--run-id")
+    parser.add_argument("--ds", help="Run date (YYYY-MM-DD), defaults to today")
+    parser.add_argument("--executor", choices=sorted(EXECUTORS), default="thread")
+    parser.add_argument("--max-workers", type=int)
+    parser.add_argument("--set", dest="overrides", action="append", metavar="NAME=VALUE",
+                        help="Replace a configured kwarg in every task that has it (repeatable)")
+    parser.add_argument("--output", help="Write the run summary, with the reports of the tasks, to this JSON file")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(threadName)s %(message)s")
+
+    from config.task_config import task_dict
+
+    summary = run_pipeline(task_dict, args.run_id, args.ds, args.tasks, args.executor, args.max_workers, _parse_overrides(args.overrides))
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(summary, output_file, indent=2, default=str)
+
+    for result in summary["tasks"]:
+        print(f"{result['task_id']:<30} {result['status']:<16} {result['wall_seconds']:>9.3f}s")
+    print(f"{'wall time':<30} {'':<16} {summary['wall_seconds']:>9.3f}s")
+    print(f"{'sum of task times':<30} {'':<16} {summary['task_seconds']:>9.3f}s")
+    print(f"{'critical path':<30} {'':<16} {summary['critical_path_seconds']:>9.3f}s")
+    return 1 if any(result["status"] != "success" for result in summary["tasks"]) else 0
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    sys.exit(main())
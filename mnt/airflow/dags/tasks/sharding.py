@@ -0,0 +1,105 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+def shard_ids(df, key_column, n_shards):
+    """
+    Computes the shard of each row from its user id.
+
+    The same user id always lands in the same shard, whatever the table, so the
+    joins between tables can run shard by shard. The shard is taken from the
+    integer key of the user id (see keys.add_keys), without hashing the strings.
+
+    Args:
+        df (pd.DataFrame): The table to partition.
+        key_column (str): Column holding the user id.
+        n_shards (int): Number of shards.
+
+    Returns:
+        np.ndarray: The shard of each row, between 0 and n_shards - 1.
+    """
+    from . import keys
+
+    high_column, low_column = keys.key_columns(key_column)
+    if high_column in df.columns and low_column in df.columns:
+        high, low = df[high_column].to_numpy(dtype=np.uint64), df[low_column].to_numpy(dtype=np.uint64)
+    else:
+        high, low = keys.encode_uuids(df[key_column])
+    return ((high ^ low) % np.uint64(n_shards)).astype(np.int64)
+
+def shard_frame(df, key_column, n_shards):
+    """
+    Hash-partitions a DataFrame by user id.
+
+    Args:
+        df (pd.DataFrame): The table to partition.
+        key_column (str): Column holding the user id.
+        n_shards (int): Number of shards.
+
+    Returns:
+        list: n_shards DataFrames, one per shard.
+    """
+    shards = shard_ids(df, key_column, n_shards)
+    order = np.argsort(shards, kind="stable")
+    bounds = np.searchsorted(shards[order], np.arange(n_shards + 1))
+    return [df.iloc[order[bounds[shard]:bounds[shard + 1]]] for shard in range(n_shards)]
+
+def _check_shard(allowance_events_df, allowance_backend_df, payment_schedule_backend_df, replay=False):
+    """
+    Runs the cross-table checks of look_for_inconsistencies on a single shard.
+
+    Args:
+        allowance_events_df (pd.DataFrame): The 'allowance_events' rows of the shard.
+        allowance_backend_df (pd.DataFrame): The 'allowance_backend' rows of the shard.
+        payment_schedule_backend_df (pd.DataFrame): The 'payment_schedule_backend' rows of the shard.
+        replay (bool, optional): Check the backend against the state replayed from all the events of the shard.
+
+    Returns:
+        list: The violations found in the shard.
+    """
+    from . import look_for_inconsistencies
+
+    if replay:
+        found = look_for_inconsistencies._check_values_replayed_state(allowance_events_df, allowance_backend_df)
+    else:
+        found = look_for_inconsistencies._check_values_allowance_backend(allowance_events_df, allowance_backend_df)
+    found.extend(look_for_inconsistencies._check_values_payment_schedule_backend(allowance_backend_df, payment_schedule_backend_df))
+    return found
+
+def run_sharded_checks(allowance_events_df, allowance_backend_df, payment_schedule_backend_df, n_shards, max_workers=None, replay=False):
+    """
+    Runs the cross-table checks of look_for_inconsistencies in parallel, one process per shard.
+
+    The three tables are hash-partitioned by user id into n_shards shards, the
+    joins and checks run per shard in a process pool and the violations of every
+    shard are merged back into one violation per check.
+
+    Args:
+        allowance_events_df (pd.DataFrame): The 'allowance_events' table.
+        allowance_backend_df (pd.DataFrame): The 'allowance_backend' table.
+        payment_schedule_backend_df (pd.DataFrame): The 'payment_schedule_backend' table.
+        n_shards (int): Number of shards.
+        max_workers (int, optional): Number of processes. Defaults to min(n_shards, cpu count).
+        replay (bool, optional): Check the backend against the state replayed from all the events (see replay.py).
+
+    Returns:
+        list: The violations found (see violations.make_violation).
+    """
+    from . import instrumentation
+    from . import violations
+
+    max_workers = max_workers or min(n_shards, os.cpu_count() or 1)
+    with instrumentation.stage("shard_tables", rows_in=len(allowance_events_df) + len(allowance_backend_df) + len(payment_schedule_backend_df)):
+        events_shards = shard_frame(allowance_events_df, 'user_id', n_shards)
+        backend_shards = shard_frame(allowance_backend_df, 'uuid', n_shards)
+        payment_shards = shard_frame(payment_schedule_backend_df, 'user_id', n_shards)
+    logging.info(f"Running the cross-table checks on {n_shards} shards with {max_workers} processes")
+
+    with instrumentation.stage("sharded_checks") as record:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            shard_results = list(executor.map(_check_shard, events_shards, backend_shards, payment_shards, [replay] * n_shards))
+        found = violations.merge_violations(shard_results)
+        record["rows_out"] = instrumentation.count_rows(found)
+    return found
@@ -0,0 +1,611 @@
+"""
+Validates the allowance events as they arrive, instead of waiting for the next DAG run.
+
+The events are read as newline-delimited JSON, one event record per line (the records
+of the allowance events payload), by tailing a local file or from a TCP socket that
+producers write to. They are validated in micro-batches against an in-memory index of
+allowance_backend and payment_schedule_backend, loaded with the typed loaders of the
+DAG and refreshed periodically. A micro-batch runs the checks of look_for_inconsistencies
+(the latest event of each user against the backend, then the payment schedule of those
+users), so the stream and the batch runs report the same rules.
+
+The events are read in batches of at most batch_size events, or of what arrived within
+max_latency seconds, and grouped by user. A user is validated once the backend had
+settle_seconds to apply their last event and the index was loaded after that, with
+the latest of their events like in the DAG: the latency of a violation is bounded by
+settle_seconds plus refresh_seconds. At most max_pending events wait in the queue and
+max_waiting events wait for their user to be validated: when the validation falls
+behind, the file is not read further and the socket is not drained, so the producers
+are slowed down instead of the memory growing.
+
+The offending rows go to one sink per hour (see violations.open_sink), under the task
+id stream_allowance_events.<hour>: the Parquet files of an hour are complete once the
+next hour starts or the validator stops. The rows older than ALLOWANCES_STREAM_RETENTION_DAYS
+are removed when a new hour starts.
+
+Usage (from mnt/airflow/dags):
+    python -m tasks.streaming --source file:/var/log/allowance_events.ndjson
+    python -m tasks.streaming --source tcp://0.0.0.0:8799 --batch-size 500 --max-latency 0.5
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlsplit
+
+import numpy as np
+
+from . import keys
+
+BATCH_SIZE = int(os.environ.get("ALLOWANCES_STREAM_BATCH_SIZE", "1000"))
+MAX_BATCH_LATENCY = float(os.environ.get("ALLOWANCES_STREAM_MAX_LATENCY", "1.0"))
+MAX_PENDING_EVENTS = int(os.environ.get("ALLOWANCES_STREAM_MAX_PENDING", "10000"))
+MAX_WAITING_EVENTS = int(os.environ.get("ALLOWANCES_STREAM_MAX_WAITING", "500000"))
+INDEX_REFRESH_SECONDS = int(os.environ.get("ALLOWANCES_STREAM_INDEX_REFRESH_SECONDS", "60"))
+# Time the backend is given to apply an event before it is checked against the event
+SETTLE_SECONDS = float(os.environ.get("ALLOWANCES_STREAM_SETTLE_SECONDS", "5"))
+POLL_INTERVAL = 0.2
+READ_SIZE = 1024 * 1024
+MAX_LINE_BYTES = 1024 * 1024
+STATS_INTERVAL = 60
+LATENCY_WINDOW = 1000
+STREAM_TASK_ID = "stream_allowance_events"
+# The offending rows of an hour share a sink, named after the hour
+SINK_WINDOW_FORMAT = "%Y-%m-%dT%H"
+STREAM_RETENTION_DAYS = float(os.environ.get("ALLOWANCES_STREAM_RETENTION_DAYS", "7"))
+
+class BackendIndex:
+    """
+    The backend tables held in memory, with their user keys in sorted order so the rows
+    of the users of a micro-batch are found with a binary search (see keys.match_keys).
+
+    The violations already reported for a user are remembered until the index is
+    refreshed, so a user with many events is not reported for every one of them.
+    """
+
+    KEY_COLUMNS = {"allowance_backend": "uuid", "payment_schedule_backend": "user_id"}
+
+    def __init__(self, allowance_backend_df, payment_schedule_backend_df, as_of=None):
+        self.frames = {"allowance_backend": allowance_backend_df, "payment_schedule_backend": payment_schedule_backend_df}
+        self._keys = {}
+        for table_name, df in self.frames.items():
+            column = self.KEY_COLUMNS[table_name]
+            high, low = keys.key_halves(df, column)
+            order = keys.sort_order(keys.sortable_keys(df, column))
+            self._keys[table_name] = (high[order], order, low)
+        self.loaded_at = datetime.now()
+        # Monotonic time the tables were read at: the events read before it can be checked against them
+        self.as_of = time.monotonic() if as_of is None else as_of
+        self.reported = set()
+
+    @classmethod
+    def load(cls, allowance_backend_url, payment_schedule_backend_url):
+        """
+        Loads the backend tables through the snapshots of the DAG: when a source did not
+        change since the previous load, its snapshot is read instead of parsing it again.
+
+        Args:
+            allowance_backend_url (str): URL of the 'allowance_backend' table.
+            payment_schedule_backend_url (str): URL of the 'payment_schedule_backend' table.
+
+        Returns:
+            BackendIndex: The index.
+
+        Raises:
+            requests.exceptions.RequestException: If there is an issue with the network request.
+        """
+        from . import utils
+
+        as_of = time.monotonic()
+        run_id = f"stream__{datetime.now().strftime('%Y-%m-%dT%H:%M:%S')}"
+        allowance_backend_df, payment_schedule_backend_df = utils.get_snapshot_dfs(
+            [(allowance_backend_url, "allowance_backend"), (payment_schedule_backend_url, "payment_schedule_backend")],
+            run_id=run_id,
+        )
+        logging.info(f"Backend index loaded: {len(allowance_backend_df)} allowances, {len(payment_schedule_backend_df)} payments")
+        return cls(allowance_backend_df, payment_schedule_backend_df, as_of)
+
+    def rows_for(self, table_name, high, low):
+        """
+        Returns the rows of a backend table for some users.
+
+        Args:
+            table_name (str): 'allowance_backend' or 'payment_schedule_backend'.
+            high (np.ndarray): High halves of the user keys.
+            low (np.ndarray): Low halves of the user keys.
+
+        Returns:
+            pd.DataFrame: The rows of these users, in key order.
+        """
+        ordered_high, order, table_low = self._keys[table_name]
+        _, positions = keys.match_keys(high, low, ordered_high, order, table_low)
+        return self.frames[table_name].take(np.unique(positions))
+
+def events_frame(records):
+    """
+    Builds the frame of a micro-batch of events, typed like utils.read_allowance_events.
+
+    Args:
+        records (list): The nested event records.
+
+    Returns:
+        pd.DataFrame: The events, with the key columns of the user id, sorted by key.
+    """
+    from . import utils
+
+    names = [name for name, _ in utils.ALLOWANCE_EVENT_FIELDS]
+    batch = [[utils._get_nested(record, path) for _, path in utils.ALLOWANCE_EVENT_FIELDS] for record in records]
+    return keys.add_keys(utils._events_frame(batch, names), "user_id").reset_index(drop=True)
+
+def validate_batch(records, index):
+    """
+    Runs the checks of look_for_inconsistencies on a micro-batch of events.
+
+    Only the backend rows of the users of the batch are checked: the latest event of
+    each user against their allowance, then their allowance against their payment schedule.
+
+    Args:
+        records (list): The nested event records.
+        index (BackendIndex): The backend tables.
+
+    Returns:
+        list: The violations found (see violations.make_violation).
+    """
+    from . import look_for_inconsistencies as checks
+
+    allowance_events_df = events_frame(records)
+    high, low = keys.key_halves(allowance_events_df, "user_id")
+    allowance_backend_df = index.rows_for("allowance_backend", high, low)
+    payment_schedule_backend_df = index.rows_for("payment_schedule_backend", high, low)
+
+    found = checks._check_values_allowance_backend(allowance_events_df, allowance_backend_df)
+    found.extend(checks._check_values_payment_schedule_backend(allowance_backend_df, payment_schedule_backend_df))
+    return found
+
+def _not_reported(found, reported):
+    """
+    Drops the offending rows of the users already reported for the same rule.
+
+    Args:
+        found (list): The violations of a micro-batch.
+        reported (set): The (rule, user id) pairs already reported, updated in place.
+
+    Returns:
+        list: The violations with only the rows of users not reported yet.
+    """
+    from . import violation_history
+    from . import violations
+
+    kept = []
+    for violation in found:
+        rows = violation["rows"]
+        if rows is None or rows.empty:
+            kept.append(violation)
+            continue
+        users = violation_history.user_ids(rows)
+        new = ~users.map(lambda user: (violation["rule"], user) in reported).to_numpy(dtype=bool)
+        if new.any():
+            reported.update((violation["rule"], user) for user in users[new])
+            kept.append(violations.make_violation(violation["rule"], violation["message"], rows=rows[new], severity=violation["severity"]))
+    return kept
+
+def _report_violations(spilled):
+    """
+    Logs the violations of a micro-batch, with their samples.
+
+    Args:
+        spilled (list): The violations, their rows written to the sink (see violations.spill_rows).
+    """
+    from . import violations
+
+    entries = {"error": [], "warning": []}
+    for violation in spilled:
+        rows = violation["rows"]
+        entries[violation["severity"]].append({
+            "rule": violation["rule"],
+            "message": violation["message"],
+            "count": violation["count"],
+            "error": violation["error"],
+            "sample": [] if rows is None else json.loads(rows.to_json(orient="records", date_format="iso")),
+            "path": violation.get("path"),
+        })
+    if entries["error"]:
+        logging.error(violations.format_report(entries["error"]))
+    for warning in entries["warning"]:
+        logging.warning(f"{warning['message']} ({warning['count']} rows, rule '{warning['rule']}')")
+
+async def _put_line(queue, line):
+    """
+    Parses a line of the stream and queues its event, waiting while the queue is full.
+
+    Args:
+        queue (asyncio.Queue): The events waiting for validation.
+        line (bytes): The JSON record of an event.
+
+    Returns:
+        bool: False if the line is not a valid event record.
+    """
+    line = line.strip()
+    if not line:
+        return True
+    try:
+        record = json.loads(line)
+    except ValueError as e:
+        logging.warning(f"Skipping an invalid event line: {e}")
+        return False
+    if not isinstance(record, dict):
+        logging.warning("Skipping an event line that is not a JSON object")
+        return False
+    await queue.put((record, time.monotonic()))
+    return True
+
+class StreamValidator:
+    """
+    Reads the events of a source, validates them in micro-batches and writes the
+    offending rows of each batch to the violation sink (see violations.open_sink).
+    """
+
+    def __init__(self, allowance_backend_url, payment_schedule_backend_url, batch_size=BATCH_SIZE,
+                 max_latency=MAX_BATCH_LATENCY, max_pending=MAX_PENDING_EVENTS, max_waiting=MAX_WAITING_EVENTS,
+                 refresh_seconds=INDEX_REFRESH_SECONDS, settle_seconds=SETTLE_SECONDS, sample_size=None):
+        from . import violations
+
+        self.allowance_backend_url = allowance_backend_url
+        self.payment_schedule_backend_url = payment_schedule_backend_url
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.max_pending = max_pending
+        self.max_waiting = max_waiting
+        self.refresh_seconds = refresh_seconds
+        self.settle_seconds = settle_seconds
+        self.sample_size = sample_size or violations.VIOLATION_SAMPLE_SIZE
+        self.run_id = f"stream__{datetime.now().strftime('%Y-%m-%dT%H:%M:%S')}"
+        self.index = None
+        self._sink = None
+        self._sink_window = None
+        # Events of the users waiting for validation: user id -> [read at of the last event, records],
+        # ordered by the read time of their last event so the settled users come first
+        self._waiting = OrderedDict()
+        self._waiting_events = 0
+        self.stats = {"events": 0, "invalid_lines": 0, "batches": 0, "violations": 0, "max_latency_seconds": 0.0}
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._stats_logged_at = time.monotonic()
+
+    def _load_index(self):
+        return BackendIndex.load(self.allowance_backend_url, self.payment_schedule_backend_url)
+
+    async def run(self, source, from_start=False, follow=True):
+        """
+        Validates the events of a source until it ends or the task is cancelled.
+
+        Args:
+            source (str): 'file:PATH' to tail a file of JSON lines, or 'tcp://HOST:PORT'
+                to accept the JSON lines of producers on a socket.
+            from_start (bool, optional): Read a file source from its start instead of its end.
+            follow (bool, optional): Wait for new lines at the end of a file source.
+                Without follow, the users still waiting are validated against the
+                current index at the end of the file and the validation stops.
+
+        Returns:
+            dict: The counters of the run ('events', 'invalid_lines', 'batches',
+                'violations', 'max_latency_seconds').
+
+        Raises:
+            ValueError: If the source is not supported.
+            OSError: If the file can not be read or the socket can not be opened.
+        """
+        loop = asyncio.get_running_loop()
+        self.index = await loop.run_in_executor(None, self._load_index)
+        queue = asyncio.Queue(maxsize=self.max_pending)
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="validate")
+        producer = asyncio.create_task(self._produce(source, queue, from_start, follow))
+        consumer = asyncio.create_task(self._consume(queue, executor))
+        refresher = asyncio.create_task(self._refresh_index())
+        try:
+            done, _ = await asyncio.wait({producer, consumer}, return_when=asyncio.FIRST_COMPLETED)
+            if producer in done and producer.exception() is not None:
+                raise producer.exception()
+            await consumer
+        finally:
+            for task in (producer, consumer, refresher):
+                task.cancel()
+            await asyncio.gather(producer, consumer, refresher, return_exceptions=True)
+            executor.shutdown(wait=True)
+            self._close_sink()
+            self._log_stats()
+        return dict(self.stats)
+
+    async def _produce(self, source, queue, from_start, follow):
+        """
+        Reads the events of the source into the queue, then queues None when the source ends.
+        """
+        parts = urlsplit(source)
+        if parts.scheme == "file":
+            await self._tail_file(source[len("file:"):], queue, from_start, follow)
+        elif parts.scheme == "tcp":
+            await self._serve(parts.hostname, parts.port, queue)
+        else:
+            raise ValueError(f"Unsupported event source '{source}', expected file:PATH or tcp://HOST:PORT")
+        await queue.put(None)
+
+    async def _tail_file(self, path, queue, from_start, follow):
+        """
+        Reads the lines appended to a file. The file is read from its start again when
+        it is truncated or replaced (log rotation), after the rest of the old file.
+        """
+        while follow and not os.path.exists(path):
+            await asyncio.sleep(POLL_INTERVAL)
+        stream = open(path, "rb")
+        try:
+            if not from_start:
+                stream.seek(0, os.SEEK_END)
+            pending = b""
+            while True:
+                data = stream.read(READ_SIZE)
+                if data:
+                    lines = (pending + data).split(b"\n")
+                    pending = lines.pop()
+                    if len(pending) > MAX_LINE_BYTES:
+                        logging.warning(f"Skipping an event line longer than {MAX_LINE_BYTES} bytes")
+                        pending = b""
+                    for line in lines:
+                        self.stats["invalid_lines"] += not await _put_line(queue, line)
+                    continue
+
+                if not follow:
+                    break
+                try:
+                    replaced = os.stat(path).st_ino != os.fstat(stream.fileno()).st_ino
+                except FileNotFoundError:
+                    replaced = False
+                if replaced:
+                    logging.info(f"{path} was rotated, reading the new file")
+                    stream.close()
+                    stream = open(path, "rb")
+                    pending = b""
+                elif os.fstat(stream.fileno()).st_size < stream.tell():
+                    logging.info(f"{path} was truncated, reading it from the start")
+                    stream.seek(0)
+                    pending = b""
+                else:
+                    await asyncio.sleep(POLL_INTERVAL)
+            self.stats["invalid_lines"] += not await _put_line(queue, pending)
+        finally:
+            stream.close()
+
+    async def _serve(self, host, port, queue):
+        """
+        Accepts producers on a TCP socket, each sending JSON lines. A producer is not read
+        further while the queue is full, so TCP flow control slows it down.
+        """
+        async def handle(reader, writer):
+            peer = writer.get_extra_info("peername")
+            logging.info(f"Producer {peer} connected")
+            try:
+                while True:
+                    try:
+                        line = await reader.readline()
+                    except ValueError:
+                        logging.warning(f"Closing producer {peer}: event line longer than {MAX_LINE_BYTES} bytes")
+                        break
+                    if not line:
+                        break
+                    self.stats["invalid_lines"] += not await _put_line(queue, line)
+            except asyncio.CancelledError:
+                # The validator is stopping
+                pass
+            finally:
+                writer.close()
+                logging.info(f"Producer {peer} disconnected")
+
+        server = await asyncio.start_server(handle, host, port, limit=MAX_LINE_BYTES)
+        logging.info(f"Listening for events on {host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+    async def _consume(self, queue, executor):
+        """
+        Reads the queued events in batches and validates the users whose latest event settled.
+        """
+        loop = asyncio.get_running_loop()
+        ended = False
+        while not ended or self._waiting:
+            if not ended and self._waiting_events < self.max_waiting:
+                ended = await self._read_batch(queue)
+            elif not ended:
+                await asyncio.sleep(POLL_INTERVAL)
+            index = self.index
+            records, first_read_at = self._take_settled(index, flush=ended)
+            if not records:
+                continue
+
+            found = await loop.run_in_executor(executor, self._validate, records, index)
+            latency = time.monotonic() - first_read_at
+            self._latencies.append(latency)
+            self.stats["batches"] += 1
+            self.stats["violations"] += found
+            self.stats["max_latency_seconds"] = max(self.stats["max_latency_seconds"], round(latency, 4))
+            if time.monotonic() - self._stats_logged_at >= STATS_INTERVAL:
+                self._log_stats()
+
+    async def _read_batch(self, queue):
+        """
+        Moves at most batch_size queued events to the waiting users, waiting at most
+        max_latency seconds for them. The events already queued are taken without waiting.
+
+        Returns:
+            bool: True if the source ended.
+        """
+        from . import utils
+
+        deadline = time.monotonic() + self.max_latency
+        for _ in range(self.batch_size):
+            if not queue.empty():
+                item = queue.get_nowait()
+            else:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    return False
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    return False
+            if item is None:
+                return True
+
+            record, read_at = item
+            self.stats["events"] += 1
+            self._waiting_events += 1
+            user_id = utils._get_nested(record, ("user", "id"))
+            waiting = self._waiting.get(user_id)
+            if waiting is None:
+                self._waiting[user_id] = [read_at, [record]]
+            else:
+                waiting[0] = read_at
+                waiting[1].append(record)
+                self._waiting.move_to_end(user_id)
+        return False
+
+    def _take_settled(self, index, flush=False):
+        """
+        Removes the users ready for validation from the waiting users.
+
+        Args:
+            index (BackendIndex): The index the users are validated against.
+            flush (bool, optional): Take every waiting user.
+
+        Returns:
+            tuple: The event records of the users, in the order they were read (list),
+                and the monotonic time the oldest last event of a user was read at
+                (float, None without users).
+        """
+        horizon = index.as_of - self.settle_seconds
+        taken = []
+        while self._waiting:
+            user_id, (read_at, _) = next(iter(self._waiting.items()))
+            if not flush and read_at > horizon:
+                break
+            taken.append(self._waiting.pop(user_id))
+        if not taken:
+            return [], None
+        records = [record for _, user_records in taken for record in user_records]
+        self._waiting_events -= len(records)
+        return records, min(read_at for read_at, _ in taken)
+
+    def _validate(self, records, index):
+        """
+        Validates a micro-batch and writes its new offending rows to the sink of the current hour.
+
+        Returns:
+            int: The number of new offending rows.
+        """
+        from . import violations
+
+        found = _not_reported(validate_batch(records, index), index.reported)
+        if not found:
+            return 0
+        spilled = violations.spill_rows(found, self._current_sink(), self.sample_size)
+        _report_violations(spilled)
+        return sum(violation["count"] for violation in spilled)
+
+    def _current_sink(self):
+        """
+        Returns the sink of the current hour. When a new hour starts, the sink of the
+        previous one is closed and the rows older than STREAM_RETENTION_DAYS are removed.
+
+        Returns:
+            ViolationSink: The sink, or a postgres.PostgresViolationSink.
+        """
+        from . import violations
+
+        window = datetime.now().strftime(SINK_WINDOW_FORMAT)
+        if window != self._sink_window:
+            self._close_sink()
+            violations.purge_violations(STREAM_TASK_ID, STREAM_RETENTION_DAYS * 24 * 60 * 60)
+            # A restart within the hour keeps the rows already written for it
+            self._sink = violations.open_sink(self.run_id, f"{STREAM_TASK_ID}.{window}", clear=False)
+            self._sink_window = window
+        return self._sink
+
+    def _close_sink(self):
+        """
+        Closes the sink of the current hour, if any.
+        """
+        if self._sink is not None:
+            self._sink.close()
+            self._sink = None
+            self._sink_window = None
+
+    async def _refresh_index(self):
+        """
+        Reloads the backend index every refresh_seconds. The batches keep using the
+        previous index while the new one loads, and when it fails to load.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            try:
+                self.index = await loop.run_in_executor(None, self._load_index)
+            except Exception as e:
+                logging.error(f"Could not refresh the backend index, keeping the one loaded at {self.index.loaded_at}: {e}")
+
+    def _log_stats(self):
+        latencies = np.array(self._latencies) if self._latencies else np.zeros(1)
+        logging.info(
+            f"{self.stats['events']} events in {self.stats['batches']} batches, {self.stats['violations']} violations, "
+            f"{self.stats['invalid_lines']} invalid lines, {len(self._waiting)} users waiting; batch latency p50 {np.percentile(latencies, 50):.3f}s, "
+            f"p99 {np.percentile(latencies, 99):.3f}s, max {self.stats['max_latency_seconds']:.3f}s"
+        )
+        self._stats_logged_at = time.monotonic()
+
+def main(argv=None):
+    """
+    Command line entry point. Runs until interrupted, or until the end of a file source with --no-follow.
+    """
+    from config.task_config import task_dict
+
+    sources = task_dict["look_for_inconsistencies"]["kwargs"]
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", required=True, help="file:PATH or tcp://HOST:PORT")
+    parser.add_argument("--allowance-backend", default=sources["allowance_backend"])
+    parser.add_argument("--payment-schedule-backend", default=sources["payment_schedule_backend"])
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--max-latency", type=float, default=MAX_BATCH_LATENCY, help="Seconds before a partial batch is validated")
+    parser.add_argument("--max-pending", type=int, default=MAX_PENDING_EVENTS, help="Events read ahead of the validation")
+    parser.add_argument("--max-waiting", type=int, default=MAX_WAITING_EVENTS, help="Events waiting for their user to be validated")
+    parser.add_argument("--refresh-seconds", type=int, default=INDEX_REFRESH_SECONDS)
+    parser.add_argument("--settle-seconds", type=float, default=SETTLE_SECONDS,
+                        help="Time the backend is given to apply an event before it is checked")
+    parser.add_argument("--from-start", action="store_true", help="Read a file source from its start")
+    parser.add_argument("--no-follow", dest="follow", action="store_false", help="Stop at the end of a file source")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    validator = StreamValidator(
+        args.allowance_backend,
+        args.payment_schedule_backend,
+        args.batch_size,
+        args.max_latency,
+        args.max_pending,
+        args.max_waiting,
+        args.refresh_seconds,
+        args.settle_seconds,
+    )
+    # Stop on SIGTERM like on Ctrl+C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        asyncio.run(validator.run(args.source, args.from_start, args.follow))
+    except KeyboardInterrupt:
+        logging.info("Stopped")
+    return 0
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    sys.exit(main())
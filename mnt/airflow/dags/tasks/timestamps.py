@@ -0,0 +1,158 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+EVENT_TIMEZONE = "America/Los_Angeles"
+UNPARSEABLE_ATTR = "unparseable_timestamps"
+
+# Formats found in the sources, detected by a regular expression and parsed with a
+# fixed format. Naive formats are in the timezone given to normalize_timestamps.
+TEXT_FORMATS = [
+    ("iso_utc_fraction", r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{1,9}Z$", "%Y-%m-%dT%H:%M:%S.%fZ", True),
+    ("iso_utc", r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z$", "%Y-%m-%dT%H:%M:%SZ", True),
+    ("local_datetime", r"^\d{4}-\d{2}-\d{2} \d{1,2}:\d{2}:\d{2}$", "%Y-%m-%d %H:%M:%S", False),
+]
+# Number of digits of epoch values and their unit
+EPOCH_UNITS = [
+    (range(1, 12), 10 ** 9),
+    (range(12, 15), 10 ** 6),
+    (range(15, 18), 10 ** 3),
+    (range(18, 20), 1),
+]
+_POWERS_OF_TEN = np.array([10 ** exponent for exponent in range(1, 20)], dtype=np.uint64)
+_MAX_EPOCH_NS = np.iinfo(np.int64).max
+
+def _epoch_to_ns(numbers):
+    """
+    Converts epoch numbers to nanoseconds, detecting the unit (s, ms, us, ns) from the number of digits.
+
+    Args:
+        numbers (np.ndarray): Non-negative epoch numbers of at most 19 digits.
+
+    Returns:
+        np.ndarray: The epoch nanoseconds, -1 for numbers too long to be an epoch or
+            whose nanoseconds do not fit in an int64 (after year 2262).
+    """
+    numbers = numbers.astype(np.uint64)
+    digits = np.searchsorted(_POWERS_OF_TEN, numbers, side='right') + 1
+    result = np.full(len(numbers), -1, dtype=np.int64)
+    for digit_range, factor in EPOCH_UNITS:
+        selected = (digits >= digit_range.start) & (digits < digit_range.stop) & (numbers <= _MAX_EPOCH_NS // factor)
+        result[selected] = (numbers[selected] * np.uint64(factor)).astype(np.int64)
+    return result
+
+def _parse_text(values, timestamp_format, utc, timezone):
+    """
+    Parses timestamps of a single known format.
+
+    Args:
+        values (pd.Series): The timestamps, all of the format.
+        timestamp_format (str): strptime format.
+        utc (bool): Whether the format carries its UTC offset.
+        timezone (str): Timezone of the naive timestamps.
+
+    Returns:
+        np.ndarray: The epoch nanoseconds, -1 where the values could not be parsed.
+    """
+    parsed = pd.to_datetime(values, format=timestamp_format, errors='coerce', utc=utc)
+    if not utc and timezone:
+        ambiguous = np.zeros(len(parsed), dtype=bool)
+        parsed = parsed.dt.tz_localize(timezone, ambiguous=ambiguous, nonexistent='shift_forward').dt.tz_convert('UTC')
+    if parsed.dt.tz is not None:
+        parsed = parsed.dt.tz_localize(None)
+    return parsed.astype('datetime64[ns]').to_numpy(dtype='int64', na_value=-1)
+
+def normalize_timestamps(values, timezone="UTC"):
+    """
+    Converts a timestamp column mixing formats into int64 epoch nanoseconds.
+
+    The format of each value is detected with vectorized string matching (epoch
+    digits, ISO-8601 in UTC with or without fraction, 'YYYY-MM-DD H:MM:SS'), and
+    each group of values is parsed with its fixed format, so no value goes
+    through the generic datetime inference.
+
+    Args:
+        values (pd.Series): The raw timestamps, as strings or numbers.
+        timezone (str, optional): Timezone of the naive timestamps ('YYYY-MM-DD H:MM:SS').
+
+    Returns:
+        tuple: The epoch nanoseconds (pd.Series of Int64, null where the value is
+            null or can not be parsed) and a boolean np.ndarray of the non-null
+            values that could not be parsed.
+    """
+    result = np.full(len(values), -1, dtype=np.int64)
+    null_mask = values.isna().to_numpy()
+
+    if pd.api.types.is_numeric_dtype(values.dtype):
+        numbers = values.to_numpy(dtype='float64', na_value=np.nan)
+        valid = ~null_mask & (numbers >= 0) & (numbers < 10 ** 19) & (numbers == np.floor(numbers))
+        result[valid] = _epoch_to_ns(numbers[valid])
+    else:
+        text = values.astype(str).str.strip()
+        pending = ~null_mask
+        is_epoch = pending & text.str.fullmatch(r"\d{1,19}").fillna(False).to_numpy(dtype=bool)
+        if is_epoch.any():
+            result[is_epoch] = _epoch_to_ns(text[is_epoch].astype(np.uint64).to_numpy())
+        pending &= ~is_epoch
+        for _, pattern, timestamp_format, utc in TEXT_FORMATS:
+            if not pending.any():
+                break
+            selected = pending & text.str.match(pattern).fillna(False).to_numpy(dtype=bool)
+            if selected.any():
+                result[selected] = _parse_text(text[selected], timestamp_format, utc, timezone)
+                pending &= ~selected
+
+    unparseable = ~null_mask & (result < 0)
+    if unparseable.any():
+        logging.warning(f"{int(unparseable.sum())} timestamps of '{values.name}' can not be parsed")
+    return pd.Series(pd.arrays.IntegerArray(np.maximum(result, 0), result < 0), index=values.index, name=values.name), unparseable
+
+def record_unparseable(df, column, raw_values, unparseable):
+    """
+    Keeps the raw values that could not be parsed in the attributes of the DataFrame,
+    by index label, so that the 'parseable_timestamp' rule can report them. The
+    attributes are kept by the Arrow snapshots and by row selections.
+
+    Args:
+        df (pd.DataFrame): The table.
+        column (str): The normalized column.
+        raw_values (pd.Series): The raw values of the column.
+        unparseable (np.ndarray): Boolean mask of the values that could not be parsed.
+    """
+    attr = df.attrs.setdefault(UNPARSEABLE_ATTR, {})
+    if unparseable.any():
+        attr[column] = {
+            "index": raw_values.index[unparseable].tolist(),
+            "values": raw_values[unparseable].astype(str).tolist(),
+        }
+
+def unparseable_mask(values):
+    """
+    Flags the rows of a normalized column whose raw value could not be parsed.
+
+    Args:
+        values (pd.Series): The normalized column, selected from a table prepared by record_unparseable.
+
+    Returns:
+        np.ndarray: Boolean mask of the unparseable rows.
+    """
+    recorded = values.attrs.get(UNPARSEABLE_ATTR, {}).get(values.name)
+    if not recorded:
+        return np.zeros(len(values), dtype=bool)
+    return values.index.isin(recorded["index"])
+
+def unparseable_values(values):
+    """
+    Returns the raw values of the rows of a normalized column that could not be parsed.
+
+    Args:
+        values (pd.Series): The normalized column, selected from a table prepared by record_unparseable.
+
+    Returns:
+        pd.Series: The raw values, by index label.
+    """
+    recorded = values.attrs.get(UNPARSEABLE_ATTR, {}).get(values.name)
+    if not recorded:
+        return pd.Series(dtype=object)
+    return pd.Series(recorded["values"], index=recorded["index"], dtype=object)
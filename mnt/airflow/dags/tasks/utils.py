@@ -1,36 +1,487 @@
+import base64
 import requests
 import json
 import logging
-from io import StringIO
+import os
+import hashlib
+import tempfile
+import codecs
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from datetime import datetime
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
+import pyarrow as pa
+import pyarrow.feather as feather
 
-def fetch_data_from_url(url):
+from . import downloads
+from . import instrumentation
+from . import keys
+from . import profiling
+from . import timestamps
+
+SNAPSHOT_DIR = os.environ.get(
+    "ALLOWANCES_SNAPSHOT_DIR",
+    os.path.join(tempfile.gettempdir(), "allowances_snapshots"),
+)
+SNAPSHOT_RETENTION_DAYS = int(os.environ.get("ALLOWANCES_SNAPSHOT_RETENTION_DAYS", "7"))
+# The snapshots of the scheduled runs are kept longer, so past days can be backfilled (see backfill.py)
+BACKFILL_RETENTION_DAYS = int(os.environ.get("ALLOWANCES_BACKFILL_RETENTION_DAYS", "35"))
+SCHEDULED_RUN_PREFIX = "scheduled__"
+# Run id of the calls without one (CLI, tests): unique per process, so a new process
+# revalidates the sources instead of reusing the snapshots of a previous one
+DEFAULT_RUN_ID = f"manual__{datetime.now().strftime('%Y-%m-%dT%H:%M:%S')}_{os.getpid()}"
+STREAM_CHUNK_SIZE = 1024 * 1024
+CSV_CHUNK_SIZE = 500000
+# Events whose timestamps are normalized together while the events JSON is streamed
+EVENT_BATCH_SIZE = 65536
+# Bytes before the end of the events array kept to check that a resumed read continues the same payload
+RESUME_TAIL_SIZE = 256
+
+# Frames loaded by the tasks of the current process, shared while shared_frames is active
+_shared_frames = None
+_shared_frames_lock = threading.Lock()
+
+ALLOWANCE_EVENT_FIELDS = [
+    ("user_id", ("user", "id")),
+    ("event_timestamp", ("event", "timestamp")),
+    ("event_name", ("event", "name")),
+    ("allowance_scheduled_frequency", ("allowance", "scheduled", "frequency")),
+    ("allowance_scheduled_day", ("allowance", "scheduled", "day")),
+    ("allowance_amount", ("allowance", "amount")),
+]
+
+TABLE_SCHEMAS = {
+    "allowance_backend": {
+        "dtypes": {
+            "uuid": "str",
+            "creation_date": "str",
+            "frequency": "category",
+            "day": "category",
+            "updated_at": "str",
+            "next_payment_day": "Int32",
+            "status": "category",
+        },
+        "small_int_columns": ["next_payment_day"],
+        "timestamp_columns": ["creation_date", "updated_at"],
+        "key_column": "uuid",
+    },
+    "payment_schedule_backend": {
+        "dtypes": {
+            "user_id": "str",
+            "payment_date": "Int32",
+        },
+        "small_int_columns": ["payment_date"],
+        "timestamp_columns": [],
+        "key_column": "user_id",
+    },
+}
+
+def fetch_data_from_url(url, stream=False):
     """
     Fetch data from the given URL.
-    This function sends a GET request to the specified URL and returns the response
-    if the request is successful. If the request fails, it logs an error message
+    This function sends a GET request to the specified URL, over the pooled session
+    shared by the process, and returns the response if the request is successful. If the request fails, it logs an error message
     and raises the exception.
     Args:
         url (str): The URL to fetch data from.
+        stream (bool, optional): If True, the body is not downloaded until it is iterated.
     Returns:
         requests.Response: The response object resulting from the GET request.
     Raises:
         requests.RequestException: If there is an issue with the GET request.
     """
     try:
-        response = requests.get(url)
+        response = downloads.get_session().get(url, stream=stream, timeout=downloads.REQUEST_TIMEOUT)
         response.raise_for_status()
         return response
     except requests.RequestException as e:
         logging.error(f"Failed to fetch data: {e}")
         raise
 
-def fetch_json_from_url(url):
+def _iter_json_array(chunks, array_started=False, progress=None):
+    """
+    Yields the elements of a top-level JSON array one by one, reading the
+    payload chunk by chunk instead of loading the whole document.
+
+    Args:
+        chunks (iterable): Iterable of bytes holding the JSON array.
+        array_started (bool, optional): The payload starts inside the array, after an element
+            (a ranged request resuming a previous read, see fetch_new_events).
+        progress (dict, optional): Receives 'end_offset', the byte offset of the end of the
+            last element of the array (of its start when it is empty), once the closing
+            bracket is reached. A payload appended to the array continues from there.
+
+    Yields:
+        object: Each decoded element of the array.
+
+    Raises:
+        json.JSONDecodeError: If the payload is not a valid JSON array.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    bytes_read = 0
+    # Separators read since the end of the last element, single-byte characters
+    skipped = 0
+    for chunk in chunks:
+        bytes_read += len(chunk)
+        buffer = buffer[position:] + text_decoder.decode(chunk)
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+                skipped += 1
+            if position >= len(buffer):
+                break
+            if not array_started:
+                if buffer[position] != "[":
+                    raise json.JSONDecodeError("Expecting '['", buffer, position)
+                array_started = True
+                position += 1
+                skipped = 0
+                continue
+            if buffer[position] == "]":
+                if progress is not None:
+                    progress["end_offset"] = bytes_read - len(buffer[position:].encode("utf-8")) - skipped
+                return
+            try:
+                element, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                break
+            skipped = 0
+            yield element
+
+    raise json.JSONDecodeError("Unterminated JSON array", buffer, position)
+
+def _get_nested(record, path):
     """
-    Fetches JSON data from a given URL and normalizes it into a pandas DataFrame.
+    Reads a value from nested dictionaries.
+
+    Args:
+        record (dict): The decoded JSON record.
+        path (tuple): Sequence of keys leading to the value.
+
+    Returns:
+        object: The value, or None if any key along the path is missing.
+    """
+    for key in path:
+        if not isinstance(record, dict):
+            return None
+        record = record.get(key)
+    return record
+
+def _iter_record_batches(records, batch_size):
+    """
+    Groups decoded records into lists of at most batch_size records.
+
+    Args:
+        records (iterable): The records.
+        batch_size (int): Maximum number of records per list.
+
+    Yields:
+        list: The records of the batch.
+    """
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def read_allowance_events(chunks, latest_only=False, since=None, array_started=False, progress=None):
+    """
+    Reads the nested allowance events JSON straight into column arrays.
+
+    The records are decoded one at a time and their fields are written into
+    preallocated arrays, so the full Python object tree of the payload never
+    exists in memory. With latest_only, each user keeps a single slot that is
+    overwritten by newer events, so only the latest event per user is kept.
+    The timestamps are compared once normalized like in the checks (see
+    timestamps.normalize_timestamps, in EVENT_TIMEZONE), a batch of records at a
+    time; the events whose timestamp can not be parsed are all kept, so the
+    'allowance_events_timestamp_parseable' rule reports them.
+
+    Args:
+        chunks (iterable): Iterable of bytes holding the JSON array of events.
+        latest_only (bool, optional): Keep only the latest event of each user.
+        since (datetime, optional): Skip the events older than this UTC timestamp.
+        array_started (bool, optional): The payload starts inside the array (see _iter_json_array).
+        progress (dict, optional): Receives the offset of the end of the array (see _iter_json_array).
+
+    Returns:
+        pandas.DataFrame: The events, with the same columns as pd.json_normalize(sep='_')
+            plus the integer keys of 'user_id', sorted by key (see keys.add_keys).
+
+    Raises:
+        json.JSONDecodeError: If the payload is not a valid JSON array.
+    """
+    capacity = 1024
+    columns = {name: np.empty(capacity, dtype=object) for name, _ in ALLOWANCE_EVENT_FIELDS}
+    latest_slots = {}
+    latest_keys = []
+    size = 0
+    since_ns = pd.Timestamp(since).value if since is not None else None
+
+    for batch in _iter_record_batches(_iter_json_array(chunks, array_started, progress), EVENT_BATCH_SIZE):
+        batch_values = [[_get_nested(record, path) for _, path in ALLOWANCE_EVENT_FIELDS] for record in batch]
+        if latest_only or since_ns is not None:
+            epoch_ns, unparseable = timestamps.normalize_timestamps(
+                pd.Series([values[1] for values in batch_values], dtype=object, name='event_timestamp'),
+                timestamps.EVENT_TIMEZONE,
+            )
+            epochs = epoch_ns.to_numpy(dtype='int64', na_value=-1).tolist()
+            unparseable = unparseable.tolist()
+        else:
+            epochs = unparseable = [None] * len(batch_values)
+
+        for values, epoch, is_unparseable in zip(batch_values, epochs, unparseable):
+            if epoch is not None and not is_unparseable:
+                if since_ns is not None and epoch < since_ns:
+                    continue
+                if latest_only:
+                    slot = latest_slots.get(values[0])
+                    if slot is not None:
+                        if epoch >= latest_keys[slot]:
+                            latest_keys[slot] = epoch
+                            for (name, _), value in zip(ALLOWANCE_EVENT_FIELDS, values):
+                                columns[name][slot] = value
+                        continue
+                    latest_slots[values[0]] = size
+            latest_keys.append(epoch)
+
+            if size == capacity:
+                capacity *= 2
+                for name in columns:
+                    columns[name] = np.resize(columns[name], capacity)
+            for (name, _), value in zip(ALLOWANCE_EVENT_FIELDS, values):
+                columns[name][size] = value
+            size += 1
+
+    df = pd.DataFrame({name: array[:size] for name, array in columns.items()})
+    df['allowance_amount'] = pd.to_numeric(df['allowance_amount'])
+    return keys.add_keys(df, 'user_id').reset_index(drop=True)
+
+def iter_allowance_event_chunks(chunks, chunk_rows=CSV_CHUNK_SIZE):
+    """
+    Reads the nested allowance events JSON into DataFrames of at most chunk_rows events,
+    so a payload larger than memory can be processed chunk by chunk (see out_of_core.py).
+
+    Args:
+        chunks (iterable): Iterable of bytes holding the JSON array of events.
+        chunk_rows (int, optional): Maximum number of events per DataFrame.
+
+    Yields:
+        pandas.DataFrame: The events of the chunk, in payload order, with the same
+            columns as read_allowance_events but without the key columns.
+
+    Raises:
+        json.JSONDecodeError: If the payload is not a valid JSON array.
+    """
+    names = [name for name, _ in ALLOWANCE_EVENT_FIELDS]
+    batch = []
+    for record in _iter_json_array(chunks):
+        batch.append([_get_nested(record, path) for _, path in ALLOWANCE_EVENT_FIELDS])
+        if len(batch) == chunk_rows:
+            yield _events_frame(batch, names)
+            batch = []
+    if batch:
+        yield _events_frame(batch, names)
+
+def _events_frame(batch, names):
+    """
+    Builds the DataFrame of a batch of events.
+
+    Args:
+        batch (list): The field values of each event, in ALLOWANCE_EVENT_FIELDS order.
+        names (list): The column names.
+
+    Returns:
+        pandas.DataFrame: The events.
+    """
+    df = pd.DataFrame.from_records(batch, columns=names)
+    df['allowance_amount'] = pd.to_numeric(df['allowance_amount'])
+    return df
+
+def _iter_stream_chunks(stream):
+    """
+    Reads a binary stream in chunks of STREAM_CHUNK_SIZE bytes.
+
+    Args:
+        stream (file-like): Binary stream (file or raw HTTP response).
+
+    Yields:
+        bytes: Each chunk of the stream.
+    """
+    return iter(lambda: stream.read(STREAM_CHUNK_SIZE), b"")
+
+def _parse_json_stream(stream):
+    """
+    Reads the allowance events JSON of a binary stream into a pandas DataFrame.
+
+    Args:
+        stream (file-like): Binary stream holding the JSON payload.
+
+    Returns:
+        pandas.DataFrame: A DataFrame containing the flattened events.
+    """
+    return read_allowance_events(_iter_stream_chunks(stream))
+
+def _parse_latest_json_stream(stream):
+    """
+    Reads the allowance events JSON of a binary stream, keeping only the latest event per user.
+
+    Args:
+        stream (file-like): Binary stream holding the JSON payload.
+
+    Returns:
+        pandas.DataFrame: A DataFrame containing the latest event of each user.
+    """
+    return read_allowance_events(_iter_stream_chunks(stream), latest_only=True)
+
+def _parse_csv_stream(stream):
+    """
+    Parses the CSV of a binary stream into a pandas DataFrame.
+
+    Args:
+        stream (file-like): Binary stream holding the CSV payload.
+
+    Returns:
+        pandas.DataFrame: The CSV data as a DataFrame.
+    """
+    return pd.read_csv(stream)
+
+def _downcast_small_int(values):
+    """
+    Stores a nullable integer column in the smallest integer type that holds its values.
+
+    Args:
+        values (pd.Series): A nullable integer column.
+
+    Returns:
+        pd.Series: The column as Int8, Int16 or the original type.
+    """
+    for dtype in ('Int8', 'Int16'):
+        info = np.iinfo(dtype.lower())
+        if values.isna().all() or (values.min() >= info.min and values.max() <= info.max):
+            return values.astype(dtype)
+    return values
+
+def iter_backend_chunks(stream, table_name, chunksize=CSV_CHUNK_SIZE):
+    """
+    Reads a backend CSV table chunk by chunk, with the dtypes declared in TABLE_SCHEMAS
+    and the timestamp columns normalized to Int64 epoch nanoseconds.
+
+    Args:
+        stream (file-like): Binary or text stream holding the CSV payload.
+        table_name (str): Name of the table, one of TABLE_SCHEMAS keys.
+        chunksize (int, optional): Number of rows parsed per chunk.
+
+    Yields:
+        tuple: The chunk (pd.DataFrame) and, by timestamp column, the raw values
+            of the chunk that can not be parsed (pd.Series indexed like the chunk).
+
+    Raises:
+        KeyError: If the table_name has no declared schema.
+        pandas.errors.ParserError: If there is an issue parsing the CSV data.
+    """
+    schema = TABLE_SCHEMAS[table_name]
+    for chunk in pd.read_csv(stream, dtype=schema["dtypes"], chunksize=chunksize):
+        unparseable = {}
+        for column in schema["timestamp_columns"]:
+            raw_values = chunk[column]
+            chunk[column], chunk_unparseable = timestamps.normalize_timestamps(raw_values)
+            unparseable[column] = raw_values[chunk_unparseable]
+        yield chunk, unparseable
+
+def read_backend_table(stream, table_name, chunksize=CSV_CHUNK_SIZE):
+    """
+    Reads a backend CSV table into a typed, low-memory pandas DataFrame.
+
+    The table is read in chunks with the dtypes declared in TABLE_SCHEMAS:
+    enum columns become categoricals, day-of-month columns are downcast to small
+    integers and timestamp columns are normalized to Int64 epoch nanoseconds
+    (see timestamps.normalize_timestamps). The raw values that can not be parsed
+    are kept in the attributes of the DataFrame for the 'parseable_timestamp' rule.
+    The user id column gets two uint64 key columns and the rows are sorted by key
+    (see keys.add_keys), so the joins and duplicate checks work on sorted integers.
+
+    Args:
+        stream (file-like): Binary or text stream holding the CSV payload.
+        table_name (str): Name of the table, one of TABLE_SCHEMAS keys.
+        chunksize (int, optional): Number of rows parsed per chunk.
+
+    Returns:
+        pandas.DataFrame: The typed table.
+
+    Raises:
+        KeyError: If the table_name has no declared schema.
+        pandas.errors.ParserError: If there is an issue parsing the CSV data.
+    """
+    schema = TABLE_SCHEMAS[table_name]
+    chunks = []
+    unparseable = {column: [] for column in schema["timestamp_columns"]}
+    for chunk, chunk_unparseable in iter_backend_chunks(stream, table_name, chunksize):
+        for column, raw_values in chunk_unparseable.items():
+            unparseable[column].append(raw_values)
+        chunks.append(chunk)
+
+    if not chunks:
+        df = pd.DataFrame({
+            column: pd.Series(dtype="Int64" if column in schema["timestamp_columns"] else dtype)
+            for column, dtype in schema["dtypes"].items()
+        })
+        return keys.add_keys(df, schema["key_column"])
+
+    df = pd.DataFrame({
+        column: (
+            pd.Series(union_categoricals([chunk[column] for chunk in chunks]))
+            if schema["dtypes"].get(column) == "category"
+            else pd.concat([chunk[column] for chunk in chunks], ignore_index=True)
+        )
+        for column in chunks[0].columns
+    })
+    for column in schema["small_int_columns"]:
+        df[column] = _downcast_small_int(df[column])
+    df = keys.add_keys(df, schema["key_column"])
+    sorted_index = df.index
+    df = df.reset_index(drop=True)
+    for column, raw_values in unparseable.items():
+        raw_values = pd.concat(raw_values)
+        raw_values.index = sorted_index.get_indexer(raw_values.index)
+        timestamps.record_unparseable(df, column, raw_values, np.ones(len(raw_values), dtype=bool))
+    return df
+
+SNAPSHOT_PARSERS = {
+    "json": _parse_json_stream,
+    "json_latest": _parse_latest_json_stream,
+    "csv": _parse_csv_stream,
+    "allowance_backend": partial(read_backend_table, table_name="allowance_backend"),
+    "payment_schedule_backend": partial(read_backend_table, table_name="payment_schedule_backend"),
+}
+
+# Table profiled when a snapshot of each format is parsed (see profiling.py)
+PROFILED_FORMATS = {
+    "json": "allowance_events",
+    "json_latest": "allowance_events",
+    "allowance_backend": "allowance_backend",
+    "payment_schedule_backend": "payment_schedule_backend",
+}
+
+def fetch_json_from_url(url, latest_only=False, since=None):
+    """
+    Fetches the allowance events JSON from a given URL and streams it into a pandas DataFrame.
 
     Args:
         url (str): The URL to fetch the JSON data from.
+        latest_only (bool, optional): Keep only the latest event of each user.
+        since (datetime, optional): Skip the events older than this UTC timestamp.
 
     Returns:
         pandas.DataFrame: A DataFrame containing the normalized JSON data.
@@ -40,16 +491,142 @@ def fetch_json_from_url(url):
         json.JSONDecodeError: If the response is not valid JSON.
     """
 
-    response = fetch_data_from_url(url)
-    data = json.loads(response.text)
-    return pd.json_normalize(data, sep='_', max_level=None)
+    with instrumentation.stage("fetch_parse_events") as record:
+        response = fetch_data_from_url(url, stream=True)
+        response.raw.decode_content = True
+        df = read_allowance_events(_iter_stream_chunks(response.raw), latest_only=latest_only, since=since)
+        record["rows_out"] = len(df)
+    return df
+
+class _TailRecorder:
+    """
+    Passes the chunks of a payload through, keeping its last bytes, so the bytes that
+    precede the end of the events array can be kept to verify the next resumed read.
+    """
+
+    def __init__(self, chunks, keep):
+        self.chunks = chunks
+        self.keep = keep
+        self.window = b""
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.size += len(chunk)
+            self.window = (self.window + chunk)[-self.keep:]
+            yield chunk
+
+    def before(self, offset, length):
+        """
+        Returns:
+            bytes: The length bytes (or fewer, if they were not kept) that precede the offset.
+        """
+        window_start = self.size - len(self.window)
+        return self.window[max(offset - length, window_start) - window_start:offset - window_start]
 
-def get_csv_df(url):
+def fetch_new_events(url, resume=None, since=None):
+    """
+    Reads the events appended to the events JSON since a previous read, keeping the latest event of each user.
+
+    The events array is append-only: the byte offset of the end of its last element
+    is kept with the bytes that precede it. The next read only asks
+    for the bytes from there (Range request, If-None-Match on the ETag), after
+    checking that the kept bytes did not change. When the server does not honor the
+    range or the payload was rewritten, the whole payload is read and only the events
+    newer than since are kept.
+
+    Args:
+        url (str): The URL of the events JSON.
+        resume (dict, optional): The resume point returned by the previous read of the URL.
+        since (datetime, optional): Skip the events older than this UTC timestamp when the whole payload is read.
+
+    Returns:
+        tuple: The latest new event of each user (pd.DataFrame, see read_allowance_events)
+            and the resume point of the next read (dict with the keys 'url', 'etag',
+            'offset' and 'tail', or None when the payload can not be resumed).
+
+    Raises:
+        requests.exceptions.RequestException: If there is an issue with the HTTP request.
+        json.JSONDecodeError: If the payload is not a valid JSON array.
+    """
+    # Offsets are offsets of the identity body: a compressed body can not be resumed
+    headers = {"Accept-Encoding": "identity"}
+    tail = b""
+    if resume and resume.get("url") == url and resume.get("offset") is not None:
+        tail = base64.b64decode(resume["tail"])
+        headers["Range"] = f"bytes={resume['offset'] - len(tail)}-"
+        if resume.get("etag"):
+            headers["If-None-Match"] = resume["etag"]
+
+    with instrumentation.stage("fetch_parse_events") as record:
+        try:
+            response = downloads.get_session().get(url, headers=headers, stream=True, timeout=downloads.REQUEST_TIMEOUT)
+            if response.status_code == 304:
+                response.close()
+                logging.info(f"{url} did not change since the previous read")
+                record["status"] = "not_modified"
+                return read_allowance_events([b"[]"]), resume
+            if response.status_code == 416:
+                response.close()
+                logging.warning(f"{url} is shorter than at the previous read, reading it again")
+                return fetch_new_events(url, None, since)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            logging.error(f"Failed to fetch data: {e}")
+            raise
+
+        with response:
+            stream = response.raw
+            stream.decode_content = True
+            resumed = response.status_code == 206
+            if resumed and stream.read(len(tail)) != tail:
+                logging.warning(f"{url} was rewritten since the previous read, reading it again")
+                return fetch_new_events(url, None, since)
+            start = resume["offset"] if resumed else 0
+            encoded = response.headers.get("Content-Encoding", "identity") != "identity"
+            recorder = _TailRecorder(_iter_stream_chunks(stream), RESUME_TAIL_SIZE + STREAM_CHUNK_SIZE)
+            progress = {}
+            df = read_allowance_events(recorder, latest_only=True, since=None if resumed else since,
+                                       array_started=resumed, progress=progress)
+        record["status"] = "resumed" if resumed else "downloaded"
+        record["rows_out"] = len(df)
+
+    if encoded or "end_offset" not in progress:
+        logging.warning(f"{url} can not be resumed, the next read will read the whole payload")
+        return df, None
+    logging.info(f"Read {recorder.size} bytes of {url} from offset {start}")
+    return df, {
+        "url": url,
+        "etag": response.headers.get("ETag", ""),
+        "offset": start + progress["end_offset"],
+        "tail": base64.b64encode(recorder.before(progress["end_offset"], RESUME_TAIL_SIZE)).decode("ascii"),
+    }
+
+def snapshot_version(url, source_format, run_id=None, snapshot_dir=SNAPSHOT_DIR):
+    """
+    Identifies the content of the snapshot of a source for a run: the runs whose
+    source did not change share the same snapshot file (see get_snapshot_df).
+
+    Args:
+        url (str): The URL of the source table.
+        source_format (str): Format of the source.
+        run_id (str, optional): The Airflow run id. Defaults to DEFAULT_RUN_ID.
+        snapshot_dir (str, optional): Directory where the snapshots are stored.
+
+    Returns:
+        str: The path of the snapshot, or None if the run has no snapshot of the source.
+    """
+    manifest = _read_json(os.path.join(snapshot_dir, f"{_snapshot_key(url, source_format, run_id or DEFAULT_RUN_ID)}.json"))
+    return manifest["snapshot_path"] if manifest else None
+
+def get_csv_df(url, table_name=None):
     """
     Fetches CSV data from a given URL and returns it as a pandas DataFrame.
 
     Args:
         url (str): The URL to fetch the CSV data from.
+        table_name (str, optional): Name of a backend table declared in TABLE_SCHEMAS.
+            When given, the typed loader is used instead of dtype inference.
 
     Returns:
         pandas.DataFrame: The CSV data as a DataFrame.
@@ -59,5 +636,338 @@ def get_csv_df(url):
         pandas.errors.ParserError: If there is an issue parsing the CSV data.
     """
 
-    response = fetch_data_from_url(url)
-    return pd.read_csv(StringIO(response.text))
+    response = fetch_data_from_url(url, stream=True)
+    response.raw.decode_content = True
+    if table_name:
+        return read_backend_table(response.raw, table_name)
+    return _parse_csv_stream(response.raw)
+
+def _snapshot_key(*parts):
+    """
+    Builds a stable file name key from the given parts.
+
+    Args:
+        *parts (str): Values identifying the snapshot (URL, validator, run id...).
+
+    Returns:
+        str: Hex digest of the joined parts.
+    """
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()[:32]
+
+def _write_json_atomic(path, content):
+    """
+    Writes a JSON file through a temporary file so readers never see a partial file.
+
+    Args:
+        path (str): Destination path.
+        content (dict): JSON serializable content.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as tmp_file:
+        json.dump(content, tmp_file)
+    os.replace(tmp_path, path)
+
+def _write_snapshot(df, snapshot_path):
+    """
+    Stores a DataFrame as an uncompressed Arrow IPC file, which can be memory-mapped on read.
+
+    Args:
+        df (pandas.DataFrame): The parsed source data.
+        snapshot_path (str): Destination path of the snapshot.
+    """
+    tmp_path = f"{snapshot_path}.tmp"
+    feather.write_feather(df, tmp_path, compression="uncompressed")
+    os.replace(tmp_path, snapshot_path)
+
+def _read_snapshot(snapshot_path):
+    """
+    Memory-maps an Arrow IPC snapshot and converts it to a pandas DataFrame.
+
+    Args:
+        snapshot_path (str): Path of the snapshot.
+
+    Returns:
+        pandas.DataFrame: The snapshot data.
+    """
+    with pa.memory_map(snapshot_path, "r") as source:
+        table = pa.ipc.open_file(source).read_all()
+    return table.to_pandas()
+
+def _purge_old_snapshots(snapshot_dir):
+    """
+    Removes snapshot files older than SNAPSHOT_RETENTION_DAYS.
+
+    The manifests of the scheduled runs of the last BACKFILL_RETENTION_DAYS days are
+    kept, with the snapshots and profiles they point to, so those days can be backfilled.
+
+    Args:
+        snapshot_dir (str): Directory holding the snapshots.
+    """
+    now = datetime.now().timestamp()
+    limit = now - SNAPSHOT_RETENTION_DAYS * 24 * 60 * 60
+    backfill_limit = now - BACKFILL_RETENTION_DAYS * 24 * 60 * 60
+    old_files = []
+    for file_name in os.listdir(snapshot_dir):
+        file_path = os.path.join(snapshot_dir, file_name)
+        try:
+            modified_at = os.path.getmtime(file_path)
+        except OSError:
+            continue
+        if modified_at < limit:
+            old_files.append((file_path, modified_at))
+
+    kept = set()
+    for file_path, modified_at in old_files:
+        if modified_at < backfill_limit or not file_path.endswith(".json") or file_path.endswith((".latest.json", ".profile.json")):
+            continue
+        manifest = _read_json(file_path)
+        if manifest and str(manifest.get("run_id", "")).startswith(SCHEDULED_RUN_PREFIX):
+            snapshot_path = manifest["snapshot_path"]
+            kept.update(os.path.abspath(path) for path in (file_path, snapshot_path, profiling.snapshot_profile_path(snapshot_path)))
+
+    for file_path, _ in old_files:
+        if os.path.abspath(file_path) in kept:
+            continue
+        try:
+            os.remove(file_path)
+        except OSError as e:
+            logging.warning(f"Could not remove old snapshot {file_path}: {e}")
+
+def _read_json(path):
+    """
+    Reads a JSON file.
+
+    Args:
+        path (str): Path of the file.
+
+    Returns:
+        dict: The content of the file, or None if it does not exist or is corrupted.
+    """
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return None
+
+@contextmanager
+def shared_frames():
+    """
+    Shares the frames loaded by get_snapshot_df between the tasks running in this
+    process (see runner.py), so a source read by several tasks of a run is only
+    loaded once. Each task gets a shallow copy, so adding or replacing columns in
+    one task does not change the frame of the others.
+    """
+    global _shared_frames
+    with _shared_frames_lock:
+        _shared_frames = {}
+    try:
+        yield
+    finally:
+        with _shared_frames_lock:
+            _shared_frames = None
+
+def _get_shared_frame(key):
+    """
+    Returns a shallow copy of a shared frame.
+
+    Args:
+        key (tuple): The source key (url, source_format, run_id, snapshot_dir).
+
+    Returns:
+        pandas.DataFrame: The frame, or None if it is not shared (yet).
+    """
+    with _shared_frames_lock:
+        df = _shared_frames.get(key) if _shared_frames is not None else None
+    return df.copy(deep=False) if df is not None else None
+
+def _share_frame(key, df):
+    """
+    Shares a loaded frame with the other tasks of the process, when shared_frames is active.
+
+    Args:
+        key (tuple): The source key (url, source_format, run_id, snapshot_dir).
+        df (pandas.DataFrame): The loaded frame.
+
+    Returns:
+        pandas.DataFrame: The frame for the caller.
+    """
+    with _shared_frames_lock:
+        if _shared_frames is None:
+            return df
+        _shared_frames.setdefault(key, df)
+    return df.copy(deep=False)
+
+def get_snapshot_df(url, source_format, run_id=None, snapshot_dir=SNAPSHOT_DIR, download_dir=downloads.DOWNLOAD_DIR):
+    """
+    Returns the data of a source URL from the local snapshot of the current run.
+
+    The first task of a run that asks for a URL downloads and parses it, and stores the
+    result as an Arrow IPC file keyed by URL, ETag/Last-Modified and run id. Every other
+    task of the same run memory-maps that file instead of making a new HTTP call and
+    parsing the CSV/JSON again. The download is conditional: when the source did not
+    change since the previous run, the snapshot of that run is reused without parsing.
+    Inside shared_frames, the tasks of the same process also share the loaded frame.
+    The columns of a freshly parsed source are profiled before its snapshot is written
+    (see get_snapshot_profile).
+
+    Args:
+        url (str): The URL of the source table.
+        source_format (str): Format of the source, one of SNAPSHOT_PARSERS keys ('json', 'json_latest',
+            'csv' or the name of a backend table declared in TABLE_SCHEMAS).
+        run_id (str, optional): The Airflow run id. Defaults to DEFAULT_RUN_ID, so a call
+            without run id always sends the conditional request.
+        snapshot_dir (str, optional): Directory where the snapshots are stored.
+        download_dir (str, optional): Directory where the source files are downloaded.
+
+    Returns:
+        pandas.DataFrame: The source data.
+
+    Raises:
+        ValueError: If the source_format is not supported.
+        requests.exceptions.RequestException: If there is an issue with the network request.
+    """
+    if source_format not in SNAPSHOT_PARSERS:
+        raise ValueError(f"Unsupported snapshot format '{source_format}'")
+
+    run_id = run_id or DEFAULT_RUN_ID
+    shared_key = (url, source_format, run_id, snapshot_dir)
+    df = _get_shared_frame(shared_key)
+    if df is not None:
+        logging.info(f"Using the frame of {url} loaded by another task for run {run_id}")
+        return df
+    os.makedirs(snapshot_dir, exist_ok=True)
+    manifest_path = os.path.join(snapshot_dir, f"{_snapshot_key(url, source_format, run_id)}.json")
+    latest_path = os.path.join(snapshot_dir, f"{_snapshot_key(url, source_format)}.latest.json")
+
+    with downloads.file_lock(f"{manifest_path}.lock"):
+        df = _get_shared_frame(shared_key)
+        if df is not None:
+            logging.info(f"Using the frame of {url} loaded by another task for run {run_id}")
+            return df
+        manifest = _read_json(manifest_path)
+        if manifest and os.path.exists(manifest["snapshot_path"]):
+            logging.info(f"Reading snapshot of {url} for run {run_id}")
+            with instrumentation.stage("read_snapshot", source=source_format) as record:
+                df = _read_snapshot(manifest["snapshot_path"])
+                record["rows_out"] = len(df)
+            return _share_frame(shared_key, df)
+
+        with instrumentation.stage("fetch", source=source_format) as record:
+            download = downloads.download_source(url, download_dir)
+            record["status"] = download["status"]
+        etag = download.get("etag", "")
+        last_modified = download.get("last_modified", "")
+        validator = etag or last_modified
+        latest = _read_json(latest_path)
+
+        if (download["status"] == "not_modified" and latest and validator
+                and latest["validator"] == validator and latest.get("key_version") == keys.KEY_VERSION
+                and os.path.exists(latest["snapshot_path"])):
+            snapshot_path = latest["snapshot_path"]
+            os.utime(snapshot_path)
+            if os.path.exists(profiling.snapshot_profile_path(snapshot_path)):
+                os.utime(profiling.snapshot_profile_path(snapshot_path))
+            rows = latest["rows"]
+            logging.info(f"{url} did not change, reusing snapshot {snapshot_path}")
+        else:
+            with instrumentation.stage("parse", source=source_format) as record:
+                with open(download["path"], "rb") as source:
+                    df = SNAPSHOT_PARSERS[source_format](source)
+                rows = record["rows_out"] = len(df)
+            snapshot_name = _snapshot_key(url, source_format, validator, run_id)
+            snapshot_path = os.path.join(snapshot_dir, f"{snapshot_name}.arrow")
+            if profiling.PROFILE_ENABLED and source_format in PROFILED_FORMATS:
+                with instrumentation.stage("profile", rows_in=rows, source=source_format):
+                    profile = profiling.profile_frame(PROFILED_FORMATS[source_format], df)
+                    _write_json_atomic(profiling.snapshot_profile_path(snapshot_path), profile.to_dict())
+            with instrumentation.stage("write_snapshot", rows_in=rows, source=source_format):
+                _write_snapshot(df, snapshot_path)
+            _write_json_atomic(latest_path, {"validator": validator, "snapshot_path": snapshot_path, "rows": rows, "key_version": keys.KEY_VERSION})
+            logging.info(f"Snapshot of {url} for run {run_id} stored at {snapshot_path}")
+
+        _write_json_atomic(manifest_path, {
+            "url": url,
+            "source_format": source_format,
+            "run_id": run_id,
+            "etag": etag,
+            "last_modified": last_modified,
+            "snapshot_path": snapshot_path,
+            "rows": rows,
+        })
+
+        with instrumentation.stage("read_snapshot", source=source_format) as record:
+            df = _read_snapshot(snapshot_path)
+            record["rows_out"] = len(df)
+        df = _share_frame(shared_key, df)
+
+    _purge_old_snapshots(snapshot_dir)
+    return df
+
+def get_snapshot_profile(url, source_format, run_id=None, snapshot_dir=SNAPSHOT_DIR, download_dir=downloads.DOWNLOAD_DIR):
+    """
+    Returns the profile of a source, computed when its snapshot was parsed (see get_snapshot_df).
+
+    When the snapshot of the run already exists, its profile is read without loading
+    the snapshot. A snapshot without profile (parsed with ALLOWANCES_PROFILE=0) is
+    loaded and profiled once.
+
+    Args:
+        url (str): The URL of the source table.
+        source_format (str): Format of the source, one of PROFILED_FORMATS keys.
+        run_id (str, optional): The Airflow run id. Defaults to DEFAULT_RUN_ID.
+        snapshot_dir (str, optional): Directory where the snapshots are stored.
+        download_dir (str, optional): Directory where the source files are downloaded.
+
+    Returns:
+        profiling.SourceProfile: The profile.
+
+    Raises:
+        ValueError: If the source_format is not profiled.
+        requests.exceptions.RequestException: If there is an issue with the network request.
+    """
+    if source_format not in PROFILED_FORMATS:
+        raise ValueError(f"Unsupported profile format '{source_format}'")
+
+    run_id = run_id or DEFAULT_RUN_ID
+    manifest_path = os.path.join(snapshot_dir, f"{_snapshot_key(url, source_format, run_id)}.json")
+    df = None
+    manifest = _read_json(manifest_path)
+    if not manifest or not os.path.exists(manifest["snapshot_path"]):
+        df = get_snapshot_df(url, source_format, run_id, snapshot_dir, download_dir)
+        manifest = _read_json(manifest_path)
+    profile_path = profiling.snapshot_profile_path(manifest["snapshot_path"])
+    content = _read_json(profile_path)
+    if content is not None:
+        return profiling.SourceProfile.from_dict(content)
+
+    if df is None:
+        df = get_snapshot_df(url, source_format, run_id, snapshot_dir, download_dir)
+    with instrumentation.stage("profile", rows_in=len(df), source=source_format):
+        profile = profiling.profile_frame(PROFILED_FORMATS[source_format], df)
+    _write_json_atomic(profile_path, profile.to_dict())
+    return profile
+
+def get_snapshot_dfs(sources, run_id=None, snapshot_dir=SNAPSHOT_DIR, download_dir=downloads.DOWNLOAD_DIR):
+    """
+    Returns the snapshots of several sources, downloading and parsing them concurrently.
+
+    The network time is the one of the slowest source instead of the sum of all of them.
+
+    Args:
+        sources (list): Tuples (url, source_format) of the sources.
+        run_id (str, optional): The Airflow run id. Defaults to DEFAULT_RUN_ID.
+        snapshot_dir (str, optional): Directory where the snapshots are stored.
+        download_dir (str, optional): Directory where the source files are downloaded.
+
+    Returns:
+        list: The DataFrames, in the same order as the sources.
+
+    Raises:
+        requests.exceptions.RequestException: If there is an issue with any network request.
+    """
+    with ThreadPoolExecutor(max_workers=max(len(sources), 1)) as executor:
+        futures = [
+            executor.submit(instrumentation.propagate(get_snapshot_df), url, source_format, run_id, snapshot_dir, download_dir)
+            for url, source_format in sources
+        ]
+        return [future.result() for future in futures]
@@ -0,0 +1,462 @@
+"""
+Persistent history of the violations, used to report only what changed since the previous run.
+
+The history is a local SQLite database keyed by (task, rule, user id) holding the run that
+first saw each violation and the last run that saw it, plus the set of violations of
+each recent run. A run is compared with the previous run of the same task with an
+anti-join in both directions: its violations are new, persisting or resolved, and
+only the new ones fail the task and are sent in the error summary. Runs are ordered
+by logical date, not by the time they ran, so a re-run of an old date is compared
+with the run of the date before it.
+"""
+import functools
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+from datetime import datetime
+
+import pandas as pd
+
+from . import instrumentation
+
+HISTORY_DIR = os.environ.get(
+    "ALLOWANCES_HISTORY_DIR",
+    os.path.join(tempfile.gettempdir(), "allowances_history"),
+)
+HISTORY_FILE_NAME = "violation_history.sqlite"
+HISTORY_ENABLED = os.environ.get("ALLOWANCES_VIOLATION_HISTORY", "1") == "1"
+# Number of runs per task whose full set of violations is kept for the diff
+HISTORY_RETENTION_RUNS = int(os.environ.get("ALLOWANCES_HISTORY_RETENTION_RUNS", "30"))
+# Columns identifying the user of an offending row, in order of preference
+USER_ID_COLUMNS = ["user_id", "uuid"]
+# Prefix of the hash standing for the user of the offending rows without user id
+ROW_HASH_PREFIX = "row:"
+
+_VIOLATIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS violations (
+    task_id TEXT NOT NULL,
+    rule TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    first_seen_run_id TEXT NOT NULL,
+    last_seen_run_id TEXT NOT NULL,
+    PRIMARY KEY (task_id, rule, user_id)
+)"""
+_SCHEMA = _VIOLATIONS_TABLE + """;
+CREATE TABLE IF NOT EXISTS run_violations (
+    task_id TEXT NOT NULL,
+    run_id TEXT NOT NULL,
+    rule TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    PRIMARY KEY (task_id, run_id, rule, user_id)
+);
+CREATE TABLE IF NOT EXISTS runs (
+    task_id TEXT NOT NULL,
+    run_id TEXT NOT NULL,
+    finished_at TEXT NOT NULL,
+    logical_date TEXT,
+    PRIMARY KEY (task_id, run_id)
+);
+"""
+# Format of the logical dates stored in the runs table, in UTC, so they sort as text
+LOGICAL_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+def open_history(history_dir=HISTORY_DIR):
+    """
+    Opens (and creates, if needed) the violation history database.
+
+    The tasks of a run update it concurrently, so a writer waits for the others
+    instead of failing on a locked database. A database created by a previous
+    version is migrated (see _migrate).
+
+    Args:
+        history_dir (str, optional): Directory holding the history database.
+
+    Returns:
+        sqlite3.Connection: Connection to the history database.
+    """
+    os.makedirs(history_dir, exist_ok=True)
+    connection = sqlite3.connect(os.path.join(history_dir, HISTORY_FILE_NAME), timeout=300)
+    connection.executescript(_SCHEMA)
+    _migrate(connection)
+    return connection
+
+def _columns(connection, table):
+    """
+    Returns:
+        list: The column names of a table of the history database.
+    """
+    return [row[1] for row in connection.execute(f"PRAGMA table_info({table})")]
+
+def _migrate(connection):
+    """
+    Upgrades a history database created by a previous version, in one transaction
+    taken before checking the schema, so concurrent tasks migrate it once.
+
+    The runs without logical date get the time they finished. The violations keyed by
+    (rule, user_id) get the task of the run that last saw them, from the sets of the
+    recent runs, or '' when that run was purged.
+
+    Args:
+        connection (sqlite3.Connection): Connection to the history database.
+    """
+    if "logical_date" in _columns(connection, "runs") and "task_id" in _columns(connection, "violations"):
+        return
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        if "logical_date" not in _columns(connection, "runs"):
+            connection.execute("ALTER TABLE runs ADD COLUMN logical_date TEXT")
+            connection.execute("UPDATE runs SET logical_date = finished_at")
+        if "task_id" not in _columns(connection, "violations"):
+            connection.execute("ALTER TABLE violations RENAME TO violations_without_task")
+            connection.execute(_VIOLATIONS_TABLE)
+            connection.execute(
+                """
+                INSERT INTO violations (task_id, rule, user_id, first_seen_run_id, last_seen_run_id)
+                SELECT COALESCE(p.task_id, ''), v.rule, v.user_id, v.first_seen_run_id, v.last_seen_run_id
+                FROM violations_without_task v
+                LEFT JOIN run_violations p ON p.run_id = v.last_seen_run_id AND p.rule = v.rule AND p.user_id = v.user_id
+                WHERE true
+                ON CONFLICT (task_id, rule, user_id) DO NOTHING
+                """
+            )
+            connection.execute("DROP TABLE violations_without_task")
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+
+def logical_date(kwargs):
+    """
+    Returns the logical date of the run of a task, the date the run is about.
+
+    Args:
+        kwargs (dict): The task arguments, with the Airflow context.
+
+    Returns:
+        str: The Airflow 'logical_date' (or 'execution_date', 'ts', 'ds'), or the current
+            time for a run outside Airflow, in UTC in the LOGICAL_DATE_FORMAT.
+    """
+    for name in ("logical_date", "execution_date", "ts", "ds"):
+        if kwargs.get(name):
+            date = pd.Timestamp(kwargs[name])
+            break
+    else:
+        date = pd.Timestamp.now(tz="UTC")
+    if date.tzinfo is not None:
+        date = date.tz_convert("UTC").tz_localize(None)
+    return date.strftime(LOGICAL_DATE_FORMAT)
+
+def user_ids(rows):
+    """
+    Returns the user of each offending row.
+
+    The rows without user id (the rows of a table without user column, or a null
+    user id) stand for themselves: they are identified by a hash of their values,
+    so the rule they violate fails again when other rows violate it.
+
+    Args:
+        rows (pd.DataFrame): The offending rows of a rule.
+
+    Returns:
+        pd.Series: The user id of each row, or ROW_HASH_PREFIX followed by the hash of the row.
+    """
+    for column in USER_ID_COLUMNS:
+        if column in rows.columns:
+            users = rows[column].astype(object)
+            missing = users.isna()
+            if missing.any():
+                users = users.where(~missing, _row_hashes(rows))
+            return users.astype(str)
+    return _row_hashes(rows)
+
+def _row_hashes(rows):
+    """
+    Hashes the values of each row, the same for the same values in every run.
+
+    Args:
+        rows (pd.DataFrame): The rows.
+
+    Returns:
+        pd.Series: ROW_HASH_PREFIX followed by the hash of each row.
+    """
+    try:
+        hashes = pd.util.hash_pandas_object(rows, index=False)
+    except TypeError:
+        hashes = pd.util.hash_pandas_object(rows.astype(str), index=False)
+    return ROW_HASH_PREFIX + hashes.astype(str).astype(object)
+
+def previous_run_id(connection, task_id, run_id, run_date):
+    """
+    Returns the latest run of a task whose logical date is not after the one of the current run.
+
+    Runs with the same logical date are ordered by the time they finished.
+
+    Args:
+        connection (sqlite3.Connection): Connection to the history database.
+        task_id (str): Name of the task.
+        run_id (str): The current run id, ignored so that a retry is compared with the run before it.
+        run_date (str): The logical date of the current run (see logical_date).
+
+    Returns:
+        str: The previous run id, or None for the first run of the task.
+    """
+    row = connection.execute(
+        "SELECT run_id FROM runs WHERE task_id = ? AND run_id != ? AND logical_date <= ? "
+        "ORDER BY logical_date DESC, finished_at DESC LIMIT 1",
+        (task_id, run_id, run_date),
+    ).fetchone()
+    return row[0] if row else None
+
+def diff_run(connection, task_id, run_id, current, run_date):
+    """
+    Compares the violations of a run with the ones of the previous run and records them.
+
+    The set of the run replaces the set of a previous attempt of the same run, so a
+    retry gets the same diff. A violation seen again after being resolved counts as new.
+
+    Args:
+        connection (sqlite3.Connection): Connection to the history database.
+        task_id (str): Name of the task.
+        run_id (str): The current run id.
+        current (pd.DataFrame): The violations of the run, one row per (rule, user_id).
+        run_date (str): The logical date of the run (see logical_date).
+
+    Returns:
+        tuple: The previous run id (str or None), the counts per rule (pd.DataFrame
+            indexed by rule with the columns 'new', 'persisting' and 'resolved') and
+            the new violations (pd.DataFrame with the columns 'rule' and 'user_id').
+    """
+    previous = previous_run_id(connection, task_id, run_id, run_date)
+    connection.execute("CREATE TEMP TABLE IF NOT EXISTS current_violations (rule TEXT NOT NULL, user_id TEXT NOT NULL, PRIMARY KEY (rule, user_id))")
+    connection.execute("DELETE FROM current_violations")
+    connection.executemany("INSERT INTO current_violations VALUES (?, ?)", current[["rule", "user_id"]].itertuples(index=False, name=None))
+
+    previous_set = "SELECT 1 FROM run_violations p WHERE p.task_id = ? AND p.run_id = ? AND p.rule = c.rule AND p.user_id = c.user_id"
+    new = pd.read_sql_query(
+        f"SELECT c.rule, c.user_id FROM current_violations c WHERE NOT EXISTS ({previous_set})",
+        connection,
+        params=(task_id, previous),
+    )
+    counts = pd.read_sql_query(
+        f"""
+        SELECT c.rule, SUM(NOT EXISTS ({previous_set})) AS new, SUM(EXISTS ({previous_set})) AS persisting, 0 AS resolved
+        FROM current_violations c GROUP BY c.rule
+        UNION ALL
+        SELECT p.rule, 0, 0, COUNT(*) FROM run_violations p
+        WHERE p.task_id = ? AND p.run_id = ?
+          AND NOT EXISTS (SELECT 1 FROM current_violations c WHERE c.rule = p.rule AND c.user_id = p.user_id)
+        GROUP BY p.rule
+        """,
+        connection,
+        params=(task_id, previous, task_id, previous, task_id, previous),
+    ).groupby("rule").sum()
+
+    connection.execute(
+        """
+        INSERT INTO violations (task_id, rule, user_id, first_seen_run_id, last_seen_run_id)
+        SELECT ?, c.rule, c.user_id, ?, ? FROM current_violations c WHERE true
+        ON CONFLICT (task_id, rule, user_id) DO UPDATE SET
+            first_seen_run_id = CASE
+                WHEN EXISTS (SELECT 1 FROM run_violations p WHERE p.task_id = ? AND p.run_id = ?
+                             AND p.rule = excluded.rule AND p.user_id = excluded.user_id)
+                THEN violations.first_seen_run_id ELSE excluded.first_seen_run_id END,
+            last_seen_run_id = excluded.last_seen_run_id
+        """,
+        (task_id, run_id, run_id, task_id, previous),
+    )
+    connection.execute("DELETE FROM run_violations WHERE task_id = ? AND run_id = ?", (task_id, run_id))
+    connection.execute(
+        "INSERT INTO run_violations SELECT ?, ?, rule, user_id FROM current_violations",
+        (task_id, run_id),
+    )
+    connection.execute(
+        "INSERT OR REPLACE INTO runs (task_id, run_id, finished_at, logical_date) VALUES (?, ?, ?, ?)",
+        (task_id, run_id, datetime.now().isoformat(), run_date),
+    )
+    _purge_old_runs(connection, task_id)
+    return previous, counts, new
+
+def _purge_old_runs(connection, task_id):
+    """
+    Removes the sets of violations of the runs before the HISTORY_RETENTION_RUNS latest runs of a task, by logical date.
+    The first-seen and last-seen runs of the violations are kept.
+
+    Args:
+        connection (sqlite3.Connection): Connection to the history database.
+        task_id (str): Name of the task.
+    """
+    old_runs = connection.execute(
+        "SELECT run_id FROM runs WHERE task_id = ? ORDER BY logical_date DESC, finished_at DESC LIMIT -1 OFFSET ?",
+        (task_id, HISTORY_RETENTION_RUNS),
+    ).fetchall()
+    for (old_run_id,) in old_runs:
+        connection.execute("DELETE FROM run_violations WHERE task_id = ? AND run_id = ?", (task_id, old_run_id))
+        connection.execute("DELETE FROM runs WHERE task_id = ? AND run_id = ?", (task_id, old_run_id))
+
+def apply_history(report, history_dir=HISTORY_DIR, sample_size=None, run_date=None):
+    """
+    Diffs the violations of a report against the previous run of its task.
+
+    The user ids of each rule are read back from the sink (see violations.read_violation_rows).
+    A rule whose rows could not be read is left out of the diff and all its rows count as new.
+
+    Args:
+        report (dict): The report returned by violations.build_report.
+        history_dir (str, optional): Directory holding the history database.
+        sample_size (int, optional): Number of new offending rows kept per rule.
+        run_date (str, optional): The logical date of the run (see logical_date). Defaults to now.
+
+    Returns:
+        dict: The report, with 'new', 'persisting' and 'resolved' (users), 'new_rows'
+            and 'new_sample' in each violation and a 'history' summary ('previous_run_id', the totals and the
+            resolved violations of each rule, including the rules no longer violated).
+    """
+    from . import violations
+
+    sample_size = sample_size or violations.VIOLATION_SAMPLE_SIZE
+    tracked = []
+    rows_by_rule = {}
+    for violation in report["violations"]:
+        if violation["error"] is not None or not violation["count"] or not violation["path"]:
+            continue
+        try:
+            rows = violations.read_violation_rows(violation["path"])
+        except Exception as e:
+            logging.error(f"Could not read the violations of {violation['rule']} from {violation['path']}: {e}")
+            continue
+        rows_by_rule[violation["rule"]] = rows
+        tracked.append(pd.DataFrame({"rule": violation["rule"], "user_id": user_ids(rows)}).drop_duplicates())
+    current = pd.concat(tracked, ignore_index=True) if tracked else pd.DataFrame({"rule": [], "user_id": []})
+
+    with instrumentation.stage("violation_history", rows_in=len(current)) as record:
+        connection = open_history(history_dir)
+        try:
+            with connection:
+                previous, counts, new = diff_run(connection, report["task_id"], report["run_id"] or "manual", current, run_date or logical_date({}))
+        finally:
+            connection.close()
+        record["rows_out"] = len(new)
+
+    new_by_rule = new.groupby("rule")["user_id"].agg(set).to_dict()
+    report = dict(report, violations=[dict(violation) for violation in report["violations"]])
+    for violation in report["violations"]:
+        rule = violation["rule"]
+        if rule in rows_by_rule:
+            rule_counts = counts.loc[rule] if rule in counts.index else None
+            violation["new"] = int(rule_counts["new"]) if rule_counts is not None else 0
+            violation["persisting"] = int(rule_counts["persisting"]) if rule_counts is not None else 0
+            rows = rows_by_rule[rule]
+            new_rows = rows[user_ids(rows).isin(new_by_rule.get(rule, set())).to_numpy()]
+            violation["new_rows"] = len(new_rows)
+            violation["new_sample"] = json.loads(new_rows.head(sample_size).to_json(orient="records", date_format="iso"))
+        else:
+            violation["new"] = violation["count"]
+            violation["persisting"] = 0
+            violation["new_rows"] = violation["count"]
+            violation["new_sample"] = violation["sample"]
+        violation["resolved"] = int(counts.loc[rule, "resolved"]) if rule in counts.index else 0
+
+    report["history"] = {
+        "previous_run_id": previous,
+        "new": int(counts["new"].sum()),
+        "persisting": int(counts["persisting"].sum()),
+        "resolved": int(counts["resolved"].sum()),
+        "resolved_by_rule": {rule: int(resolved) for rule, resolved in counts["resolved"].items() if resolved},
+    }
+    logging.info(
+        f"Violations since run {previous}: {report['history']['new']} new, "
+        f"{report['history']['persisting']} persisting, {report['history']['resolved']} resolved"
+    )
+    return report
+
+def _as_new(violation, previous):
+    """
+    Restricts a violation to its new rows, for the error summary.
+
+    Args:
+        violation (dict): A violation of a report returned by apply_history.
+        previous (str): The previous run id.
+
+    Returns:
+        dict: The violation with the count and sample of its new rows.
+    """
+    if violation["error"] is not None or previous is None:
+        return violation
+    return dict(
+        violation,
+        message=f"{violation['message']}, new since run {previous}",
+        count=violation["new_rows"],
+        sample=violation["new_sample"],
+    )
+
+def raise_for_new_errors(report, sample_size=None):
+    """
+    Fails the task when its report has new violations with 'error' severity.
+
+    Violations already found by the previous run are only logged, so the error summary
+    and the failure email only hold what changed. A rule raising an exception always fails.
+
+    Args:
+        report (dict): The report returned by apply_history.
+        sample_size (int, optional): Maximum number of sample rows printed per rule.
+
+    Returns:
+        dict: The report, when it has no new errors.
+
+    Raises:
+        violations.ViolationsError: If the report has new violations with 'error' severity.
+    """
+    from . import violations
+
+    sample_size = sample_size or violations.VIOLATION_SAMPLE_SIZE
+    previous = report["history"]["previous_run_id"]
+    errors = [
+        violation for violation in report["violations"]
+        if violation["severity"] != "warning" and (violation["error"] is not None or violation["new"])
+    ]
+    if errors:
+        raise violations.ViolationsError(violations.format_report([_as_new(violation, previous) for violation in errors], sample_size), report)
+    logging.info(f"No new errors since run {previous} ({report['history']['persisting']} persisting violations)")
+    return report
+
+def tracked(task_id):
+    """
+    Decorator diffing the report of a look_* task against the previous run of the task
+    (see apply_history), so that only new violations fail it.
+
+    It wraps memo.memoized: a memoized report is diffed like a computed one. The run
+    is compared with the previous one by the logical date of the Airflow context. The diff
+    report is pushed to XCom in place of the full report. Incremental runs only check
+    the changed users and are not tracked. The 'history' argument (or
+    ALLOWANCES_VIOLATION_HISTORY=0) disables the tracking.
+
+    Args:
+        task_id (str): Name of the task.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(**kwargs):
+            from . import violations
+
+            if not kwargs.get("history", HISTORY_ENABLED) or kwargs.get("incremental"):
+                return function(**kwargs)
+
+            try:
+                report = function(**kwargs)
+            except violations.ViolationsError as e:
+                report = e.report
+            sample_size = kwargs.get("violation_sample_size", violations.VIOLATION_SAMPLE_SIZE)
+            report = apply_history(
+                dict(report, task_id=report.get("task_id") or task_id),
+                kwargs.get("history_dir", HISTORY_DIR),
+                sample_size,
+                logical_date(kwargs),
+            )
+            ti = kwargs.get("ti")
+            if ti is not None:
+                ti.xcom_push(key="violations", value=report)
+            return raise_for_new_errors(report, sample_size)
+        return wrapper
+    return decorator
@@ -0,0 +1,397 @@
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from . import instrumentation
+from . import keys
+
+VIOLATIONS_DIR = os.environ.get(
+    "ALLOWANCES_VIOLATIONS_DIR",
+    os.path.join(tempfile.gettempdir(), "allowances_violations"),
+)
+# When set, the offending rows are loaded into Postgres instead of Parquet files (see open_sink)
+VIOLATIONS_DSN = os.environ.get("ALLOWANCES_VIOLATIONS_DSN", "")
+# The offending rows of the batch tasks are removed after this many days (see build_report)
+VIOLATIONS_RETENTION_DAYS = float(os.environ.get("ALLOWANCES_VIOLATIONS_RETENTION_DAYS", "30"))
+VIOLATION_SAMPLE_SIZE = 20
+SINK_BATCH_SIZE = 100000
+
+class ViolationsError(Exception):
+    """
+    Raised when checks find violations with 'error' severity. Keeps the report of the
+    task, so that the result of a failed run can be memoized (see memo.py).
+    """
+
+    def __init__(self, message, report):
+        super().__init__(message)
+        self.report = report
+
+def make_violation(rule, message, rows=None, severity="error", error=None):
+    """
+    Builds the structured result of a violated check.
+
+    Args:
+        rule (str): Name of the check.
+        message (str): Description of the violation, without the offending rows.
+        rows (pd.DataFrame, optional): The offending rows.
+        severity (str, optional): 'error' fails the task, 'warning' is only reported.
+        error (str, optional): Message of the exception raised by the check, if any.
+
+    Returns:
+        dict: The violation, with the keys 'rule', 'message', 'severity', 'count', 'rows' and 'error'.
+    """
+    return {
+        "rule": rule,
+        "message": message,
+        "severity": severity,
+        "count": 0 if rows is None else len(rows),
+        "rows": rows,
+        "error": error,
+    }
+
+def merge_violations(partial_results):
+    """
+    Merges the violations found on separate parts of the data (shards, partitions, chunks).
+
+    The violations of a same rule are merged into one, with the offending rows of
+    every part. The first error raised by a rule, if any, is kept. The counts are
+    summed, so parts whose rows were already spilled (see spill_rows) keep their
+    full count and the path of their Parquet file.
+
+    Args:
+        partial_results (list): One list of violations per part.
+
+    Returns:
+        list: The merged violations, in the order the rules were first found.
+    """
+    merged = {}
+    for found in partial_results:
+        for violation in found:
+            merged.setdefault(violation["rule"], []).append(violation)
+
+    result = []
+    for rule, parts in merged.items():
+        rows = [part["rows"] for part in parts if part["rows"] is not None]
+        errors = [part["error"] for part in parts if part["error"] is not None]
+        paths = [part["path"] for part in parts if part.get("path") is not None]
+        violation = make_violation(
+            rule,
+            parts[0]["message"],
+            rows=pd.concat(rows, ignore_index=True) if rows else None,
+            severity=parts[0]["severity"],
+            error=errors[0] if errors else None,
+        )
+        violation["count"] = sum(part["count"] for part in parts)
+        if paths:
+            violation["path"] = paths[0]
+        result.append(violation)
+    return result
+
+def spill_rows(violations, sink, sample_size=VIOLATION_SAMPLE_SIZE):
+    """
+    Writes the offending rows of violations to the sink right away and keeps only a sample,
+    so the rows of the parts checked one after the other do not add up in memory.
+
+    Args:
+        violations (list): Violations returned by the checks (see make_violation).
+        sink (ViolationSink): The sink of the task.
+        sample_size (int, optional): Number of offending rows kept per violation.
+
+    Returns:
+        list: The violations with their count, at most sample_size rows and the
+            path of the Parquet file holding all their rows.
+    """
+    spilled = []
+    for violation in violations:
+        violation = dict(violation)
+        rows = violation["rows"]
+        if rows is not None and not rows.empty:
+            rows = keys.drop_keys(rows)
+            try:
+                violation["path"] = sink.write(violation["rule"], rows)
+            except Exception as e:
+                logging.error(f"Error writing violations of {violation['rule']}: {e}")
+            violation["rows"] = rows.head(sample_size)
+        spilled.append(violation)
+    return spilled
+
+def _safe_name(name):
+    """
+    Converts a run id or rule name into a safe file name.
+
+    Args:
+        name (str): The name to convert.
+
+    Returns:
+        str: The name with every character outside [A-Za-z0-9_.-] replaced by '_'.
+    """
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", str(name))
+
+class ViolationSink:
+    """
+    Writes the full set of offending rows of each rule to a Parquet file per rule and run.
+
+    Rows are written in batches of SINK_BATCH_SIZE, so the sink never builds an
+    Arrow copy of a whole violation set. The rows of a rule can be written in several
+    calls (partitions, stream batches) and must keep the column types of the first call.
+    Unless clear is False, the files left by a previous attempt of the run and task are
+    removed, so a retry leaves no file of the rules that no longer fire.
+    """
+
+    def __init__(self, run_id, task_id, base_dir=VIOLATIONS_DIR, clear=True):
+        self.directory = os.path.join(base_dir, _safe_name(run_id), _safe_name(task_id))
+        if clear:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        self._writers = {}
+        self._schemas = {}
+        self.paths = {}
+
+    def write(self, rule, rows):
+        """
+        Appends offending rows to the Parquet file of a rule.
+
+        Args:
+            rule (str): Name of the rule.
+            rows (pd.DataFrame): The offending rows.
+
+        Returns:
+            str: Path of the Parquet file of the rule.
+        """
+        if rule not in self._writers:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{_safe_name(rule)}.parquet")
+            schema = pa.Schema.from_pandas(rows, preserve_index=False)
+            # A column without values in the first rows holds strings in the next ones
+            for position, field in enumerate(schema):
+                if pa.types.is_null(field.type):
+                    schema = schema.set(position, field.with_type(pa.string()))
+            self._writers[rule] = pq.ParquetWriter(path, schema)
+            self._schemas[rule] = schema
+            self.paths[rule] = path
+
+        for start in range(0, len(rows), SINK_BATCH_SIZE):
+            batch = rows.iloc[start:start + SINK_BATCH_SIZE]
+            table = pa.Table.from_pandas(batch, schema=self._schemas[rule], preserve_index=False, safe=False)
+            self._writers[rule].write_table(table)
+        return self.paths[rule]
+
+    def close(self):
+        """
+        Closes every open Parquet file.
+        """
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+
+def open_sink(run_id, task_id, base_dir=VIOLATIONS_DIR, clear=True):
+    """
+    Opens the sink of the offending rows of a task: the Postgres table of
+    VIOLATIONS_DSN when it is set (see postgres.PostgresViolationSink),
+    Parquet files under base_dir otherwise.
+
+    Args:
+        run_id (str): The Airflow run id.
+        task_id (str): Name of the task that ran the checks.
+        base_dir (str, optional): Directory where the Parquet files are written.
+        clear (bool, optional): Remove the rows written by a previous attempt of the run and task.
+
+    Returns:
+        ViolationSink: The sink, or a postgres.PostgresViolationSink.
+    """
+    if VIOLATIONS_DSN:
+        from . import postgres
+
+        return postgres.PostgresViolationSink(run_id, task_id, VIOLATIONS_DSN, clear=clear)
+    return ViolationSink(run_id, task_id, base_dir, clear)
+
+def purge_violations(task_id_prefix, retention_seconds, base_dir=VIOLATIONS_DIR):
+    """
+    Removes the offending rows written more than retention_seconds ago by the tasks
+    whose name starts with task_id_prefix, from the sink of open_sink.
+
+    Failures are logged: the rows are removed again by the next purge.
+
+    Args:
+        task_id_prefix (str): Prefix of the names of the tasks.
+        retention_seconds (float): Age of the oldest rows kept.
+        base_dir (str, optional): Directory where the Parquet files are written.
+    """
+    if VIOLATIONS_DSN:
+        from . import postgres
+
+        postgres.purge_violations(VIOLATIONS_DSN, task_id_prefix, retention_seconds)
+        return
+
+    limit = time.time() - retention_seconds
+    prefix = _safe_name(task_id_prefix)
+    try:
+        run_names = os.listdir(base_dir)
+    except FileNotFoundError:
+        return
+    for run_name in run_names:
+        run_dir = os.path.join(base_dir, run_name)
+        try:
+            for task_name in os.listdir(run_dir):
+                task_dir = os.path.join(run_dir, task_name)
+                if not task_name.startswith(prefix):
+                    continue
+                written_at = max([os.path.getmtime(task_dir)] + [entry.stat().st_mtime for entry in os.scandir(task_dir)])
+                if written_at < limit:
+                    shutil.rmtree(task_dir)
+            if not os.listdir(run_dir):
+                os.rmdir(run_dir)
+        except OSError as e:
+            logging.warning(f"Could not remove old violations of {run_dir}: {e}")
+
+def read_violation_rows(path, columns=None):
+    """
+    Reads back the offending rows of a rule from the sink (see open_sink).
+
+    Args:
+        path (str): The path of the rule in a report.
+        columns (list, optional): Read only these columns of a Parquet file.
+
+    Returns:
+        pd.DataFrame: The offending rows.
+    """
+    if path.endswith(".parquet"):
+        return pq.read_table(path, columns=columns).to_pandas()
+    from . import postgres
+
+    return postgres.read_violations(VIOLATIONS_DSN, path)
+
+def build_report(violations, run_id, task_id, ti=None, sample_size=VIOLATION_SAMPLE_SIZE, base_dir=VIOLATIONS_DIR):
+    """
+    Spills the offending rows of each violation to the sink and builds a bounded report.
+
+    The report holds, per rule, the number of offending rows, a sample of at most
+    sample_size rows and the path of the Parquet file (or the Postgres table, see
+    open_sink) with the full set, so its size
+    does not depend on how many rows are bad. The rows of violations that already have
+    a path were spilled while the checks ran (see spill_rows) and are not written again.
+    The rows written by the task more than VIOLATIONS_RETENTION_DAYS ago are removed first.
+    The integer key columns of the user ids are left out of the report. It is pushed to XCom when the task instance is given.
+
+    Args:
+        violations (list): Violations returned by the checks (see make_violation).
+        run_id (str): The Airflow run id.
+        task_id (str): Name of the task that ran the checks.
+        ti (TaskInstance, optional): The Airflow task instance, used to push the report to XCom.
+        sample_size (int, optional): Maximum number of offending rows kept in the report per rule.
+        base_dir (str, optional): Directory where the Parquet files are written.
+
+    Returns:
+        dict: The report, with the keys 'run_id', 'task_id', 'total_violations' and
+            'violations' (list of per-rule dicts with 'rule', 'message', 'severity',
+            'count', 'error', 'sample' and 'path').
+    """
+    purge_violations(task_id, VIOLATIONS_RETENTION_DAYS * 24 * 60 * 60, base_dir)
+    # The sink that spilled rows while the checks ran already removed those of a previous attempt
+    spilled = any(violation.get("path") is not None for violation in violations)
+    sink = open_sink(run_id or "manual", task_id, base_dir, clear=not spilled)
+    report_violations = []
+    with instrumentation.stage("build_report", rows_in=sum(violation["count"] for violation in violations)):
+        try:
+            for violation in violations:
+                rows = violation["rows"]
+                if rows is not None:
+                    rows = keys.drop_keys(rows)
+                path = violation.get("path")
+                sample = []
+                if rows is not None and not rows.empty:
+                    if path is None:
+                        try:
+                            path = sink.write(violation["rule"], rows)
+                        except Exception as e:
+                            logging.error(f"Error writing violations of {violation['rule']}: {e}")
+                    sample = json.loads(rows.head(sample_size).to_json(orient="records", date_format="iso"))
+                report_violations.append({
+                    "rule": violation["rule"],
+                    "message": violation["message"],
+                    "severity": violation["severity"],
+                    "count": violation["count"],
+                    "error": violation["error"],
+                    "sample": sample,
+                    "path": path,
+                })
+        finally:
+            sink.close()
+
+    report = {
+        "run_id": run_id,
+        "task_id": task_id,
+        "total_violations": sum(violation["count"] for violation in report_violations),
+        "violations": report_violations,
+    }
+    if ti is not None:
+        ti.xcom_push(key="violations", value=report)
+    return report
+
+def get_errors(report):
+    """
+    Returns the violations of a report that must fail the task.
+
+    Args:
+        report (dict): The report returned by build_report.
+
+    Returns:
+        list: The violations with 'error' severity. Warnings are logged.
+    """
+    errors = []
+    for violation in report["violations"]:
+        if violation["severity"] == "warning":
+            logging.warning(f"{violation['message']} ({violation['count']} rows)")
+        else:
+            errors.append(violation)
+    return errors
+
+def format_report(violations, sample_size=VIOLATION_SAMPLE_SIZE):
+    """
+    Formats violations into a bounded error summary for the task log and the failure email.
+
+    Args:
+        violations (list): Per-rule violations of a report.
+        sample_size (int, optional): Maximum number of sample rows printed per rule.
+
+    Returns:
+        str: The error summary.
+    """
+    lines = ["Errors found during execution:"]
+    for violation in violations:
+        if violation["error"] is not None:
+            lines.append(f"Error during {violation['rule']} check: {violation['error']}")
+            continue
+        lines.append(f"{violation['message']} ({violation['count']} rows, rule '{violation['rule']}')")
+        for row in violation["sample"][:sample_size]:
+            lines.append(f"    {row}")
+        if violation["count"] > len(violation["sample"][:sample_size]):
+            lines.append(f"    ... full list in {violation['path']}")
+    return "\n".join(lines)
+
+def raise_for_errors(report, sample_size=VIOLATION_SAMPLE_SIZE):
+    """
+    Fails the task when its report has violations with 'error' severity.
+
+    Args:
+        report (dict): The report returned by build_report.
+        sample_size (int, optional): Maximum number of sample rows printed per rule.
+
+    Returns:
+        dict: The report, when it has no errors.
+
+    Raises:
+        ViolationsError: If the report has violations with 'error' severity, with the error summary.
+    """
+    errors = get_errors(report)
+    if errors:
+        raise ViolationsError(format_report(errors, sample_size), report)
+    logging.info("All checks passed successfully.")
+    return report
@@ -0,0 +1,89 @@
+import hashlib
+import os
+import re
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "mnt", "airflow", "dags"))
+
+class SourceServer:
+    """
+    Local stand-in of the source server: serves bodies by path with an ETag, answers
+    If-None-Match, Range and If-Range requests, and can fail the next requests.
+    """
+
+    def __init__(self):
+        self.bodies = {}
+        self.requests = []
+        self.failures = 0
+        self.base_url = None
+
+    def url(self, path):
+        return f"{self.base_url}/{path}"
+
+    @staticmethod
+    def etag(body):
+        return f'"{hashlib.md5(body).hexdigest()}"'
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        source = self.server.source
+        source.requests.append(dict(self.headers))
+        if source.failures:
+            source.failures -= 1
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = source.bodies.get(self.path.lstrip("/"))
+        if body is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        etag = source.etag(body)
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if match and self.headers.get("If-Range", etag) == etag:
+            start = int(match.group(1))
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(body)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+            body = body[start:]
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+@pytest.fixture
+def source_server():
+    """
+    Starts a SourceServer on a free local port for the duration of a test.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    server.source = SourceServer()
+    server.source.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server.source
+    finally:
+        server.shutdown()
+        server.server_close()
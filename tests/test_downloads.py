@@ -0,0 +1,110 @@
+import hashlib
+import os
+
+import pytest
+
+from tasks import downloads
+
+BODY = b"uuid,status\n" + b"".join(f"{index:08d},enabled\n".encode() for index in range(5000))
+
+@pytest.fixture(autouse=True)
+def fresh_session(monkeypatch):
+    """
+    Builds a new shared session per test, retrying without backoff.
+    """
+    monkeypatch.setattr(downloads, "BACKOFF_FACTOR", 0)
+    monkeypatch.setattr(downloads, "_session", None)
+
+def _read(path):
+    with open(path, "rb") as source_file:
+        return source_file.read()
+
+def test_download_then_not_modified(source_server, tmp_path):
+    source_server.bodies["table"] = BODY
+    url = source_server.url("table")
+
+    first = downloads.download_source(url, str(tmp_path))
+    assert first["status"] == "downloaded"
+    assert _read(first["path"]) == BODY
+    assert first["sha256"] == hashlib.sha256(BODY).hexdigest()
+    assert first["etag"] == source_server.etag(BODY)
+
+    second = downloads.download_source(url, str(tmp_path))
+    assert second["status"] == "not_modified"
+    assert source_server.requests[-1]["If-None-Match"] == source_server.etag(BODY)
+    assert second["sha256"] == first["sha256"]
+
+def test_changed_source_is_downloaded_again(source_server, tmp_path):
+    source_server.bodies["table"] = BODY
+    url = source_server.url("table")
+    downloads.download_source(url, str(tmp_path))
+
+    source_server.bodies["table"] = BODY + b"99999999,disabled\n"
+    download = downloads.download_source(url, str(tmp_path))
+    assert download["status"] == "downloaded"
+    assert _read(download["path"]) == source_server.bodies["table"]
+
+def _interrupted_download(source_server, tmp_path, part):
+    """
+    Leaves the state of a download interrupted after the given bytes.
+    """
+    url = source_server.url("table")
+    first = downloads.download_source(url, str(tmp_path))
+    os.remove(first["path"])
+    with open(f"{first['path']}.part", "wb") as part_file:
+        part_file.write(part)
+    downloads._write_metadata(f"{first['path']}.json", {"etag": first["etag"], "last_modified": "", "complete": False})
+    return url
+
+def test_interrupted_download_is_resumed(source_server, tmp_path):
+    source_server.bodies["table"] = BODY
+    url = _interrupted_download(source_server, tmp_path, BODY[:1000])
+
+    download = downloads.download_source(url, str(tmp_path))
+    assert download["status"] == "resumed"
+    assert source_server.requests[-1]["Range"] == "bytes=1000-"
+    assert _read(download["path"]) == BODY
+    assert download["sha256"] == hashlib.sha256(BODY).hexdigest()
+
+def test_resume_of_a_changed_source_restarts(source_server, tmp_path):
+    source_server.bodies["table"] = BODY
+    url = _interrupted_download(source_server, tmp_path, BODY[:1000])
+    source_server.bodies["table"] = b"uuid,status\n" + BODY[12:][::-1]
+
+    download = downloads.download_source(url, str(tmp_path))
+    assert download["status"] == "downloaded"
+    assert _read(download["path"]) == source_server.bodies["table"]
+
+def test_unsatisfiable_range_restarts(source_server, tmp_path):
+    source_server.bodies["table"] = BODY
+    url = _interrupted_download(source_server, tmp_path, BODY + b"stale bytes")
+
+    download = downloads.download_source(url, str(tmp_path))
+    assert download["status"] == "downloaded"
+    assert _read(download["path"]) == BODY
+
+def test_server_errors_are_retried(source_server, tmp_path):
+    source_server.bodies["table"] = BODY
+    source_server.failures = downloads.MAX_RETRIES
+
+    download = downloads.download_source(source_server.url("table"), str(tmp_path))
+    assert download["status"] == "downloaded"
+    assert len(source_server.requests) == downloads.MAX_RETRIES + 1
+    assert _read(download["path"]) == BODY
+
+def test_persistent_server_errors_raise(source_server, tmp_path):
+    source_server.bodies["table"] = BODY
+    source_server.failures = downloads.MAX_RETRIES + 1
+
+    with pytest.raises(downloads.requests.RequestException):
+        downloads.download_source(source_server.url("table"), str(tmp_path))
+
+def test_download_sources_fetches_each_url_once(source_server, tmp_path):
+    source_server.bodies["a"] = BODY
+    source_server.bodies["b"] = BODY[::-1]
+    urls = [source_server.url("a"), source_server.url("b"), source_server.url("a")]
+
+    result = downloads.download_sources(urls, str(tmp_path))
+    assert sorted(result) == sorted(set(urls))
+    assert _read(result[source_server.url("b")]["path"]) == BODY[::-1]
+    assert len(source_server.requests) == 2
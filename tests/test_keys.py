@@ -0,0 +1,71 @@
+import uuid
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from tasks import keys
+
+SEEDS = range(20)
+
+def _user_ids(rng, n_rows):
+    """
+    Draws user ids from a small pool, so that they repeat: canonical UUIDs, the nil
+    UUID and a UUID ending with NOT_UUID_LO, strings that are not UUIDs and null values.
+    """
+    pool = [str(uuid.UUID(int=int(rng.integers(2 ** 62)) << 64 | int(rng.integers(2 ** 62)), version=4)) for _ in range(8)]
+    pool += [str(uuid.UUID(int=0)), "00000000-0000-0000-ffff-ffffffffffff"]
+    pool += ["not-a-uuid", "", "12345678-1234-1234-1234-12345678901z", None]
+    return [pool[index] for index in rng.integers(len(pool), size=n_rows)]
+
+def _tables(seed, with_keys):
+    rng = np.random.default_rng(seed)
+    n_left, n_right = rng.integers(0, 40, size=2)
+    left = pd.DataFrame({"uuid": _user_ids(rng, n_left), "value": np.arange(n_left), "row_left": np.arange(n_left)})
+    right = pd.DataFrame({"user_id": _user_ids(rng, n_right), "value": -np.arange(n_right), "row_right": np.arange(n_right)})
+    if with_keys:
+        left = keys.add_keys(left, "uuid")
+        right = keys.add_keys(right, "user_id")
+    return left, right
+
+def _pairs(df):
+    """
+    Lists the joined rows as tuples, in a canonical order.
+    """
+    columns = ["row_left", "row_right", "uuid", "user_id", "value_x", "value_y", "_merge"]
+    rows = keys.drop_keys(df)[columns].astype(object).to_numpy()
+    return sorted(tuple("null" if pd.isna(value) else str(value) for value in row) for row in rows)
+
+@pytest.mark.parametrize("how", ["inner", "outer"])
+@pytest.mark.parametrize("with_keys", [False, True])
+@pytest.mark.parametrize("seed", SEEDS)
+def test_merge_matches_pandas(seed, with_keys, how):
+    left, right = _tables(seed, with_keys)
+    joined = keys.merge(left, right, left_on="uuid", right_on="user_id", how=how, indicator=True)
+    expected = pd.merge(keys.drop_keys(left), keys.drop_keys(right), left_on="uuid", right_on="user_id", how=how, indicator=True)
+    assert _pairs(joined) == _pairs(expected)
+
+def test_inner_merge_keeps_left_order():
+    left, right = _tables(0, with_keys=False)
+    joined = keys.merge(left, right, left_on="uuid", right_on="user_id")
+    assert (np.diff(joined["row_left"].to_numpy()) >= 0).all()
+
+@pytest.mark.parametrize("keep", ["first", "last", False])
+@pytest.mark.parametrize("with_keys", [False, True])
+@pytest.mark.parametrize("seed", SEEDS)
+def test_duplicated_matches_pandas(seed, with_keys, keep):
+    left, _ = _tables(seed, with_keys)
+    expected = left["uuid"].duplicated(keep=keep).to_numpy()
+    assert (keys.duplicated(left, "uuid", keep=keep) == expected).all()
+
+@pytest.mark.parametrize("value", [str(uuid.uuid4()), "00000000-0000-0000-ffff-ffffffffffff"])
+def test_uuid_case_is_ignored(value):
+    df = pd.DataFrame({"uuid": [value, value.upper()]})
+    assert keys.duplicated(df, "uuid").tolist() == [False, True]
+
+def test_null_key_is_taken_by_no_user_id():
+    values = pd.Series([None, str(uuid.UUID(int=0)), "00000000-0000-0000-ffff-ffffffffffff", "not-a-uuid", np.nan])
+    high, low = keys.encode_uuids(values)
+    is_null_key = (high == keys.NULL_KEY[0]) & (low == keys.NULL_KEY[1])
+    assert is_null_key.tolist() == [True, False, False, False, True]
+    assert len(set(zip(high.tolist(), low.tolist()))) == 4
@@ -0,0 +1,42 @@
+import pytest
+
+from tasks import downloads
+from tasks import memo
+
+@pytest.fixture(autouse=True)
+def fresh_session(monkeypatch, tmp_path):
+    """
+    Builds a new shared session per test, downloading to a temporary directory.
+    """
+    monkeypatch.setattr(downloads, "_session", None)
+    monkeypatch.setattr(downloads.download_sources, "__defaults__", (str(tmp_path / "downloads"), downloads.POOL_SIZE))
+
+def _task(today):
+    """
+    Builds a memoized task whose result depends on a run date defaulting to today.
+    """
+    calls = []
+
+    @memo.memoized("test_task", ["source"], ["violation_sample_size"], {"as_of": lambda kwargs: kwargs.get("as_of") or today[0]})
+    def task(**kwargs):
+        calls.append(kwargs.get("as_of") or today[0])
+        return {"run_id": kwargs.get("run_id"), "violations": []}
+
+    return task, calls
+
+def test_resolved_run_date_is_part_of_the_key(source_server, tmp_path):
+    source_server.bodies["table"] = b"uuid\n1\n"
+    today = ["2024-01-01"]
+    task, calls = _task(today)
+    kwargs = {"source": source_server.url("table"), "memo_dir": str(tmp_path / "memo")}
+
+    task(run_id="first", **kwargs)
+    task(run_id="second", **kwargs)
+    assert calls == ["2024-01-01"]
+
+    today[0] = "2024-01-02"
+    task(run_id="third", **kwargs)
+    assert calls == ["2024-01-01", "2024-01-02"]
+
+    task(run_id="fourth", as_of="2024-01-01", **kwargs)
+    assert calls == ["2024-01-01", "2024-01-02"]
@@ -0,0 +1,49 @@
+import json
+import os
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+import pytest
+
+from config.rules_config import DAYS, FREQUENCIES
+from tasks import look_allowance_backend
+from tasks import payment_calendar
+
+NOTEBOOK = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "exploratory_data_analysis", "exploratory_data_analysis.ipynb")
+
+def _notebook_function():
+    """
+    Loads calculate_next_payment_event from the exploratory analysis, with its current_date global.
+    """
+    with open(NOTEBOOK) as notebook_file:
+        cells = ["".join(cell["source"]) for cell in json.load(notebook_file)["cells"]]
+    source = next(cell for cell in cells if "def calculate_next_payment_event" in cell)
+    namespace = {"datetime": datetime, "timedelta": timedelta}
+    exec(source[:source.index("allowance_events_df[")], namespace)
+    return namespace
+
+@pytest.mark.parametrize("year", [2024, 2025])
+def test_next_payment_day_matches_the_exploratory_analysis(year):
+    namespace = _notebook_function()
+    pairs = pd.DataFrame([(frequency, day) for frequency in FREQUENCIES for day in DAYS], columns=["frequency", "day"])
+    as_of = datetime(year, 1, 1)
+    while as_of.year == year:
+        namespace["current_date"] = as_of
+        expected = [namespace["calculate_next_payment_event"](day, frequency) for frequency, day in zip(pairs["frequency"], pairs["day"])]
+        days = payment_calendar.expected_next_payment_day(pairs["frequency"], pairs["day"], as_of)
+        assert days.tolist() == expected, as_of
+        dates = payment_calendar.next_payment_dates(pairs["frequency"], pairs["day"], as_of)
+        assert ((dates > pd.Timestamp(as_of).to_datetime64()) & (dates <= pd.Timestamp(as_of + timedelta(days=31)).to_datetime64())).all()
+        as_of += timedelta(days=1)
+
+def test_unknown_days_have_no_payment_day():
+    days = payment_calendar.expected_next_payment_day(pd.Series(["weekly", None]), pd.Series(["someday", None]), "2024-12-03")
+    assert days.isna().all()
+
+def test_run_date_is_the_end_of_the_data_interval():
+    end = pd.Timestamp("2024-12-04T00:00:00+00:00")
+    assert look_allowance_backend._run_date({"ds": "2024-12-03", "data_interval_end": end}) == "2024-12-04"
+    assert look_allowance_backend._run_date({"ds": "2024-12-03", "next_ds": "2024-12-04"}) == "2024-12-04"
+    assert look_allowance_backend._run_date({"ds": "2024-12-03"}) == "2024-12-03"
+    assert look_allowance_backend._run_date({"as_of": "2024-01-01", "data_interval_end": end}) == "2024-01-01"
+    assert look_allowance_backend._run_date({}) == date.today().isoformat()
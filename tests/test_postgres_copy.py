@@ -0,0 +1,78 @@
+import json
+import re
+from contextlib import contextmanager
+
+import pandas as pd
+import pytest
+
+from tasks import postgres
+from tasks import violations
+
+AWKWARD_TEXT = ["plain", "back\\slash", "tab\there", "line\nbreak", "carriage\rreturn", "\\N", "\\t literal", "quote\"s", "\u00e9 \x85 \u2028", "\x00\x1f\x7f", ""]
+
+_COPY_ESCAPES = {"\\": "\\", "t": "\t", "n": "\n", "r": "\r"}
+
+def _copy_fields(line):
+    """
+    Decodes a line of the text format of COPY like the server does, for the escapes written by postgres.py.
+    """
+    assert line != "\\N" and "\\N" not in line.split("\t"), "a value was read as NULL"
+    return [re.sub(r"\\(.)", lambda match: _COPY_ESCAPES[match.group(1)], field) for field in line.split("\t")]
+
+@pytest.mark.parametrize("value", AWKWARD_TEXT)
+def test_copy_text_round_trips(value):
+    escaped = postgres._copy_text(value)
+    assert "\t" not in escaped and "\n" not in escaped and "\r" not in escaped
+    assert _copy_fields(escaped) == [value]
+
+class _FakeCursor:
+    def __init__(self, copied):
+        self.copied = copied
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, query, params=None):
+        pass
+
+    def copy_expert(self, query, buffer, size=None):
+        self.copied.append(buffer.getvalue())
+
+class _FakeConnection:
+    def __init__(self, copied):
+        self.copied = copied
+
+    def cursor(self):
+        return _FakeCursor(self.copied)
+
+@pytest.fixture
+def copied(monkeypatch):
+    """
+    Replaces the database connection with one keeping the COPY input of each write.
+    """
+    copied = []
+
+    @contextmanager
+    def connection(dsn):
+        yield _FakeConnection(copied)
+
+    monkeypatch.setattr(postgres, "connection", connection)
+    return copied
+
+def test_sink_rows_round_trip(copied, monkeypatch):
+    monkeypatch.setattr(violations, "SINK_BATCH_SIZE", 4)
+    rows = pd.DataFrame({"uuid": AWKWARD_TEXT, "amount": range(len(AWKWARD_TEXT))})
+    sink = postgres.PostgresViolationSink("run\t1\\", "task\n1", "postgresql://localhost/db")
+
+    location = sink.write("rule\r1", rows)
+    assert location.startswith(f"{postgres.VIOLATIONS_TABLE}?")
+    assert len(copied) == 3
+
+    lines = [line for batch in copied for line in batch.split("\n")[:-1]]
+    assert len(lines) == len(rows)
+    decoded = [_copy_fields(line) for line in lines]
+    assert {tuple(fields[:3]) for fields in decoded} == {("run\t1\\", "task\n1", "rule\r1")}
+    assert [json.loads(fields[3]) for fields in decoded] == rows.to_dict(orient="records")
@@ -0,0 +1,17 @@
+import uuid
+
+import pandas as pd
+
+from tasks import profiling
+
+def test_distinct_estimate_is_capped_at_the_non_null_rows():
+    df = pd.DataFrame({"uuid": [str(uuid.UUID(int=10000 + value, version=4)) for value in range(2882)] + [None] * 10})
+    profile = profiling.SourceProfile("table", {"distinct": ["uuid"]})
+    profile.update(df)
+    previous = profiling.SourceProfile("table", {"distinct": ["uuid"]})
+    previous.update(df)
+
+    assert profile.distinct["uuid"].estimate() > 2882
+    assert profile.distinct_estimate("uuid") == 2882
+    assert profile.summary()["columns"]["uuid"]["distinct"] == 2882
+    assert profiling.detect_drift(profile, [previous], {"row_count": 0.1, "distinct": 0.0, "null_fraction": 0.1}) == []
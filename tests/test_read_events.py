@@ -0,0 +1,91 @@
+import io
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from tasks import timestamps
+from tasks import utils
+
+COLUMNS = [name for name, _ in utils.ALLOWANCE_EVENT_FIELDS]
+USERS = ["11111111-1111-4111-8111-111111111111", "22222222-2222-4222-8222-222222222222", "3333 \"quoted\" \\ user ]", "usér, ünïcode"]
+TIMESTAMPS = ["1727446537", 1727446538000, "2024-09-27T14:15:39Z", "2024-09-27T14:15:39.250Z", "2024-09-27 07:15:40", "not a date", None]
+
+def _event(rng):
+    return {
+        "user": {"id": USERS[rng.integers(len(USERS))]},
+        "event": {"timestamp": TIMESTAMPS[rng.integers(len(TIMESTAMPS))], "name": ["allowance.created", "allowance.edited", "allowance.disabled"][rng.integers(3)]},
+        "allowance": {"scheduled": {"frequency": "weekly", "day": "monday, \"the\" [1st]"}, "amount": int(rng.integers(1, 100))},
+    }
+
+def _payload(seed, n_events=60):
+    rng = np.random.default_rng(seed)
+    return json.dumps([_event(rng) for _ in range(n_events)], indent=int(rng.integers(0, 3)) or None, ensure_ascii=bool(seed % 2)).encode("utf-8")
+
+def _chunks(payload, size):
+    return (payload[start:start + size] for start in range(0, len(payload), size))
+
+def _expected(payload):
+    """
+    Reads the events with pandas, flattened like read_allowance_events.
+    """
+    records = pd.read_json(io.BytesIO(payload), orient="records", dtype=False, convert_dates=False).to_dict(orient="records")
+    df = pd.json_normalize(records, sep="_")
+    return df.reindex(columns=COLUMNS)
+
+def _rows(df):
+    values = df[COLUMNS].astype(object).to_numpy()
+    return sorted(tuple("null" if pd.isna(value) else str(value) for value in row) for row in values)
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 1 << 20])
+@pytest.mark.parametrize("seed", range(4))
+def test_iter_json_array_splits_tokens_across_chunks(seed, chunk_size):
+    payload = _payload(seed)
+    assert list(utils._iter_json_array(_chunks(payload, chunk_size))) == json.loads(payload)
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 1 << 20])
+@pytest.mark.parametrize("seed", range(4))
+def test_read_allowance_events_matches_pandas(seed, chunk_size):
+    payload = _payload(seed)
+    df = utils.read_allowance_events(_chunks(payload, chunk_size))
+    assert _rows(df) == _rows(_expected(payload))
+
+@pytest.mark.parametrize("seed", range(4))
+def test_latest_only_keeps_the_latest_event_and_the_unparseable_ones(seed):
+    payload = _payload(seed)
+    expected = _expected(payload)
+    epochs, unparseable = timestamps.normalize_timestamps(expected["event_timestamp"].astype(object), timestamps.EVENT_TIMEZONE)
+    # Null timestamps are older than any event, like in keys.latest_positions
+    parsed = expected[~unparseable].assign(epoch=epochs[~unparseable].fillna(-1).astype("int64"))
+    # Among the events with the latest timestamp, the last one of the payload is kept
+    latest = parsed.sort_values("epoch", kind="stable").groupby("user_id").tail(1)
+    expected = pd.concat([latest, expected[unparseable]])
+
+    df = utils.read_allowance_events(_chunks(payload, 3), latest_only=True)
+    assert _rows(df) == _rows(expected)
+
+def test_since_skips_older_and_undated_events_and_keeps_the_unparseable_ones():
+    payload = _payload(0)
+    expected = _expected(payload)
+    epochs, unparseable = timestamps.normalize_timestamps(expected["event_timestamp"].astype(object), timestamps.EVENT_TIMEZONE)
+    since = pd.Timestamp("2024-09-27T14:15:39Z").tz_localize(None)
+    expected = expected[unparseable | (epochs >= since.value).fillna(False).to_numpy()]
+
+    df = utils.read_allowance_events(_chunks(payload, 4), since=since)
+    assert _rows(df) == _rows(expected)
+
+def test_end_offset_resumes_an_appended_array():
+    first = json.dumps([{"user": {"id": "a"}, "event": {"timestamp": "1", "name": "x"}}], indent=2).encode("utf-8")
+    progress = {}
+    assert len(list(utils._iter_json_array(_chunks(first, 2), progress=progress))) == 1
+    assert first[progress["end_offset"]:].strip() == b"]"
+
+    appended = b",\n  " + json.dumps({"user": {"id": "b"}}).encode("utf-8") + b"\n]"
+    resumed = list(utils._iter_json_array(_chunks(appended, 3), array_started=True))
+    assert resumed == [{"user": {"id": "b"}}]
+
+@pytest.mark.parametrize("payload", [b"{}", b"[1, 2", b"[1, }]"])
+def test_invalid_arrays_raise(payload):
+    with pytest.raises(json.JSONDecodeError):
+        list(utils._iter_json_array(_chunks(payload, 2)))
@@ -0,0 +1,70 @@
+import pandas as pd
+
+from tasks import replay
+
+A = "aaaaaaaa-aaaa-4aaa-8aaa-aaaaaaaaaaaa"
+B = "bbbbbbbb-bbbb-4bbb-8bbb-bbbbbbbbbbbb"
+C = "cccccccc-cccc-4ccc-8ccc-cccccccccccc"
+D = "dddddddd-dddd-4ddd-8ddd-dddddddddddd"
+E = "eeeeeeee-eeee-4eee-8eee-eeeeeeeeeeee"
+
+def _epoch(local_time):
+    return pd.Timestamp(f"2024-09-21 {local_time}", tz=replay.timestamps.EVENT_TIMEZONE).value
+
+def _events():
+    """
+    The events of a few users, out of order, with ties and an unparseable timestamp.
+    """
+    rows = [
+        # A is disabled then enabled again within the same second, listed before its creation
+        (A, "10:00:05", "allowance.disabled", None, None, None),
+        (A, "10:00:00", "allowance.created", "weekly", "monday", 10),
+        (A, "10:00:05", "allowance.enabled", None, None, None),
+        (A, "10:00:03", "allowance.edited", "daily", None, 20),
+        # B is disabled last, although its enabled event arrives after
+        (B, "9:00:00", "allowance.created", "weekly", "friday", 5),
+        (B, "9:30:00", "allowance.disabled", None, None, None),
+        (B, "9:10:00", "allowance.enabled", None, None, None),
+        (B, "not a date", "allowance.edited", None, None, 99),
+        (None, "9:00:00", "allowance.created", "daily", None, 1),
+        (D, "8:00:00", "allowance.created", "monthly", "first_day", 7),
+        (E, "8:00:00", "allowance.created", "weekly", "monday", 3),
+    ]
+    df = pd.DataFrame(rows, columns=["user_id", "event_timestamp", "event_name", "allowance_scheduled_frequency", "allowance_scheduled_day", "allowance_amount"])
+    df["event_timestamp"] = [value if value == "not a date" else f"2024-09-21 {value}" for value in df["event_timestamp"]]
+    df.index = df.index + 100
+    return df
+
+def test_replay_keeps_the_latest_value_of_each_field():
+    state = replay.replay_events(_events()).set_index("user_id")
+
+    assert state.loc[A, ["status", "status_event", "frequency", "day", "amount"]].tolist() == ["enabled", "allowance.enabled", "daily", "monday", 20]
+    assert state.loc[A, ["created_at", "last_event_at", "event_count"]].tolist() == [_epoch("10:00:00"), _epoch("10:00:05"), 4]
+    # The unparseable event is the oldest of B, so its amount is not the latest
+    assert state.loc[B, ["status", "status_event", "amount"]].tolist() == ["disabled", "allowance.disabled", 5]
+    assert state.loc[B, "event_count"] == 4
+    assert sorted(state.index) == [A, B, D, E]
+    assert state.attrs[replay.UNPARSEABLE_EVENTS_ATTR] == [107]
+
+def test_compare_state_flags_each_kind_of_mismatch():
+    backend = pd.DataFrame({
+        "uuid": [A, B, C, E],
+        "status": ["enabled", "enabled", "enabled", "enabled"],
+        "frequency": ["daily", "weekly", "weekly", "monthly"],
+        "day": ["monday", "friday", "monday", "monday"],
+        "creation_date": [_epoch("10:00:02"), _epoch("9:00:10"), _epoch("7:00:00"), _epoch("8:00:00")],
+    })
+    joined, masks = replay.compare_state(replay.replay_events(_events()), backend)
+
+    users = joined["uuid"].fillna(joined["expected_user_id"])
+    flagged = {name: sorted(users[mask]) for name, mask in masks.items()}
+    assert flagged == {
+        "missing_in_backend": [D],
+        "missing_in_events": [C],
+        # B was disabled by its latest lifecycle event
+        "status": [B],
+        # E is enabled by its creation only, its schedule still has to match
+        "schedule": [E],
+        # A was created 2 seconds after its event, within the tolerance
+        "creation_date": [B],
+    }
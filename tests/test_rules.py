@@ -0,0 +1,97 @@
+import uuid
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from tasks import keys
+from tasks import rules
+
+FREQUENCIES = ["daily", "biweekly", "weekly", "monthly"]
+
+def _table(seed, categorical, with_keys):
+    """
+    Builds a backend-like table with repeated user ids and nulls in every column.
+    """
+    rng = np.random.default_rng(seed)
+    n_rows = int(rng.integers(0, 50))
+    pool = [str(uuid.UUID(int=int(rng.integers(2 ** 62)), version=4)) for _ in range(10)] + [None]
+    df = pd.DataFrame({
+        "uuid": [pool[index] for index in rng.integers(len(pool), size=n_rows)],
+        "frequency": [(FREQUENCIES + ["yearly", None])[index] for index in rng.integers(6, size=n_rows)],
+        "next_payment_day": pd.array([None if value == 40 else value for value in rng.integers(-2, 41, size=n_rows).tolist()], dtype="Int32"),
+        "amount": np.where(rng.random(n_rows) < 0.2, np.nan, rng.normal(10, 10, n_rows)),
+    })
+    if categorical:
+        df["frequency"] = df["frequency"].astype("category")
+    if with_keys:
+        df = keys.add_keys(df, "uuid")
+    return df
+
+def _rule(name, column, rule_type, **params):
+    rule = {"name": name, "column": column, "type": rule_type, "severity": "error", "message": name}
+    if params:
+        rule["params"] = params
+    return rule
+
+RULES = [
+    _rule("not_null", "*", "not_null"),
+    _rule("unique_uuid", "uuid", "unique"),
+    _rule("payment_day_range", "next_payment_day", "range", min=1, max=31),
+    _rule("amount_min", "amount", "range", min=0),
+    _rule("frequency_allowed", "frequency", "isin", values=FREQUENCIES),
+    _rule("uuid_allowed", "uuid", "isin", values=[]),
+]
+
+def _expected_masks(df):
+    """
+    The offending rows of RULES, with the plain pandas checks the rules replaced.
+    """
+    plain = keys.drop_keys(df)
+    expected = [(("not_null", column), plain[column].isnull()) for column in plain.columns]
+    grouped = plain.groupby("uuid").size()
+    expected += [
+        (("unique_uuid", "uuid"), plain["uuid"].isin(grouped[grouped > 1].index)),
+        (("payment_day_range", "next_payment_day"), ((plain["next_payment_day"] < 1) | (plain["next_payment_day"] > 31)).fillna(False)),
+        (("amount_min", "amount"), plain["amount"] < 0),
+        (("frequency_allowed", "frequency"), ~plain["frequency"].isin(FREQUENCIES)),
+        (("uuid_allowed", "uuid"), ~plain["uuid"].isin([])),
+    ]
+    return {key: mask.to_numpy(dtype=bool) for key, mask in expected}
+
+@pytest.mark.parametrize("with_keys", [False, True])
+@pytest.mark.parametrize("categorical", [False, True])
+@pytest.mark.parametrize("seed", range(10))
+def test_rules_flag_the_rows_of_the_plain_checks(seed, categorical, with_keys):
+    df = _table(seed, categorical, with_keys)
+    results = rules.evaluate_rules(df, RULES)
+
+    masks = {(result["rule"]["name"], result["rule"]["column"]): result["mask"] for result in results}
+    assert all(result["error"] is None for result in results)
+    assert set(masks) == set(_expected_masks(df))
+    for key, expected in _expected_masks(df).items():
+        assert masks[key].tolist() == expected.tolist(), key
+    assert [result["rule"]["position"] for result in results] == sorted(result["rule"]["position"] for result in results)
+
+def test_missing_column_is_reported_as_an_error_of_its_rules_only():
+    df = _table(0, categorical=False, with_keys=False).drop(columns=["frequency"])
+    results = rules.evaluate_rules(df, RULES)
+
+    errors = {result["rule"]["name"]: result for result in results if result["error"] is not None}
+    assert set(errors) == {"frequency_allowed"}
+    assert errors["frequency_allowed"]["mask"] is None and errors["frequency_allowed"]["count"] == 0
+    assert sum(result["rule"]["name"] == "not_null" for result in results) == len(df.columns)
+
+def test_null_column_is_flagged_by_the_rules_that_reject_nulls():
+    df = pd.DataFrame({"uuid": [None, None], "frequency": pd.Series([None, None], dtype=object),
+                       "next_payment_day": pd.array([None, None], dtype="Int32"), "amount": [np.nan, np.nan]})
+    masks = {(result["rule"]["name"], result["rule"]["column"]): result["mask"].tolist() for result in rules.evaluate_rules(df, RULES)}
+    assert masks[("not_null", "uuid")] == [True, True]
+    assert masks[("unique_uuid", "uuid")] == [False, False]
+    assert masks[("payment_day_range", "next_payment_day")] == [False, False]
+    assert masks[("frequency_allowed", "frequency")] == [True, True]
+
+def test_check_rules_names_the_rules_declared_for_every_column():
+    df = pd.DataFrame({"uuid": ["a", None], "frequency": ["daily", "yearly"]})
+    found = rules.check_rules("table", df, [RULES[0], RULES[4]])
+    assert [(violation["rule"], violation["count"]) for violation in found] == [("not_null.uuid", 1), ("frequency_allowed", 1)]
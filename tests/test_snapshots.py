@@ -0,0 +1,35 @@
+import json
+import os
+import time
+
+from tasks import utils
+
+DAY = 24 * 60 * 60
+
+def _write(path, content, age_days):
+    with open(path, "w") as output_file:
+        output_file.write(content)
+    modified_at = time.time() - age_days * DAY
+    os.utime(path, (modified_at, modified_at))
+
+def _run_files(snapshot_dir, run_id, age_days):
+    """
+    Writes the manifest and snapshot files of a run, as left by utils.get_snapshot_df.
+    """
+    name = utils._snapshot_key("http://source/table", "csv", run_id)
+    snapshot_path = os.path.join(snapshot_dir, f"{name}.arrow")
+    manifest_path = os.path.join(snapshot_dir, f"{name}.json")
+    _write(snapshot_path, "", age_days)
+    _write(manifest_path, json.dumps({"run_id": run_id, "snapshot_path": snapshot_path}), age_days)
+    return manifest_path, snapshot_path
+
+def test_scheduled_runs_are_kept_for_backfills(tmp_path):
+    snapshot_dir = str(tmp_path)
+    recent = _run_files(snapshot_dir, "manual__1", utils.SNAPSHOT_RETENTION_DAYS - 1)
+    manual = _run_files(snapshot_dir, "manual__2", utils.SNAPSHOT_RETENTION_DAYS + 1)
+    scheduled = _run_files(snapshot_dir, "scheduled__2025-01-01T00:00:00+00:00", utils.SNAPSHOT_RETENTION_DAYS + 1)
+    expired = _run_files(snapshot_dir, "scheduled__2024-01-01T00:00:00+00:00", utils.BACKFILL_RETENTION_DAYS + 1)
+
+    utils._purge_old_snapshots(snapshot_dir)
+    assert all(os.path.exists(path) for path in recent + scheduled)
+    assert not any(os.path.exists(path) for path in manual + expired)
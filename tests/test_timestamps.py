@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from tasks import timestamps
+
+UNITS = [(range(1, 12), "s"), (range(12, 15), "ms"), (range(15, 18), "us"), (range(18, 20), "ns")]
+
+def _random_values(rng, n_values):
+    """
+    Builds timestamps of every supported format, plus nulls and values that can not be parsed.
+    """
+    seconds = rng.integers(0, 2 * 10 ** 9, size=n_values)
+    values = []
+    for second, kind in zip(seconds.tolist(), rng.integers(0, 9, size=n_values).tolist()):
+        moment = pd.Timestamp(second, unit="s")
+        if kind == 0:
+            values.append(str(second))
+        elif kind == 1:
+            values.append(str(second * 1000 + int(rng.integers(1000))))
+        elif kind == 2:
+            values.append(str(second * 10 ** 6 + int(rng.integers(10 ** 6))))
+        elif kind == 3:
+            values.append(str(second * 10 ** 9 + int(rng.integers(10 ** 9))))
+        elif kind == 4:
+            values.append(moment.strftime("%Y-%m-%dT%H:%M:%SZ"))
+        elif kind == 5:
+            values.append(moment.strftime("%Y-%m-%dT%H:%M:%S.") + str(int(rng.integers(10 ** 9))).zfill(9)[:int(rng.integers(1, 10))] + "Z")
+        elif kind == 6:
+            values.append(f"{moment:%Y-%m-%d} {moment.hour}:{moment:%M:%S}")
+        elif kind == 7:
+            values.append(None)
+        else:
+            values.append(["not a date", "2024-13-01T00:00:00Z", "-5", "1" * 20, "9" * 19, "99999999999", ""][int(rng.integers(7))])
+    return pd.Series(values, dtype=object, name="event_timestamp")
+
+def _expected(value, timezone):
+    """
+    Parses one timestamp with pd.to_datetime, the unit or timezone chosen like normalize_timestamps does.
+    """
+    if value is None:
+        return None
+    if value.isdigit():
+        unit = next((unit for digits, unit in UNITS if len(value) in digits), None)
+        if unit is None or int(value) > np.iinfo(np.int64).max:
+            return "unparseable"
+        try:
+            return pd.to_datetime(int(value), unit=unit).as_unit("ns").value
+        except (OverflowError, pd.errors.OutOfBoundsDatetime):
+            return "unparseable"
+    parsed = pd.to_datetime(value, errors="coerce", utc=value.endswith("Z"))
+    if parsed is pd.NaT:
+        return "unparseable"
+    if parsed.tzinfo is None:
+        parsed = parsed.tz_localize(timezone, ambiguous=False, nonexistent="shift_forward")
+    return parsed.value
+
+def _actual(epochs, unparseable):
+    return ["unparseable" if bad else (None if pd.isna(epoch) else epoch) for epoch, bad in zip(epochs.tolist(), unparseable)]
+
+@pytest.mark.parametrize("timezone", ["UTC", timestamps.EVENT_TIMEZONE])
+@pytest.mark.parametrize("seed", range(5))
+def test_mixed_column_matches_pandas(seed, timezone):
+    values = _random_values(np.random.default_rng(seed), 300)
+    epochs, unparseable = timestamps.normalize_timestamps(values, timezone)
+    assert epochs.index.equals(values.index) and epochs.name == values.name
+    assert _actual(epochs, unparseable) == [_expected(value, timezone) for value in values]
+
+@pytest.mark.parametrize("digits, unit", [(1, "s"), (10, "s"), (12, "ms"), (13, "ms"), (15, "us"), (16, "us"), (18, "ns"), (19, "ns")])
+def test_epoch_unit_follows_the_number_of_digits(digits, unit):
+    value = int("1" * digits)
+    epochs, unparseable = timestamps.normalize_timestamps(pd.Series([str(value), f" {value} "]))
+    assert not unparseable.any()
+    assert epochs.tolist() == [pd.to_datetime(value, unit=unit).value] * 2
+
+def test_epochs_after_the_datetime64_range_are_unparseable():
+    values = pd.Series(["9223372036", "9223372037", "10000000000", "9223372036854775807", "9999999999999999999", "99999999999999"])
+    epochs, unparseable = timestamps.normalize_timestamps(values)
+    assert unparseable.tolist() == [False, True, True, False, True, True]
+    assert epochs.tolist()[0] == pd.to_datetime(9223372036, unit="s").value
+    assert epochs.tolist()[3] == np.iinfo(np.int64).max
+
+def test_numeric_column_matches_pandas():
+    values = pd.Series([1727446537, 1727446538000, np.nan, -1, 1727446537.5, 1727446538000000000])
+    epochs, unparseable = timestamps.normalize_timestamps(values)
+    assert epochs.tolist()[:2] + epochs.tolist()[5:] == [pd.to_datetime(1727446537, unit="s").value, pd.to_datetime(1727446538000, unit="ms").value, pd.to_datetime(1727446538000000000, unit="ns").value]
+    assert unparseable.tolist() == [False, False, False, True, True, False]
+    assert epochs.isna().tolist() == [False, False, True, True, True, False]
+
+@pytest.mark.parametrize("value, timezone", [
+    ("2024-11-03 1:30:00", timestamps.EVENT_TIMEZONE),
+    ("2024-03-10 2:30:00", timestamps.EVENT_TIMEZONE),
+    ("2024-07-01 12:00:00", "Europe/Paris"),
+    ("2024-07-01 12:00:00", "UTC"),
+])
+def test_local_timestamps_are_converted_from_the_timezone(value, timezone):
+    epochs, _ = timestamps.normalize_timestamps(pd.Series([value]), timezone)
+    assert epochs.iloc[0] == pd.Timestamp(value).tz_localize(timezone, ambiguous=False, nonexistent="shift_forward").value
+
+def test_utc_timestamps_ignore_the_timezone():
+    values = pd.Series(["2024-09-27T14:15:39Z", "2024-09-27T14:15:39.123456789Z"])
+    epochs, _ = timestamps.normalize_timestamps(values, timestamps.EVENT_TIMEZONE)
+    assert epochs.tolist() == [pd.to_datetime(value, utc=True).value for value in values]
+
+def test_unparseable_values_follow_the_rows_of_the_table():
+    raw = pd.Series(["1727446537", "not a date", None, "2024-13-01T00:00:00Z"], index=[10, 11, 12, 13], name="event_timestamp")
+    epochs, unparseable = timestamps.normalize_timestamps(raw)
+    df = pd.DataFrame({"event_timestamp": epochs, "user_id": list("abcd")})
+    timestamps.record_unparseable(df, "event_timestamp", raw, unparseable)
+
+    assert timestamps.unparseable_mask(df["event_timestamp"]).tolist() == [False, True, False, True]
+    selected = df[df["user_id"] != "b"]
+    assert timestamps.unparseable_mask(selected["event_timestamp"]).tolist() == [False, False, True]
+    assert timestamps.unparseable_values(selected["event_timestamp"]).to_dict() == {11: "not a date", 13: "2024-13-01T00:00:00Z"}
+    assert not timestamps.unparseable_mask(df["user_id"]).any()
+    assert timestamps.unparseable_values(df["user_id"]).empty
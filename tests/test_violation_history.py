@@ -0,0 +1,79 @@
+import sqlite3
+
+import pandas as pd
+
+from tasks import violation_history
+
+def _run(connection, run_id, ds, users):
+    current = pd.DataFrame({"rule": ["rule"] * len(users), "user_id": users})
+    with connection:
+        previous, _, new = violation_history.diff_run(connection, "task", run_id, current, violation_history.logical_date({"ds": ds}))
+    return previous, sorted(new["user_id"])
+
+def test_runs_are_compared_by_logical_date(tmp_path):
+    connection = violation_history.open_history(str(tmp_path))
+    assert _run(connection, "day1", "2024-01-01", ["a"]) == (None, ["a"])
+    assert _run(connection, "day3", "2024-01-03", ["a", "c"]) == ("day1", ["c"])
+    assert _run(connection, "day2", "2024-01-02", ["a", "b"]) == ("day1", ["b"])
+    assert _run(connection, "day2", "2024-01-02", ["a", "b"]) == ("day1", ["b"])
+    assert _run(connection, "day4", "2024-01-04", ["a"]) == ("day3", [])
+
+def test_logical_date_is_in_utc():
+    assert violation_history.logical_date({"ts": "2024-01-01T05:00:00+02:00"}) == "2024-01-01T03:00:00.000000"
+    assert violation_history.logical_date({"ds": "2024-01-01"}) == "2024-01-01T00:00:00.000000"
+
+def test_history_without_logical_dates_is_migrated(tmp_path):
+    connection = sqlite3.connect(str(tmp_path / violation_history.HISTORY_FILE_NAME))
+    connection.execute("CREATE TABLE runs (task_id TEXT NOT NULL, run_id TEXT NOT NULL, finished_at TEXT NOT NULL, PRIMARY KEY (task_id, run_id))")
+    connection.execute("INSERT INTO runs VALUES ('task', 'old', '2024-01-01T10:00:00.000000')")
+    connection.commit()
+    connection.close()
+
+    connection = violation_history.open_history(str(tmp_path))
+    assert _run(connection, "new", "2024-01-02", []) == ("old", [])
+
+def test_history_without_task_in_the_violations_key_is_migrated(tmp_path):
+    connection = sqlite3.connect(str(tmp_path / violation_history.HISTORY_FILE_NAME))
+    connection.executescript(
+        """
+        CREATE TABLE violations (rule TEXT NOT NULL, user_id TEXT NOT NULL, first_seen_run_id TEXT NOT NULL, last_seen_run_id TEXT NOT NULL, PRIMARY KEY (rule, user_id));
+        CREATE TABLE run_violations (task_id TEXT NOT NULL, run_id TEXT NOT NULL, rule TEXT NOT NULL, user_id TEXT NOT NULL, PRIMARY KEY (task_id, run_id, rule, user_id));
+        INSERT INTO violations VALUES ('rule', 'a', 'day0', 'day1'), ('rule', 'gone', 'day0', 'day0');
+        INSERT INTO run_violations VALUES ('task', 'day1', 'rule', 'a');
+        """
+    )
+    connection.commit()
+    connection.close()
+
+    connection = violation_history.open_history(str(tmp_path))
+    rows = connection.execute("SELECT task_id, rule, user_id, first_seen_run_id FROM violations ORDER BY user_id").fetchall()
+    assert rows == [("task", "rule", "a", "day0"), ("", "rule", "gone", "day0")]
+
+def test_violations_are_kept_per_task(tmp_path):
+    connection = violation_history.open_history(str(tmp_path))
+    current = pd.DataFrame({"rule": ["rule"], "user_id": ["a"]})
+    with connection:
+        violation_history.diff_run(connection, "first_task", "day1", current, violation_history.logical_date({"ds": "2024-01-01"}))
+        violation_history.diff_run(connection, "second_task", "day2", current, violation_history.logical_date({"ds": "2024-01-02"}))
+        violation_history.diff_run(connection, "first_task", "day2", current, violation_history.logical_date({"ds": "2024-01-02"}))
+    rows = connection.execute("SELECT task_id, first_seen_run_id, last_seen_run_id FROM violations ORDER BY task_id").fetchall()
+    assert rows == [("first_task", "day1", "day2"), ("second_task", "day2", "day2")]
+
+def test_rows_without_user_are_identified_by_their_values():
+    rows = pd.DataFrame({"metric": ["rows", "rows", "nulls"], "value": [1.0, 1.0, 0.5]})
+    users = violation_history.user_ids(rows)
+    assert users[0] == users[1] != users[2]
+    assert users.str.startswith(violation_history.ROW_HASH_PREFIX).all()
+    assert violation_history.user_ids(rows.iloc[[2]]).tolist() == [users[2]]
+
+    with_users = pd.DataFrame({"user_id": ["a", None, None], "status": ["x", "y", "z"]})
+    users = violation_history.user_ids(with_users)
+    assert users[0] == "a" and users[1] != users[2]
+    assert users[1].startswith(violation_history.ROW_HASH_PREFIX)
+
+def test_rule_without_user_fails_again_for_other_rows(tmp_path):
+    connection = violation_history.open_history(str(tmp_path))
+    first = violation_history.user_ids(pd.DataFrame({"metric": ["rows"], "value": [1.0]}))
+    second = violation_history.user_ids(pd.DataFrame({"metric": ["rows"], "value": [2.0]}))
+    assert _run(connection, "day1", "2024-01-01", first.tolist())[1] == first.tolist()
+    assert _run(connection, "day2", "2024-01-02", second.tolist())[1] == second.tolist()
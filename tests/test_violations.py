@@ -0,0 +1,54 @@
+import os
+
+import pandas as pd
+
+from tasks import violations
+
+def test_rows_of_a_rule_are_appended_across_writes(tmp_path):
+    sink = violations.ViolationSink("run", "task", str(tmp_path))
+    sink.write("rule", pd.DataFrame({"status": [None, None], "amount": [1, 2]}))
+    path = sink.write("rule", pd.DataFrame({"status": ["enabled", "disabled"], "amount": [3, 4]}))
+    sink.close()
+
+    rows = violations.read_violation_rows(path)
+    assert rows["amount"].tolist() == [1, 2, 3, 4]
+    assert rows["status"].tolist()[2:] == ["enabled", "disabled"]
+
+def test_purge_removes_only_old_rows_of_the_prefix(tmp_path):
+    paths = {}
+    for run_id, task_id in [("stream__1", "stream_allowance_events.2024-01-01T00"), ("stream__1", "stream_allowance_events.2024-01-01T01"), ("run", "look_payment_schedule")]:
+        sink = violations.ViolationSink(run_id, task_id, str(tmp_path))
+        paths[task_id] = sink.write("rule", pd.DataFrame({"user_id": ["a"]}))
+        sink.close()
+    for task_id in ("stream_allowance_events.2024-01-01T00", "look_payment_schedule"):
+        os.utime(paths[task_id], (0, 0))
+        os.utime(os.path.dirname(paths[task_id]), (0, 0))
+
+    violations.purge_violations("stream_allowance_events", 3600, str(tmp_path))
+    assert not os.path.exists(paths["stream_allowance_events.2024-01-01T00"])
+    assert os.path.exists(paths["stream_allowance_events.2024-01-01T01"])
+    assert os.path.exists(paths["look_payment_schedule"])
+
+def test_retry_removes_the_rows_of_the_previous_attempt(tmp_path):
+    sink = violations.ViolationSink("run", "task", str(tmp_path))
+    stale = sink.write("fixed_rule", pd.DataFrame({"user_id": ["a"]}))
+    sink.close()
+
+    report = violations.build_report([violations.make_violation("rule", "rule", pd.DataFrame({"user_id": ["b"]}))], "run", "task", base_dir=str(tmp_path))
+    assert not os.path.exists(stale)
+    assert os.path.exists(report["violations"][0]["path"])
+
+def test_build_report_keeps_the_spilled_rows_and_purges_old_runs_of_the_task(tmp_path):
+    old = violations.ViolationSink("old_run", "task", str(tmp_path))
+    old_path = old.write("rule", pd.DataFrame({"user_id": ["a"]}))
+    old.close()
+    os.utime(old_path, (0, 0))
+    os.utime(os.path.dirname(old_path), (0, 0))
+
+    sink = violations.open_sink("run", "task", str(tmp_path))
+    spilled = violations.spill_rows([violations.make_violation("rule", "rule", pd.DataFrame({"user_id": ["b"]}))], sink)
+    sink.close()
+    report = violations.build_report(spilled, "run", "task", base_dir=str(tmp_path))
+
+    assert not os.path.exists(os.path.join(str(tmp_path), "old_run"))
+    assert violations.read_violation_rows(report["violations"][0]["path"])["user_id"].tolist() == ["b"]